@@ -13,6 +13,15 @@ def main():
     transportobj = transport.Transport()
     boss = pluginbase.PluginBoss(sys.argv[1], transportobj)
 
+    # e.g. "dispatch": {"max_depth": 5000, "shed": ["irc.on_privmsg"]}
+    # or, with priority lanes,
+    # "dispatch": {"max_depth": 5000, "default_lane": 1, "shed_lane": 2,
+    #     "lanes": {"irc.do_kick": 0, "irc.do_mode": 0, "irc.do_raw": 0,
+    #         "irc.on_privmsg": 2, "irc.on_action": 2}}
+    dispatch = boss.config['core'].get('dispatch')
+    if dispatch is not None:
+        transportobj.set_queued_dispatch(**dispatch)
+
     observer = log.FileLogObserver(sys.stdout)
     observer.timeFormat = "%Y-%m-%d %H:%M:%S"
     log.startLoggingWithObserver(observer.emit)
@@ -21,6 +30,11 @@ def main():
 
     boss.load_all_plugins()
 
+    # Reload plugins when their config files are edited, unless the core
+    # config has "watch_config": false
+    if boss.config['core'].get('watch_config', True):
+        boss.watch_config_dir()
+
     reactor.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+import json
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+from timeit import default_timer as _timer
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from .transport import make_event, event_attrs, _SubscriptionTrie
+
+"""
+Event journals: a compact binary record of the events sent through a
+transport, and a way to feed them back into a transport later.
+
+A journal file starts with the 4 bytes MAGIC. Each record after that is a
+header packed as RECORD_HEADER (the time the event was sent, as a float of
+seconds since the epoch, and the length of the payload in bytes) followed by
+the payload: the event type and attributes as compact UTF-8 JSON
+{"t": eventtype, "a": {attributes}}.
+
+Callable attributes (such as reply() functions installed by middleware) and
+lazily provided attributes are not recorded; the plugins that add them do so
+again when the event is replayed. Other values JSON can't represent are
+recorded as their repr().
+
+Events are written with the logger.Recorder plugin. To replay a journal into a
+fresh bot:
+
+    python -m abbott.journal <config dir> <journal file> [speed]
+
+where speed is a multiplier of the recorded pace (default 1), or "max" to
+send events as fast as they can be handled.
+
+The plugins are loaded from a copy of the config directory in a temporary
+directory, which is deleted afterwards, so whatever they save during the
+replay (their config files and state.sqlite3) doesn't touch the real ones.
+
+"""
+
+MAGIC = b"ABJ1"
+RECORD_HEADER = struct.Struct(">dI")
+
+class JournalError(Exception):
+    pass
+
+def _encode_default(obj):
+    return repr(obj)
+
+class JournalWriter(object):
+    """Writes events to a file object opened in binary mode. If the file is
+    empty, the journal header is written first.
+
+    """
+    def __init__(self, fileobj):
+        self._file = fileobj
+        if fileobj.tell() == 0:
+            fileobj.write(MAGIC)
+        self._encoder = json.JSONEncoder(separators=(",", ":"),
+                default=_encode_default)
+
+    def write(self, event, timestamp):
+        attrs = dict((name, value) for name, value in
+                event_attrs(event).items()
+                if not callable(value))
+        payload = self._encoder.encode(
+                {"t": event.eventtype, "a": attrs}).encode("UTF-8")
+        self._file.write(RECORD_HEADER.pack(timestamp, len(payload)))
+        self._file.write(payload)
+
+    def flush(self):
+        self._file.flush()
+
+def read_journal(fileobj):
+    """Yields (timestamp, event) tuples from a journal file opened in binary
+    mode. A truncated record at the end (such as when the bot was killed
+    mid-write) is ignored.
+
+    """
+    if fileobj.read(len(MAGIC)) != MAGIC:
+        raise JournalError("Not an event journal")
+    while True:
+        header = fileobj.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        timestamp, length = RECORD_HEADER.unpack(header)
+        payload = fileobj.read(length)
+        if len(payload) < length:
+            return
+        record = json.loads(payload.decode("UTF-8"))
+        yield timestamp, make_event(record['t'], **record['a'])
+
+def replay(records, transport, speed=1.0, match=None, clock=None):
+    """Sends the events from an iterable of (timestamp, event) tuples, such as
+    one returned by read_journal(), to the transport.
+
+    With a speed, events are sent at the pace they were recorded at,
+    multiplied by speed. If speed is None they are sent as fast as possible,
+    though the reactor still gets a chance to run between batches.
+
+    match, if given, is a list of event globs. Only matching events are sent.
+    It's usually best to only replay the events that come into the bot
+    ("irc.on_*"), since the events the bot's plugins sent in response to them
+    were recorded too and will be sent again by the plugins.
+
+    Returns a deferred that fires with the number of events sent.
+
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+
+    if match is not None:
+        patterns = _SubscriptionTrie()
+        for matchstr in match:
+            patterns.add(matchstr, True)
+        records = ((timestamp, event) for timestamp, event in records
+                if patterns.match(event.eventtype)[0])
+    records = iter(records)
+
+    sent = [0]
+    def send(event):
+        transport.send_event(event)
+        sent[0] += 1
+
+    if speed is None:
+        def send_all():
+            for _, event in records:
+                send(event)
+                yield
+        d = task.cooperate(send_all()).whenDone()
+        d.addCallback(lambda _: sent[0])
+        return d
+
+    # Schedule one event at a time, each at the recorded offset from the
+    # first one, scaled by speed
+    d = defer.Deferred()
+    start = []
+    def send_next(event=None):
+        if event is not None:
+            send(event)
+        try:
+            timestamp, next_event = next(records)
+        except StopIteration:
+            d.callback(sent[0])
+            return
+        if not start:
+            start.extend([timestamp, clock.seconds()])
+        due = start[1] + (timestamp - start[0]) / speed
+        clock.callLater(max(0, due - clock.seconds()), send_next, next_event)
+    send_next()
+    return d
+
+class _ReplayIRC(object):
+    """Provides the bot's nick during a replay. Stands in for both the plugin
+    and its client in loaded_plugins, and provides irc.getnick
+
+    """
+    plugin_name = "irc.IRCBotPlugin"
+
+    def __init__(self, nickname, transport):
+        self.client = self
+        self.nickname = nickname
+        transport.provides_request("irc.getnick", self)
+
+    def incoming_request(self, name):
+        return self.nickname
+
+def main():
+    from twisted.internet import reactor
+
+    from .pluginbase import PluginBoss
+    from .transport import Transport
+
+    if len(sys.argv) < 3:
+        print("Usage: %s <config dir> <journal file> [speed|max]" % sys.argv[0])
+        sys.exit(1)
+    configdir, journalfile = sys.argv[1:3]
+    speed = sys.argv[3] if len(sys.argv) > 3 else "1"
+    speed = None if speed == "max" else float(speed)
+
+    log.startLogging(sys.stdout)
+
+    # Plugins write to their config files and the state database as they
+    # go, so they get a scratch copy. The journal may be in the config
+    # directory too, and isn't needed in the copy.
+    scratchdir = tempfile.mkdtemp(prefix="abbott-replay-")
+    scratch_configdir = os.path.join(scratchdir, "config")
+    journal_path = os.path.abspath(journalfile)
+    shutil.copytree(configdir, scratch_configdir,
+            ignore=lambda dirname, names: [name for name in names
+                if os.path.abspath(os.path.join(dirname, name)) ==
+                    journal_path])
+    log.msg("Replaying with a copy of {0} in {1}".format(configdir,
+        scratch_configdir))
+
+    transport = Transport()
+    boss = PluginBoss(scratch_configdir, transport)
+
+    # Stand in for the IRC plugin, for the plugins that need the bot's nick
+    boss.loaded_plugins['irc.IRCBotPlugin'] = _ReplayIRC(
+            boss.get_plugin_config("irc.IRCBotPlugin").get("nick"), transport)
+    # Load the configured plugins, except the ones that would talk to the
+    # outside world or write a journal of the replay
+    for plugin_name in boss.config['core']['plugins']:
+        if plugin_name in ("irc.IRCBotPlugin", "logger.Recorder"):
+            continue
+        # One plugin failing to load shouldn't stop the replay
+        try:
+            d = boss.load_plugin(plugin_name)
+        except Exception:
+            log.err(None, "Could not load {0}".format(plugin_name))
+            continue
+        d.addErrback(log.err, "Could not load {0}".format(plugin_name))
+
+    journal = open(journalfile, "rb")
+    started = _timer()
+    def done(count):
+        elapsed = _timer() - started
+        log.msg("Replayed {0} events in {1:.2f}s".format(count, elapsed))
+        for (plugin, kind, name), histogram in sorted(
+                transport.latency_stats().items(),
+                key=lambda item: item[1].total, reverse=True)[:20]:
+            log.msg("{0} {1} {2}: {3} calls, {4:.1f}ms total, {5:.1f}ms max".format(
+                plugin, kind, name, histogram.count, histogram.total * 1000,
+                histogram.max * 1000))
+    def start():
+        d = replay(read_journal(journal), transport, speed=speed,
+                match=["irc.on_*"])
+        d.addCallback(done)
+        d.addErrback(log.err)
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(start)
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(scratchdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,201 @@
 # encoding: UTF-8
 
 
+import hashlib
+import heapq
+import itertools
 import json
 import os
 import os.path
 import sys
-from collections import defaultdict
+import threading
+import weakref
+from collections import defaultdict, OrderedDict
 try:
     from UserDict import UserDict
 except:
     # This moved in python 3
     from collections import UserDict
 from functools import wraps
+from timeit import default_timer as _timer
 
 from twisted.internet import defer
 from twisted.internet import reactor
-from twisted.python import log
+from twisted.internet import threads
+from twisted.python import failure, log
+from twisted.python.threadpool import ThreadPool
+
+from .transport import event_attrs, LatencyHistogram, _SubscriptionTrie
+from . import store
+from .timerwheel import TimerWheel
+
+# Thread pools for BotPlugin.offload(), by name. See get_thread_pool()
+_thread_pools = {}
+
+def get_thread_pool(name, size=4):
+    """Returns the named thread pool, creating and starting it if necessary.
+    size is the maximum number of threads in the pool, and only applies when it
+    is created. Pools are stopped when the reactor shuts down.
+
+    """
+    try:
+        return _thread_pools[name]
+    except KeyError:
+        pass
+    pool = _thread_pools[name] = ThreadPool(minthreads=0, maxthreads=size, name=name)
+    pool.start()
+    def stop():
+        if _thread_pools.get(name) is pool:
+            del _thread_pools[name]
+            pool.stop()
+    reactor.addSystemEventTrigger("during", "shutdown", stop)
+    return pool
+
+# The timer wheel shared by EventWatcher timeouts. See get_timer_wheel()
+_timer_wheel = None
+
+def get_timer_wheel():
+    """Returns the timer wheel that plugins share for coarse-grained timers,
+    creating it if necessary
+
+    """
+    global _timer_wheel
+    if _timer_wheel is None:
+        _timer_wheel = TimerWheel()
+    return _timer_wheel
+
+def _content_hash(contents):
+    """Returns the hash config files are compared by, of a file's contents as
+    bytes
+
+    """
+    return hashlib.sha1(contents).hexdigest()
+
+def _configured_thread_pool(config):
+    """Returns the thread pool named by the "thread_pool" key of the given
+    master config's core section
+
+    """
+    poolconfig = config['core'].get("thread_pool", {})
+    return get_thread_pool(poolconfig.get("name", "abbott"),
+            poolconfig.get("size", 4))
+
+class OffloadStats(object):
+    """Keeps track of a plugin's calls to offload()"""
+    def __init__(self, concurrency):
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        # Calls waiting for the plugin's concurrency limit
+        self.waiting = 0
+        # Calls handed to the thread pool, running or waiting for a thread
+        self.running = 0
+        # Time from the call to offload() until the function starts running
+        self.wait_times = LatencyHistogram()
+        # Time the function takes to run
+        self.run_times = LatencyHistogram()
 
 class PluginConfig(UserDict):
     """Installed in plugins as self.config. Provides a dictionary-like
     interface with a method .save() to save to persistent storage. Uses a json
     file as a backing store.
 
+    If write_behind is a number of seconds, save() doesn't write the file
+    right away. It marks the config dirty, and the file is written by flush()
+    at most that many seconds later, so a plugin that saves on every message
+    only writes once per interval. The file is written in a thread from the
+    pool thread_pool() returns. Either way, the file is replaced atomically
+    with a rename.
+
+    content_hash is the hash of the file as it was last read or written, so
+    PluginBoss can tell whether it has been changed by someone else.
+
     """
-    def __init__(self, jsonfile):
+    def __init__(self, jsonfile, write_behind=None, thread_pool=None,
+            clock=None):
         """Initialize a config from a json file."""
         self._jsonfile = jsonfile
-        with open(jsonfile, 'r') as inp:
-            self.data = json.load(inp)
+        with open(jsonfile, 'rb') as inp:
+            contents = inp.read()
+        self.data = json.loads(contents.decode("UTF-8"))
+        self.content_hash = _content_hash(contents)
+
+        self._write_behind = write_behind
+        self._thread_pool = thread_pool
+        if clock is None:
+            clock = reactor
+        self._clock = clock
+        self._flush_call = None
+        self._dirty = False
+        # Each write is numbered, so that a write that finishes in a thread
+        # after a newer one was made can be dropped instead of replacing it
+        self._sequence = 0
+        self._written = 0
+        self._file_lock = threading.Lock()
 
     def save(self):
-        with open(self._jsonfile+"~", 'w') as out:
-            json.dump(self.data, out, indent=4)
-        os.rename(self._jsonfile+"~", self._jsonfile)
+        self._dirty = True
+        if self._write_behind is None:
+            self.flush(sync=True)
+        elif self._flush_call is None:
+            self._flush_call = self._clock.callLater(self._write_behind,
+                    self.flush)
+
+    def flush(self, sync=False):
+        """Writes the config if it has unsaved changes. Returns a deferred
+        that fires when it has been written.
+
+        If sync is true, the file is written before this returns, and is
+        guaranteed not to be replaced by an older version still being written
+        in a thread.
+
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if not (self._dirty or (sync and self._written < self._sequence)):
+            return defer.succeed(None)
+
+        # Encoding has to happen here, since plugins keep changing the data
+        # in this thread
+        self._dirty = False
+        self._sequence += 1
+        contents = json.dumps(self.data, indent=4)
+        if sync or self._thread_pool is None:
+            self._write(contents, self._sequence)
+            return defer.succeed(None)
+        d = threads.deferToThreadPool(reactor, self._thread_pool(),
+                self._write, contents, self._sequence)
+        d.addErrback(log.err, "Could not write {0}".format(self._jsonfile))
+        return d
+
+    def discard(self):
+        """Drops any changes that haven't been written, including writes
+        still waiting for a thread, so they don't replace a file someone else
+        has changed. Returns whether there were any.
+
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        # Waits for a write in progress, and keeps queued ones from happening
+        with self._file_lock:
+            unsaved = self._dirty or self._written < self._sequence
+            self._dirty = False
+            self._written = self._sequence
+        return unsaved
+
+    def _write(self, contents, sequence):
+        with self._file_lock:
+            if sequence <= self._written:
+                return
+            with open(self._jsonfile+"~", 'w') as out:
+                out.write(contents)
+            # Before the rename, so the change is known to be ours by the
+            # time anything watching the file sees it
+            self.content_hash = _content_hash(contents.encode("UTF-8"))
+            os.rename(self._jsonfile+"~", self._jsonfile)
+            self._written = sequence
 
 
 class PluginBoss(object):
@@ -50,6 +213,28 @@ class PluginBoss(object):
 
         self.loaded_plugins = {}
 
+        # The PluginConfig most recently handed out for each plugin, so
+        # unsaved changes can be flushed. See get_plugin_config()
+        self._plugin_configs = {}
+        reactor.addSystemEventTrigger("before", "shutdown",
+                self.flush_plugin_configs)
+
+        # The database for plugins' stores. Opened when first needed. See
+        # get_plugin_store()
+        self._database = None
+
+        # The hash of config.json as last read or written, and the files
+        # changed since the last check. See watch_config_dir()
+        self._config_hash = None
+        self._changed_files = set()
+        self._reload_call = None
+
+        # Lazy plugins that have been activated, and so should be loaded for
+        # real, and the lists of deferreds waiting on plugins being
+        # activated. See activate_plugin()
+        self._activated = set()
+        self._activating = {}
+
         if not os.path.exists(self._configdir):
             os.mkdir(self._configdir)
         elif not os.path.isdir(self._configdir):
@@ -143,55 +328,362 @@ I'll create a new one for you now""")
                 }
         self.save()
 
+    @property
+    def configdir(self):
+        """The path of the config directory, for plugins that keep other
+        files there
+
+        """
+        return self._configdir
+
     def _load(self):
-        with open(self._filename, 'r') as file_handle:
-            self.config = json.load(file_handle)
+        with open(self._filename, 'rb') as file_handle:
+            contents = file_handle.read()
+        self.config = json.loads(contents.decode("UTF-8"))
+        self._config_hash = _content_hash(contents)
 
     def save(self):
         """Saves the master config. Use plugin.config.save() to save plugin
         configs
         
         """
+        contents = json.dumps(self.config, indent=4)
+        self._config_hash = _content_hash(contents.encode("UTF-8"))
         with open(self._filename, 'w') as output_file_handle:
-            json.dump(self.config, output_file_handle, indent=4)
+            output_file_handle.write(contents)
+
+    def reload_changed_configs(self, filenames=None):
+        """Reloads the plugins whose config files have changed since they
+        were last read or written, going by the files' contents, so saving a
+        file without changing it does nothing. If config.json has changed,
+        it's read again and every plugin is reloaded, since any of them may
+        use the master config.
+
+        filenames, if given, is a collection of the names of the files in the
+        config directory known to have changed. Others aren't checked.
+
+        Raises ValueError if config.json can't be parsed. Plugin config files
+        that can't be parsed are logged and skipped; they'll be checked again
+        next time. Returns a list of the names of the reloaded plugins.
+
+        """
+        def read_changed(filename, known_hash):
+            """Returns the file's contents if it changed, or None"""
+            try:
+                with open(os.path.join(self._configdir, filename), 'rb') as inp:
+                    contents = inp.read()
+            except IOError:
+                return None
+            if _content_hash(contents) == known_hash:
+                return None
+            return contents
+
+        master_changed = False
+        if filenames is None or "config.json" in filenames:
+            if read_changed("config.json", self._config_hash) is not None:
+                self._load()
+                master_changed = True
+
+        names = []
+        for plugin_name, config in list(self._plugin_configs.items()):
+            filename = plugin_name + ".json"
+            if filenames is not None and filename not in filenames:
+                continue
+            if plugin_name not in self.loaded_plugins:
+                continue
+            contents = read_changed(filename, config.content_hash)
+            if contents is None:
+                continue
+            try:
+                json.loads(contents.decode("UTF-8"))
+            except ValueError:
+                log.msg("Not reloading {0}: {1} is not valid JSON".format(
+                    plugin_name, filename))
+                continue
+            # The edited file wins over changes the plugin hasn't written
+            # yet. Otherwise reloading would write them over the edit first.
+            if config.discard():
+                log.msg("{0} was changed while {1} had unsaved changes. "
+                        "Discarding them".format(filename, plugin_name))
+            names.append(plugin_name)
+
+        if master_changed:
+            log.msg("config.json changed. Reloading all plugins")
+            names = list(self.loaded_plugins)
+        self._reload_plugins(names)
+        return names
+
+    def _reload_plugins(self, plugin_names):
+        for plugin_name in plugin_names:
+            log.msg("Reloading {0}".format(plugin_name))
+            try:
+                self.loaded_plugins[plugin_name].reload()
+            except Exception:
+                log.err(None, "Error reloading {0}".format(plugin_name))
+
+    def watch_config_dir(self, poll_interval=2):
+        """Calls reload_changed_configs() when files in the config directory
+        change. Uses inotify where the platform supports it, and otherwise
+        checks the files' modification times every poll_interval seconds.
+
+        """
+        try:
+            from twisted.internet import inotify
+            from twisted.python.filepath import FilePath
+            notifier = inotify.INotify()
+            notifier.startReading()
+            notifier.watch(FilePath(self._configdir),
+                    mask=inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO,
+                    callbacks=[lambda _, path, mask:
+                        self._config_file_changed(
+                            path.asTextMode().basename())])
+            log.msg("Watching {0} with inotify".format(self._configdir))
+            return notifier
+        except Exception:
+            log.msg("inotify is unavailable. Polling {0} every {1} seconds"
+                    .format(self._configdir, poll_interval))
+
+        from twisted.internet import task
+        mtimes = {}
+        def poll():
+            for filename in os.listdir(self._configdir):
+                try:
+                    mtime = os.stat(os.path.join(self._configdir,
+                        filename)).st_mtime
+                except OSError:
+                    continue
+                if filename in mtimes and mtimes[filename] != mtime:
+                    self._config_file_changed(filename)
+                mtimes[filename] = mtime
+        poller = task.LoopingCall(poll)
+        poller.start(poll_interval)
+        return poller
+
+    def _config_file_changed(self, filename):
+        """Notes a changed file in the config directory. The changed files
+        are checked together shortly after, since editors tend to write a
+        file in several steps.
+
+        """
+        if not filename.endswith(".json"):
+            return
+        self._changed_files.add(filename)
+        if self._reload_call is None:
+            self._reload_call = reactor.callLater(0.5,
+                    self._reload_changed_files)
+
+    def _reload_changed_files(self):
+        self._reload_call = None
+        filenames, self._changed_files = self._changed_files, set()
+        try:
+            self.reload_changed_configs(filenames)
+        except ValueError:
+            log.msg("Not reloading: config.json is not valid JSON")
 
     def load_all_plugins(self):
-        """Called by the main method at startup time to load all configured plugins"""
-        for plugin_name in self.config['core']['plugins']:
-            self.load_plugin(plugin_name)
+        """Called by the main method at startup time to load all configured
+        plugins.
+
+        Plugins are started in tiers according to their REQUIRES: a plugin
+        isn't started until everything it requires has finished starting.
+        The plugins within a tier are started together, so those whose start()
+        returns a deferred run concurrently. A plugin that fails to load is
+        logged, and the plugins that require it aren't loaded.
 
-    def load_plugin(self, plugin_name):
+        Returns a deferred that fires when every plugin has been started (or
+        has failed to).
+
+        """
+        tiers = self._startup_tiers(self.config['core']['plugins'])
+        failed = set()
+
+        @defer.inlineCallbacks
+        def load(plugin_name):
+            try:
+                yield self.load_plugin(plugin_name)
+            except Exception:
+                failed.add(plugin_name)
+                log.err(None, "Could not load {0}".format(plugin_name))
+
+        @defer.inlineCallbacks
+        def load_tiers():
+            for tier in tiers:
+                loading = []
+                for plugin_name, requires in tier:
+                    missing = failed.intersection(requires)
+                    if missing:
+                        failed.add(plugin_name)
+                        log.msg("Not loading {0}, since it requires {1}, which "
+                                "failed to load".format(plugin_name,
+                                    ", ".join(sorted(missing))))
+                        continue
+                    loading.append(load(plugin_name))
+                yield defer.DeferredList(loading)
+        return load_tiers()
+
+    def _startup_tiers(self, plugin_names):
+        """Sorts the given plugins topologically by their REQUIRES. Returns a
+        list of tiers, each a list of (plugin name, requires) tuples in the
+        order the plugins were listed. Each plugin comes after everything it
+        requires. Requirements that aren't in plugin_names are ignored.
+
+        """
+        requires = {}
+        for plugin_name in plugin_names:
+            try:
+                pluginclass = self._get_plugin_class(plugin_name)
+            except Exception:
+                # load_plugin() will fail too, and report it
+                pluginclass = None
+            requires[plugin_name] = [dep for dep in
+                    getattr(pluginclass, "REQUIRES", [])
+                    if dep in plugin_names and dep != plugin_name]
+            for dep in getattr(pluginclass, "REQUIRES", []):
+                if dep not in plugin_names:
+                    log.msg("WARNING: {0} requires {1}, but {1} is not in the "
+                            "list of plugins to load".format(plugin_name, dep))
+
+        tiers = []
+        placed = set()
+        remaining = list(plugin_names)
+        while remaining:
+            tier = [plugin_name for plugin_name in remaining
+                    if placed.issuperset(requires[plugin_name])]
+            if not tier:
+                log.msg("WARNING: these plugins have circular requirements, "
+                        "and will be loaded in the listed order: {0}".format(
+                            ", ".join(remaining)))
+                tiers.extend([(plugin_name, [])] for plugin_name in remaining)
+                break
+            tiers.append([(plugin_name, requires[plugin_name])
+                for plugin_name in tier])
+            placed.update(tier)
+            remaining = [plugin_name for plugin_name in remaining
+                    if plugin_name not in placed]
+        return tiers
+
+    def load_plugin(self, plugin_name, state=None):
         """Loads the named plugin.
         
         plugin_name is expected to be in the form A.B where A is the module and
         B is the class. This module is expected to live in the plugins package.
+
+        If the plugin is listed in the core config's "out_of_process" list, it
+        is started in a child process instead. See the remote module.
+
+        A plugin's start() may return a deferred if it has initialization to
+        finish asynchronously. This returns a deferred that fires when start()
+        has finished. If start() raises an exception, so does this; if its
+        deferred fails, the plugin is unloaded and the deferred returned here
+        fails too.
+
+        state, if not None, is passed to the plugin's import_state() after
+        start(). See export_state().
         
         """
-        modulename, classname = plugin_name.split(".")
-        module = __import__("abbott.plugins."+modulename, fromlist=[classname])
-        
-        pluginclass = getattr(module, classname)
+        pluginclass = self._get_plugin_class(plugin_name)
         
         plugin = pluginclass(plugin_name, self._transport, self)
         try:
-            plugin.start()
+            started = plugin.start()
         except Exception:
             self._transport.unhook_plugin(plugin)
             raise
 
+        if state is not None:
+            # The plugin works without the state, it just has to fetch things
+            # again
+            try:
+                plugin.import_state(state)
+            except Exception:
+                log.err(None, "Could not import the state of {0}".format(
+                    plugin_name))
+
         self.loaded_plugins[plugin_name] = plugin
 
+        def start_failed(f):
+            if self.loaded_plugins.get(plugin_name) is plugin:
+                self.unload_plugin(plugin_name)
+            return f
+        return defer.maybeDeferred(lambda: started).addErrback(start_failed)
+
+    def _get_plugin_class(self, plugin_name):
+        """Returns the class to instantiate for the named plugin"""
+        if plugin_name in self.config['core'].get('lazy_plugins', {}) and \
+                plugin_name not in self._activated:
+            return LazyPlugin
+        if plugin_name in self.config['core'].get('out_of_process', []):
+            from .remote import RemotePlugin
+            return RemotePlugin
+        return self._import_plugin_class(plugin_name)
+
+    def _import_plugin_class(self, plugin_name):
+        modulename, classname = plugin_name.split(".")
+        module = __import__("abbott.plugins."+modulename, fromlist=[classname])
+        return getattr(module, classname)
+
     def unload_plugin(self, plugin_name):
         plugin = self.loaded_plugins.pop(plugin_name)
         self._transport.unhook_plugin(plugin)
         plugin.stop()
+        self._activated.discard(plugin_name)
+        config = self._plugin_configs.get(plugin_name)
+        if config is not None:
+            config.flush()
+
+    def activate_plugin(self, plugin_name):
+        """Replaces the LazyPlugin standing in for the named plugin with the
+        real plugin. Returns a deferred that fires with the plugin once it
+        has started.
+
+        """
+        d = defer.Deferred()
+        waiters = self._activating.get(plugin_name)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        plugin = self.loaded_plugins.get(plugin_name)
+        if plugin is None:
+            return defer.fail(KeyError("{0} is not loaded".format(plugin_name)))
+        if not isinstance(plugin, LazyPlugin):
+            return defer.succeed(plugin)
+
+        log.msg("Activating {0}".format(plugin_name))
+        waiters = self._activating[plugin_name] = [d]
+        self.unload_plugin(plugin_name)
+        self._activated.add(plugin_name)
+        def done(result):
+            del self._activating[plugin_name]
+            if isinstance(result, failure.Failure):
+                log.err(result, "Could not activate {0}".format(plugin_name))
+                for waiter in waiters:
+                    waiter.errback(result)
+            else:
+                for waiter in waiters:
+                    waiter.callback(self.loaded_plugins[plugin_name])
+        defer.maybeDeferred(self.load_plugin, plugin_name).addBoth(done)
+        return d
+
+    def flush_plugin_configs(self):
+        """Writes any unsaved plugin config changes to disk right away"""
+        for config in self._plugin_configs.values():
+            config.flush(sync=True)
 
     def get_plugin_config(self, plugin_name):
         """Returns a config dictionary for the named plugin. This dict has an
         additional method: .save(), to save any changes back to persistant
         store
 
+        If the core config has a "config_write_behind" number of seconds,
+        saves are written at most that often. See PluginConfig. Any unsaved
+        changes to the plugin's previous config object are written before
+        the file is read again.
+
         """
+        previous = self._plugin_configs.pop(plugin_name, None)
+        if previous is not None:
+            previous.flush(sync=True)
+
         try:
             old_config = self.config['plugin_config'][plugin_name]
         except KeyError:
@@ -211,7 +703,24 @@ I'll create a new one for you now""")
             self.save()
 
 
-        return PluginConfig(plugin_config_path)
+        config = self._plugin_configs[plugin_name] = PluginConfig(
+                plugin_config_path,
+                write_behind=self.config['core'].get("config_write_behind"),
+                thread_pool=lambda: _configured_thread_pool(self.config),
+                )
+        return config
+
+    def get_plugin_store(self, plugin_name):
+        """Returns the store.PluginStore for the named plugin. All plugins'
+        stores are kept in the state.sqlite3 database in the config directory.
+
+        """
+        if self._database is None:
+            self._database = store.Database(
+                    os.path.join(self._configdir, "state.sqlite3"))
+            reactor.addSystemEventTrigger("after", "shutdown",
+                    self._database.close)
+        return store.PluginStore(self._database, plugin_name)
 
 
 class BotPlugin(object):
@@ -226,9 +735,13 @@ class BotPlugin(object):
     The REQUIRES class variable should be set to a list of plugins that this
     one depends on.
 
+    OFFLOAD_CONCURRENCY is the number of offload() calls the plugin may have
+    running at once. Further calls wait their turn.
+
     """
     REQUIRES = []
     DEFAULT_CONFIG = {}
+    OFFLOAD_CONCURRENCY = 2
     def __init__(self, plugin_name, transport, pluginboss):
         self.plugin_name = plugin_name
         self.transport = transport
@@ -261,6 +774,10 @@ class BotPlugin(object):
 
         This should do any sort of interaction with the twisted reactor such as connecting
 
+        It may return a deferred if some of the initialization finishes later.
+        At startup, plugins that require this one aren't started until it
+        fires. See PluginBoss.load_all_plugins()
+
         """
         pass
 
@@ -271,6 +788,27 @@ class BotPlugin(object):
         """
         pass
 
+    def export_state(self):
+        """Called on the old instance, before it's stopped, when the plugin's
+        module is reloaded. Override this to return the in-memory state worth
+        handing over to the new instance, such as caches that would otherwise
+        have to be fetched from the server again. The default None hands over
+        nothing.
+
+        The state isn't serialized, but it shouldn't hold instances of classes
+        from the plugin's module, since those are replaced by the reload.
+
+        """
+        return None
+
+    def import_state(self, state):
+        """Called on the new instance after start() when the plugin's module
+        is reloaded, with what export_state() returned on the old one, if it
+        returned anything.
+
+        """
+        pass
+
     ### Convenience dispatcher methods, but feel free to override them if you
     ### want!
 
@@ -303,14 +841,180 @@ class BotPlugin(object):
         return toret
 
     ### Convenience methods for use by the plugin to install event listeners
-    def install_middleware(self, matchstr):
-        self.transport.install_middleware(matchstr, self)
+    def install_middleware(self, matchstr, priority=0):
+        self.transport.install_middleware(matchstr, self, priority)
+
+    def provide_event_attribute(self, matchstr, name, func):
+        self.transport.provide_event_attribute(matchstr, name, self, func)
+
+    def listen_for_event(self, matchstr, **filters):
+        self.transport.listen_for_event(matchstr, self, **filters)
+
+    def unlisten_for_event(self, matchstr, **filters):
+        self.transport.unlisten_for_event(matchstr, self, **filters)
+
+    def provides_request(self, name, **kwargs):
+        self.transport.provides_request(name, self, **kwargs)
+
+    ### Running things off of the reactor thread
+
+    def offload(self, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) in a thread, and returns a deferred that
+        fires with its return value (or errbacks with its exception).
+
+        Use this for blocking or CPU-heavy work that would otherwise hold up
+        the reactor, and with it the whole bot. func runs in another thread, so
+        it mustn't touch the transport, the reactor, or state the plugin
+        changes elsewhere; do those things with its result instead.
+
+        Calls run in the thread pool named by the core config's
+        "thread_pool" key (a dict with "name" and "size"), and at most
+        OFFLOAD_CONCURRENCY of this plugin's calls run at a time. See
+        offload_stats.
 
-    def listen_for_event(self, matchstr):
-        self.transport.listen_for_event(matchstr, self)
+        """
+        stats = self.offload_stats
+        if stats is None:
+            stats = self._offload_stats = OffloadStats(self.OFFLOAD_CONCURRENCY)
+        pool = _configured_thread_pool(self.pluginboss.config)
+
+        queued = _timer()
+        started = []
+        def run():
+            started.append(_timer())
+            return func(*args, **kwargs)
+        def call():
+            stats.waiting -= 1
+            stats.running += 1
+            return threads.deferToThreadPool(reactor, pool, run)
+        def finished(result):
+            stats.running -= 1
+            if started:
+                stats.wait_times.record(started[0] - queued)
+                stats.run_times.record(_timer() - started[0])
+            return result
+
+        stats.waiting += 1
+        d = stats.semaphore.run(call)
+        d.addBoth(finished)
+        return d
+
+    ### Persistent state
+
+    @property
+    def store(self):
+        """The plugin's store.PluginStore, for state that changes too often
+        or is too big to keep in self.config. See the store module.
+
+        """
+        try:
+            return self._store
+        except AttributeError:
+            self._store = self.pluginboss.get_plugin_store(self.plugin_name)
+            return self._store
+
+    @property
+    def offload_stats(self):
+        """The OffloadStats for this plugin's calls to offload(), or None if
+        it has never called it
+
+        """
+        return getattr(self, "_offload_stats", None)
+
+class LazyPlugin(BotPlugin):
+    """Stands in for a plugin listed in the core config's "lazy_plugins"
+    dict, so the plugin's module isn't imported until it's needed. The dict
+    maps plugin names to a declaration of what the plugin handles::
+
+        "lazy_plugins": {
+            "pyexec.PyExec": {"commands": ["pyexec"]},
+            "admin.IRCAdmin": {
+                "commands": ["kick", "op", "quiet", "help"],
+                "prefixes": ["."],
+                "events": ["irc.on_mode_changed"],
+                "requests": ["ircadmin.timedquiet"]
+            }
+        }
+
+    The first time an event matching one of the "events" globs arrives, a
+    command starting with one of the "commands" words or "help <word>" is
+    said, a message starts with one of the "prefixes", or one of the
+    "requests" is issued, the plugin is activated: this is unloaded and the
+    real plugin is loaded in its place. The event or request that activated
+    it is then handed to the real plugin.
+
+    The declaration must cover everything the plugin does that should
+    activate it. Until it's activated, other plugins requiring it will find
+    it's not really there.
+
+    """
+    def reload(self):
+        # We don't have a config of our own; the real plugin will
+        declaration = self.pluginboss.config['core']['lazy_plugins'][
+                self.plugin_name]
+        self.events = _SubscriptionTrie()
+        for matchstr in declaration.get("events", []):
+            self.events.add(matchstr, True)
+        self.event_globs = declaration.get("events", [])
+        self.commands = set(declaration.get("commands", []))
+        self.prefixes = tuple(declaration.get("prefixes", []))
+        self.requests = declaration.get("requests", [])
+
+    def start(self):
+        for matchstr in self.event_globs:
+            self.listen_for_event(matchstr)
+        if self.commands or self.prefixes:
+            self.listen_for_event("irc.on_privmsg")
+        for name in self.requests:
+            self.provides_request(name)
+
+    def received_event(self, event):
+        if not (self.events.match(event.eventtype)[0] or
+                (event.eventtype == "irc.on_privmsg" and
+                    self._is_command(event))):
+            return
+        d = self.pluginboss.activate_plugin(self.plugin_name)
+        d.addCallback(lambda plugin: plugin.received_event(event))
+        # Activation errors are logged by activate_plugin()
+        d.addErrback(lambda _: None)
+
+    def _is_command(self, event):
+        """Does the same prefix matching as CommandPluginSuperclass, to see
+        if the message is one of our commands
+
+        """
+        message = event.message.strip()
+        if self.prefixes and message.startswith(self.prefixes):
+            return True
+
+        try:
+            nick = self.pluginboss.loaded_plugins['irc.IRCBotPlugin'
+                    ].client.nickname
+        except (KeyError, AttributeError):
+            # The IRC plugin isn't loaded in this process (or not for real
+            # yet), or isn't connected. Only the prefixes can be matched.
+            nick = None
+        globalprefix = self.pluginboss.config.get("command", {}).get("prefix")
+        globalprefix = globalprefix.strip() if globalprefix else None
+        if nick and message.startswith(nick + ":"):
+            message = message[len(nick)+1:]
+        elif globalprefix and message.startswith(globalprefix):
+            message = message[len(globalprefix):]
+        elif not getattr(event, "direct", False):
+            return False
+        words = message.split()
+        if words[:1] == ["help"]:
+            words = words[1:]
+        return bool(words) and words[0] in self.commands
+
+    def incoming_request(self, name, *args, **kwargs):
+        d = self.pluginboss.activate_plugin(self.plugin_name)
+        d.addCallback(lambda plugin: plugin.incoming_request(name, *args,
+            **kwargs))
+        return d
 
-    def provides_request(self, name):
-        self.transport.provides_request(name, self)
+# Sentinel for attributes an event doesn't have
+_no_attr = object()
 
 class EventWatcher(object):
     """This is a mixin for plugins that adds event watching features, which
@@ -365,8 +1069,13 @@ class EventWatcher(object):
         # Holds all timers so that we can cancel them on stop
         self.__timers = set()
 
-        # Maps event names to sets of (event_match object, deferred object, timer object)
-        self.__watchers = defaultdict(set)
+        # Maps event names to dicts indexing the pending watchers by the
+        # attributes their event_match templates fix. Each maps a tuple of
+        # attribute names to a dict mapping a tuple of those attributes'
+        # values to a list of (deferred object, timer object) pairs. So an
+        # incoming event is only compared against each distinct set of
+        # attribute names, however many watchers are waiting.
+        self.__watchers = defaultdict(dict)
 
     def stop(self):
         for s in self.__timers:
@@ -374,31 +1083,53 @@ class EventWatcher(object):
         super(EventWatcher, self).stop()
 
     def received_event(self, event):
-        toremove = []
-        try:
-            for event_match, d, timer in list(self.__watchers[event.eventtype]):
-                # Every attribute specified in the event_match template object must
-                # be equal to the corresponding attribute in the received event
-                for attr in dir(event_match):
-                    if attr.startswith("_"): continue
-                    if not hasattr(event, attr) or getattr(event_match, attr) != getattr(event, attr):
-                        break
-                else:
-                    # we have a match
-                    toremove.append((event_match, d, timer))
-                    if timer:
-                        timer.cancel()
-                        self.__timers.remove(timer)
-                    d.callback(event)
-        finally:
-            # In a finally block in case the callback raises an error of some
-            # sort. Actually, I don't think callbacks raise errors to the
-            # caller (the error goes to the next errback handler) Anyways
-            # putting this in a finally block can't hurt
-            for item in toremove:
-                self.__watchers[event.eventtype].remove(item)
+        matched = []
+        index = self.__watchers.get(event.eventtype)
+        if index:
+            for attrs, by_values in list(index.items()):
+                values = tuple(getattr(event, attr, _no_attr) for attr in attrs)
+                try:
+                    watchers = by_values.pop(values, None)
+                except TypeError:
+                    # An unhashable value can't equal any template's
+                    continue
+                if watchers is None:
+                    continue
+                if not by_values:
+                    del index[attrs]
+                matched.extend(watchers)
+            if not index:
+                del self.__watchers[event.eventtype]
+
+        # The watchers are all removed before any callbacks run, in case a
+        # callback raises an error or waits for another event
+        for d, timer in matched:
+            if timer:
+                timer.cancel()
+                self.__timers.remove(timer)
+            d.callback(event)
         super(EventWatcher, self).received_event(event)
 
+    def __remove_watcher(self, eventtype, attrs, values, watcher):
+        index = self.__watchers[eventtype]
+        watchers = index[attrs][values]
+        watchers.remove(watcher)
+        if not watchers:
+            del index[attrs][values]
+            if not index[attrs]:
+                del index[attrs]
+                if not index:
+                    del self.__watchers[eventtype]
+
+    def __call_later(self, timeout, func):
+        """Timeouts of a second or more go on the shared timer wheel, so the
+        reactor doesn't need a delayed call for each one. Shorter ones need
+        the reactor's precision.
+
+        """
+        if timeout >= 1:
+            return get_timer_wheel().call_later(timeout, func)
+        return reactor.callLater(timeout, func)
 
     def wait_for(self, event_match=None, timeout=None):
         """This method returns a twisted deferred that fires when an event is
@@ -418,6 +1149,12 @@ class EventWatcher(object):
         timeout of 0 will always pass through and never return an event.
         Exception: if both are None then success is returned.
 
+        The values of event_match's parameters must be hashable, since pending
+        watchers are indexed by them.
+
+        Timeouts of a second or more are rounded up to the shared timer
+        wheel's resolution, a quarter of a second.
+
         """
         if timeout == 0:
             return defer.succeed(None)
@@ -429,27 +1166,243 @@ class EventWatcher(object):
             def timer_timesup():
                 self.__timers.remove(timer)
                 d.callback(None)
-            timer = reactor.callLater(timeout, timer_timesup)
+            timer = self.__call_later(timeout, timer_timesup)
             self.__timers.add(timer)
             return d
 
         else:
 
             # An event watcher and possibly a timer
+            eventtype = event_match.eventtype
+            template = sorted((attr, value) for attr, value in
+                    event_attrs(event_match).items()
+                    if not attr.startswith("_"))
+            attrs = tuple(attr for attr, _ in template)
+            values = tuple(value for _, value in template)
+            hash(values)
+
             d = defer.Deferred()
             if timeout:
                 # both an event watcher and a timer
                 def timer_and_event_timesup():
                     self.__timers.remove(timer)
-                    self.__watchers[event_match.eventtype].remove((event_match, d, timer))
+                    self.__remove_watcher(eventtype, attrs, values, watcher)
                     d.callback(None)
-                timer = reactor.callLater(timeout, timer_and_event_timesup)
+                timer = self.__call_later(timeout, timer_and_event_timesup)
                 self.__timers.add(timer)
             else:
                 timer = None
-            self.__watchers[event_match.eventtype].add((event_match, d, timer))
+            watcher = (d, timer)
+            self.__watchers[eventtype].setdefault(attrs, {}).setdefault(
+                    values, []).append(watcher)
             return d
 
+class Scheduler(object):
+    """This is a mixin for plugins that need to do something at a later time,
+    even if the bot is restarted in the meantime::
+
+        class MyPlugin(Scheduler, BotPlugin):
+            def start(self):
+                super(MyPlugin, self).start()
+                ...
+                self.call_later(3600, "remind", "#channel", "Time's up!")
+
+            def on_later_remind(self, channel, message):
+                self.transport.send_event(Event("irc.do_msg",
+                    user=channel, message=message))
+
+    A later is a callback name and its arguments. When it's due, the
+    plugin's on_later_<name> method is called with the arguments. Since laters
+    are saved in the plugin's store (see BotPlugin.store) the arguments must
+    be representable in JSON, and tuples are passed back as lists after a
+    restart. Changes are saved in batches, LATER_SAVE_DELAY seconds after the
+    first unsaved change, and on shutdown.
+
+    There may only be one pending later with a given name and arguments.
+    Scheduling it again moves it to the new time, and cancel_later() cancels
+    it.
+
+    Laters that came due while the bot was down are run when the plugin
+    starts, or LATER_STARTUP_DELAY seconds after it starts, for plugins that
+    need to wait for the bot to connect.
+
+    The pending laters are kept in a heap, with one reactor timer per plugin
+    for the earliest of them, so scheduling and cancelling take logarithmic
+    time no matter how many are pending.
+
+    Make sure to call super() for __init__(), start() and stop() if you
+    override those methods!
+
+    """
+    LATER_STARTUP_DELAY = 0
+    LATER_SAVE_DELAY = 1
+
+    def __init__(self, plugin_name, transport, pluginboss):
+        # The clock used for timers and times. Tests may replace it.
+        self.scheduler_clock = reactor
+
+        # Heap of [time, sequence number, key, name, args] lists. Cancelled
+        # entries stay in the heap with their key set to None until they
+        # come to the top, or until they make up most of the heap.
+        self.__heap = []
+        self.__cancelled = 0
+        self.__sequence = itertools.count()
+        # Maps the keys of pending laters (the JSON of the name and args) to
+        # their heap entries
+        self.__laters = {}
+        # The timer for the entry at the top of the heap, and its time
+        self.__timer = None
+        self.__timer_at = None
+        # Laters aren't run before this time. See LATER_STARTUP_DELAY.
+        self.__hold_until = 0
+
+        # Maps keys to the [time, name, args] values to save to the store, or
+        # to None to delete them from it
+        self.__unsaved = {}
+        self.__save_timer = None
+        self.__shutdown_trigger = None
+
+        super(Scheduler, self).__init__(plugin_name, transport, pluginboss)
+
+    def start(self):
+        super(Scheduler, self).start()
+        for key, (when, name, args) in self.store.table("laters").items():
+            # Skip any changed since they were saved
+            if key not in self.__unsaved:
+                self.__push(key, when, name, args)
+        self.__hold_until = self.scheduler_clock.seconds() + \
+                self.LATER_STARTUP_DELAY
+        self.__shutdown_trigger = reactor.addSystemEventTrigger("before",
+                "shutdown", self.save_laters)
+        self.__reset_timer()
+
+    def stop(self):
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+        if self.__shutdown_trigger:
+            reactor.removeSystemEventTrigger(self.__shutdown_trigger)
+            self.__shutdown_trigger = None
+        self.save_laters()
+        super(Scheduler, self).stop()
+
+    def call_later(self, delay, name, *args):
+        """Calls self.on_later_<name>(*args) in delay seconds"""
+        self.call_at(self.scheduler_clock.seconds() + delay, name, *args)
+
+    def call_at(self, when, name, *args):
+        """Calls self.on_later_<name>(*args) at the given time, in seconds
+        since the epoch
+
+        """
+        if not hasattr(self, "on_later_" + name):
+            raise ValueError("{0} has no on_later_{1} method".format(
+                self.plugin_name, name))
+        key = json.dumps([name] + list(args))
+        self.__remove(key)
+        self.__push(key, when, name, args)
+        self.__save(key, [when, name, list(args)])
+        self.__reset_timer()
+
+    def cancel_later(self, name, *args):
+        """Cancels the pending later with the given name and arguments.
+        Returns whether there was one.
+
+        """
+        key = json.dumps([name] + list(args))
+        if not self.__remove(key):
+            return False
+        self.__save(key, None)
+        self.__reset_timer()
+        return True
+
+    def pending_laters(self):
+        """Returns a list of (time, name, args) tuples for the pending laters,
+        in the order they're due
+
+        """
+        return [(entry[0], entry[3], entry[4])
+                for entry in sorted(self.__laters.values())]
+
+    def save_laters(self):
+        """Saves unsaved changes to the pending laters right away"""
+        if self.__save_timer:
+            if self.__save_timer.active():
+                self.__save_timer.cancel()
+            self.__save_timer = None
+        if not self.__unsaved:
+            return
+        unsaved, self.__unsaved = self.__unsaved, {}
+        table = self.store.table("laters")
+        with table.transaction():
+            for key, value in unsaved.items():
+                if value is not None:
+                    table[key] = value
+                elif key in table:
+                    del table[key]
+
+    def __push(self, key, when, name, args):
+        entry = [when, next(self.__sequence), key, name, tuple(args)]
+        self.__laters[key] = entry
+        heapq.heappush(self.__heap, entry)
+
+    def __remove(self, key):
+        entry = self.__laters.pop(key, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self.__cancelled += 1
+        if self.__cancelled > len(self.__heap) // 2:
+            self.__heap = [entry for entry in self.__heap
+                    if entry[2] is not None]
+            heapq.heapify(self.__heap)
+            self.__cancelled = 0
+        return True
+
+    def __save(self, key, value):
+        self.__unsaved[key] = value
+        if not self.__save_timer:
+            self.__save_timer = self.scheduler_clock.callLater(
+                    self.LATER_SAVE_DELAY, self.save_laters)
+
+    def __reset_timer(self):
+        """Sets the timer for the earliest pending later"""
+        heap = self.__heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self.__cancelled -= 1
+        at = max(heap[0][0], self.__hold_until) if heap else None
+        if at == self.__timer_at:
+            return
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+        self.__timer_at = at
+        if at is not None:
+            self.__timer = self.scheduler_clock.callLater(
+                    max(0, at - self.scheduler_clock.seconds()), self.__run_due)
+
+    def __run_due(self):
+        self.__timer = self.__timer_at = None
+        now = self.scheduler_clock.seconds()
+        due = []
+        heap = self.__heap
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if entry[2] is None:
+                self.__cancelled -= 1
+                continue
+            del self.__laters[entry[2]]
+            self.__save(entry[2], None)
+            due.append(entry)
+        # Laters scheduled by these callbacks run no earlier than the next
+        # timer
+        for _, _, _, name, args in due:
+            d = defer.maybeDeferred(getattr(self, "on_later_" + name), *args)
+            d.addErrback(log.err, "Error in {0} later {1}".format(
+                self.plugin_name, name))
+        self.__reset_timer()
+
 def non_reentrant(**keyargs_def):
     """This is a handy function decorator that will pass through the first call
     to the function, but prevent a second call to the function with the same
@@ -496,54 +1449,134 @@ def non_reentrant(**keyargs_def):
     the original invocation, since the function isn't called more than once at
     a time.
 
-    Also note that it is unnecessary to include the `self` parameter of methods
-    only because in this framework there is only ever one instance of each
-    plugin object. If you are using this decorator in other situations, you
-    need to declare self=0. The reason is since the entrants are stored in a
-    closure of the decorator function, it is stored per-class, not
-    per-instance.
+    This is memoized() without caching results; see memoized() for how the
+    `self` argument is handled.
+
+    """
+    return memoized(ttl=0, **keyargs_def)
+
+def memoized(ttl=None, maxsize=None, **keyargs_def):
+    """Like non_reentrant(), this returns a decorator for functions that
+    return a deferred, where keyargs_def declares the arguments that make up
+    the key, and concurrent calls with the same key share one invocation.
+    Additionally, a successful result is kept and returned to later calls
+    with the same key for ttl seconds (forever if ttl is None, not at all if
+    it's 0). Failures are not kept.
+
+    At most maxsize results are kept, if given; the least recently used one
+    is dropped to make room for another.
+
+    If the key includes self (self=0), each instance gets its own results,
+    held with a weak reference to the instance, so they're gone with the
+    plugin instance when it's reloaded. Otherwise the results are shared by
+    all callers.
+
+    The decorated function gets two attributes. forget(*args, **kwargs) drops
+    the kept result for the key those arguments would be called with, for
+    when the caller knows it's out of date. stats() returns a dict of
+    counters: "hits" for calls answered with a kept result or by joining a
+    call in progress, "misses" for calls that invoked the function, and
+    "inflight" for the number of invocations in progress::
+
+        @memoized(ttl=300, maxsize=256, self=0, url=1)
+        def _fetch_title(self, url):
+            ...
+
+    Don't keep results that may go stale in ways that matter without the
+    caller noticing. Whois replies, for example, belong to whoever holds a
+    nick, and that can change at any moment.
 
     """
+    per_instance = "self" in keyargs_def
+    keyargs_def = dict(keyargs_def)
+    self_index = keyargs_def.pop("self", None)
+
     def decorator(func):
+        # Maps instances (or None) to a pair of dicts. The first maps key
+        # tuples to (expiry time, result), least recently used first. The
+        # second maps key tuples to lists of deferreds waiting for an
+        # invocation in progress.
+        if per_instance:
+            caches = weakref.WeakKeyDictionary()
+        else:
+            caches = {}
+        counters = {"hits": 0, "misses": 0, "inflight": 0}
 
-        # This maps a tuple of key arguments to a list of deferred objects
-        entrants = defaultdict(list)
+        def find(args, kwargs):
+            """Returns the cache pair and key for a call, or (None, None) if
+            not all the key arguments were given
 
-        @wraps(func)
-        def new_func(*args, **kwargs):
-            # determine what our key argument tuple is.
+            """
             key_arguments = []
-            # note that this stores key arguments in the order returned from
-            # this dictionary, which depends the order being consistent.
-            # Dictionary order is guaranteed not to change as long as it
-            # doesn't mutate, so this is okay.
             for kwarg, posarg in keyargs_def.items():
                 if posarg is not None and len(args) > posarg:
                     key_arguments.append(args[posarg])
                 elif kwarg in kwargs:
                     key_arguments.append(kwargs[kwarg])
                 else:
-                    # This argument was not given. We cannot do anything this
-                    # call
-                    return func(*args, **kwargs)
+                    return None, None
+            if per_instance:
+                if self_index is not None and len(args) > self_index:
+                    instance = args[self_index]
+                elif "self" in kwargs:
+                    instance = kwargs["self"]
+                else:
+                    return None, None
+            else:
+                instance = None
+            try:
+                cache = caches[instance]
+            except KeyError:
+                cache = caches[instance] = (OrderedDict(), {})
+            return cache, tuple(key_arguments)
 
-            key_arguments = tuple(key_arguments)
+        @wraps(func)
+        def new_func(*args, **kwargs):
+            cache, key = find(args, kwargs)
+            if cache is None:
+                # The key arguments weren't all given. We cannot do anything
+                # this call
+                return func(*args, **kwargs)
+            results, entrants = cache
+
+            if key in results:
+                expires, result = results[key]
+                if expires is None or expires > _timer():
+                    results[key] = results.pop(key)
+                    counters['hits'] += 1
+                    return defer.succeed(result)
+                del results[key]
 
-            # Now that we have a key by which to track invocations, check our
-            # entrants dict
             d = defer.Deferred()
-            entrants[key_arguments].append(d)
-
-            if len(entrants[key_arguments]) == 1:
-                # No existing calls to this function (because we were the
-                # first), call it and set a handler for its completion
-                real_d = func(*args, **kwargs)
-                def done(param):
-                    for other_d in entrants.pop(key_arguments):
-                        other_d.callback(param)
-                real_d.addBoth(done)
+            if key in entrants:
+                counters['hits'] += 1
+                entrants[key].append(d)
+                return d
+
+            # We're the first. Call the function and set a handler for its
+            # completion
+            counters['misses'] += 1
+            counters['inflight'] += 1
+            entrants[key] = [d]
+            def done(param):
+                counters['inflight'] -= 1
+                if ttl != 0 and not isinstance(param, failure.Failure):
+                    results[key] = (
+                            None if ttl is None else _timer() + ttl,
+                            param)
+                    if maxsize is not None and len(results) > maxsize:
+                        results.popitem(last=False)
+                for other_d in entrants.pop(key):
+                    other_d.callback(param)
+            defer.maybeDeferred(func, *args, **kwargs).addBoth(done)
             return d
 
+        def forget(*args, **kwargs):
+            cache, key = find(args, kwargs)
+            if cache is not None:
+                cache[0].pop(key, None)
+        new_func.forget = forget
+        new_func.stats = lambda: dict(counters)
 
         return new_func
 
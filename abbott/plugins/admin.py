@@ -13,7 +13,7 @@ from parsedatetime.parsedatetime import Calendar
 import pretty
 
 from ..command import CommandPluginSuperclass, require_channel
-from ..pluginbase import EventWatcher
+from ..pluginbase import EventWatcher, Scheduler
 from ..transport import Event
 from . import ircutil
 from . import ircop
@@ -32,7 +32,7 @@ def parse_time(timestr):
     now = time.time()
     return max(1, timestamp-now)
 
-class IRCAdmin(EventWatcher, CommandPluginSuperclass):
+class IRCAdmin(Scheduler, EventWatcher, CommandPluginSuperclass):
     """Provides a command interface to IRC operator tasks. Uses the plugins in
     the ircop module to perform the operations.
 
@@ -44,50 +44,13 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             "defaulttime": None,
             }
 
-    def __init__(self, *args):
-        self.started = False
-
-        # This dictionary maps tuples of (param, channel, mode) to twisted
-        # timer objects. When the timer fires, the mode is set/unset on the
-        # given channel with the given parameter
-        self.later_timers = {}
-
-
-        super(IRCAdmin, self).__init__(*args)
-
-    def reload(self):
-        super(IRCAdmin, self).reload()
-
-        if "laters" not in self.config:
-            self.config['laters'] = []
-
-        if self.started:
-            self._set_all_timers()
-
-    def _set_all_timers(self):
-        """Reads from the config and syncs the twisted timers with that.
-        This is called when the plugin is started or reloaded. basically
-        whenever we have to read the config and set twisted timers from
-        that."""
-
-        if self.initial_setalltimers_timer:
-            if self.initial_setalltimers_timer.active():
-                # This function was called from somewhere before the initial
-                # call (maybe from reload?). Just ignore it. We'll get called
-                # soon enough.
-                return
-            else:
-                # First time this function is called. Set this to none
-                self.initial_setalltimers_timer = None
-
-        for timer in self.later_timers.values():
-            timer.cancel()
-        # Avoid AlreadyCancelled errors by deleting the timer objects
-        self.later_timers = {}
-
-        for activatetime, param, channel, mode in self.config['laters']:
-            self._set_timer(activatetime - time.time(), param, channel, mode)
-
+    # Don't set modes that came due while we were down right away, because
+    # we're likely still connecting to the server. This is a bit of a hack; a
+    # better way would be to detect when we're connected, or have the
+    # framework automatically buffer things like mode requests if sent while
+    # not connected. This hack won't help, for example, if the bot is started
+    # but disconnected due to network or server issues.
+    LATER_STARTUP_DELAY = 30
 
     def _set_timer(self, delay, param, channel, mode):
         """In delay seconds, issue a mode request with the given parameter on
@@ -97,77 +60,8 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
         the second character is a letter
 
         """
-        # First, cancel any existing timers and remove any existing saved
-        # laters from the config that match this one.
-        if (param, channel, mode) in self.later_timers:
-            timer = self.later_timers.pop((param, channel, mode))
-            timer.cancel()
-
-        # Filter out any events that match this one from the persistent config.
-        # If this is being called from _set_all_timers(), the current entry is
-        # removed, but is added back below.
-        self.config['laters'] = [item for item in self.config['laters']
-                if not (item[1] == param and
-                       item[2] == channel and
-                       item[3] == mode
-                       )]
-
-        # This function will be run later
-        @defer.inlineCallbacks
-        def do_later():
-            log.msg("timed request: %s for %s in %s" % (mode, param, channel))
-            # First, take this item out of the mapping
-            del self.later_timers[(param, channel, mode)]
-
-            # And the persistent config
-            self.config['laters'] = [item for item in self.config['laters']
-                    if not (item[1] == param and
-                           item[2] == channel and
-                           item[3] == mode
-                           )]
-            self.config.save()
-
-            # Now send the event
-            try:
-                try:
-                    # If we can call a specific request, do so
-                    yield self.transport.issue_request(
-                            "ircop.{0}".format(
-                                {
-                                    "+b":"ban",
-                                    "+q":"quiet",
-                                    "+o":"op",
-                                    "-o":"deop",
-                                    "+v":"voice",
-                                    "-v":"devoice",
-                                    "-b":"unban",
-                                    "-q":"unquiet"
-                                    }[mode]
-                                ),
-                            channel=channel,
-                            target=param
-                            )
-                except KeyError:
-                    # ...otherwise, just use the generic mode call
-                    yield self.transport.issue_request(
-                            "ircop.mode",
-                            channel=channel,
-                            mode=mode,
-                            param=param)
-            except (ircop.OpFailed, ValueError) as e:
-                s = "I was about to do a {0} {1}, but {2}".format(
-                        mode,
-                        param,
-                        e,
-                        )
-                self.transport.send_event(Event("irc.do_msg",
-                    user=channel,
-                    message=s,
-                    ))
-
-
-        # Now submit the do_later() function to twisted to call it later
-        timer = reactor.callLater(max(1,delay), do_later)
+        # Replaces any pending timer for the same mode change
+        self.call_later(max(1,delay), "mode", param, channel, mode)
 
         log.msg("Setting {0} on {1} in {2} in {3} seconds".format(
             mode,
@@ -176,14 +70,48 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
             max(1,delay),
             ))
 
-        # and file this timer away:
-        self.later_timers[(param, channel, mode)] = timer
+    @defer.inlineCallbacks
+    def on_later_mode(self, param, channel, mode):
+        """Issues a mode request scheduled by _set_timer()"""
+        log.msg("timed request: %s for %s in %s" % (mode, param, channel))
 
-        # Save to the persistent config
-        self.config['laters'].append(
-                (time.time()+delay, param, channel, mode)
-                )
-        self.config.save()
+        # Now send the event
+        try:
+            try:
+                # If we can call a specific request, do so
+                yield self.transport.issue_request(
+                        "ircop.{0}".format(
+                            {
+                                "+b":"ban",
+                                "+q":"quiet",
+                                "+o":"op",
+                                "-o":"deop",
+                                "+v":"voice",
+                                "-v":"devoice",
+                                "-b":"unban",
+                                "-q":"unquiet"
+                                }[mode]
+                            ),
+                        channel=channel,
+                        target=param
+                        )
+            except KeyError:
+                # ...otherwise, just use the generic mode call
+                yield self.transport.issue_request(
+                        "ircop.mode",
+                        channel=channel,
+                        mode=mode,
+                        param=param)
+        except (ircop.OpFailed, ValueError) as e:
+            s = "I was about to do a {0} {1}, but {2}".format(
+                    mode,
+                    param,
+                    e,
+                    )
+            self.transport.send_event(Event("irc.do_msg",
+                user=channel,
+                message=s,
+                ))
 
     def on_event_irc_on_mode_change(self, event):
         """If a timer was set to un-ban or un-quiet a user, and we see them be
@@ -199,46 +127,17 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
         channel = event.channel
 
         # Cancel any pending timers for this
-        try:
-            timer = self.later_timers.pop((user, channel, mode))
-        except KeyError:
-            pass
-        else:
-            timer.cancel()
-
-            # Also filter out the persistent config entry
-            self.config['laters'] = [item for item in self.config['laters']
-                    if not (item[1] == user and
-                           item[2] == channel and
-                           item[3] == mode
-                           )]
-            self.config.save()
-
-
-    def stop(self):
-        super(IRCAdmin, self).stop()
-
-        for timer in self.later_timers.values():
-            timer.cancel()
-
-        # if the plugin is stopped (happens on module reload) before the
-        # initial call to _set_all_timers, then make sure to cancel that timer!
-        if self.initial_setalltimers_timer:
-            self.initial_setalltimers_timer.cancel()
+        self.cancel_later("mode", user, channel, mode)
 
     def start(self):
         super(IRCAdmin, self).start()
 
-        self.started = True
-        
-        # Start the timers for modes we need to set later. Don't start the
-        # timers right away, though, because we're likely still connecting to
-        # the server. This is a bit of a hack; a better way would be to detect
-        # when we're connected, or have the framework automatically buffer
-        # things like mode requests if sent while not connected. This hack won't
-        # help, for example, if the bot is started but disconnected due to
-        # network or server issues.
-        self.initial_setalltimers_timer = reactor.callLater(30, self._set_all_timers)
+        # Timers used to be kept in the config. Move any left there to the
+        # scheduler.
+        if "laters" in self.config:
+            for activatetime, param, channel, mode in self.config.pop('laters'):
+                self.call_at(activatetime, "mode", param, channel, mode)
+            self.config.save()
 
         self.listen_for_event("irc.on_mode_change")
 
@@ -1070,11 +969,12 @@ class IRCAdmin(EventWatcher, CommandPluginSuperclass):
         # so it's easier to work with
         laters = [
                 LaterItem(
-                    time=int(x[0]),
-                    mask=x[1],
-                    channel=x[2],
-                    mode=x[3])
-                for x in self.config['laters'] if x[3][1] in "bq"
+                    time=int(x),
+                    mask=mask,
+                    channel=channel,
+                    mode=mode)
+                for x, name, (mask, channel, mode) in self.pending_laters()
+                if mode[1] in "bq"
         ]
 
         # Sort in the order of the namedtuple parameters: by channel and then by time
@@ -1168,6 +1068,14 @@ class IRCTopic(CommandPluginSuperclass):
         # set of deferreds waiting for the current topic response in a channel
         self.topic_waiters = defaultdict(set)
 
+    def export_state(self):
+        return dict((channel, list(topics)) for channel, topics in
+                self.topic_stack.items())
+
+    def import_state(self, state):
+        for channel, topics in state.items():
+            self.topic_stack[channel].extend(topics)
+
     ### Topic methods
     def on_event_irc_on_topic_updated(self, event):
         channel = event.channel
@@ -15,8 +15,8 @@ The auth module provides the Auth plugin, which handles authorization of irc
 users. It identifies irc users by the response code 330 from a whois, commonly
 used to supply the username the user is logged in with.
 
-The plugin hooks incoming irc events and adds a function to the event object:
-has_permission(). This function takes two parameters: a permission string, and
+The plugin provides a lazy attribute on incoming irc events (see
+transport.Transport.provide_event_attribute()): has_permission(). This function takes two parameters: a permission string, and
 a channel, and returns a deferred which fires with a boolean value indicating
 if the user that initiated the event has that permission in that channel or
 not. (if channel is irrelevant for the permission, it should be None,
@@ -97,7 +97,7 @@ class Auth(command.CommandPluginSuperclass):
     """Auth plugin.
 
     Provides a reliable set of permissions other plugins can rely on. For
-    certain irc events, installs a has_permission() callback which can be used
+    certain irc events, provides a has_permission() callback which can be used
     to query if a user has a particular permission.
     
     """
@@ -114,8 +114,20 @@ class Auth(command.CommandPluginSuperclass):
     def start(self):
         super(Auth, self).start()
 
-        # Install a middleware hook for all irc events
-        self.install_middleware("irc.on_*")
+        # Provide functions one can call to see if a user has a particular
+        # permission on the applicable irc events. They're only created if a
+        # plugin actually wants to verify identity.
+        for eventtype in [
+                "irc.on_privmsg",
+                "irc.on_mode_changed",
+                "irc.on_user_joined",
+                "irc.on_action",
+                "irc.on_topic_updated",
+                ]:
+            self.provide_event_attribute(eventtype, "has_permission",
+                    lambda event: functools.partial(self._has_permission, event.user))
+            self.provide_event_attribute(eventtype, "where_permission",
+                    lambda event: functools.partial(self._where_permission, event.user))
 
         # maps hostmasks to authenticated usernames, or None to indicate the
         # user doesn't have any auth information
@@ -214,27 +226,14 @@ class Auth(command.CommandPluginSuperclass):
                 helptext="Tells you who you're auth'd as and lists your permissions.",
                 )
 
-    def received_middleware_event(self, event):
-        """For events that are applicable, install a handler one can call to
-        see if a user has a particular permission.
-
-        This way, auth permissions aren't checked until a plugin actually wants
-        to verify identity.
-
-        """
-
-        if event.eventtype in [
-                "irc.on_privmsg",
-                "irc.on_mode_changed",
-                "irc.on_user_joined",
-                "irc.on_action",
-                "irc.on_topic_updated",
-                ]:
-            event.has_permission = functools.partial(self._has_permission, event.user)
-            event.where_permission = functools.partial(self._where_permission, event.user)
-
-        return event
+    def export_state(self):
+        # The None entries are short-lived and pruned by timers of the old
+        # instance, so leave those out
+        return dict((hostmask, authname) for hostmask, authname in
+                self.authd_users.items() if authname is not None)
 
+    def import_state(self, state):
+        self.authd_users.update(state)
 
     @defer.inlineCallbacks
     def _get_permissions(self, hostmask):
@@ -23,20 +23,133 @@ class CoreControl(CommandPluginSuperclass):
                 helptext="Re-reads the config on disk and updates in-memory configuration",
                 )
 
+        self.install_command(
+                cmdname="stats",
+                argmatch=r"(?P<plugin>[\w.]+)?$",
+                cmdusage="[plugin name | reset]",
+                permission="core.stats",
+                callback=self.stats,
+                helptext="Shows which event and request handlers are taking up the most time, optionally only for the given plugin",
+                )
+
+        self.provides_request("core.stats")
+
+    def on_request_core_stats(self):
+        """Returns a dict with the transport's dispatch statistics. "handlers"
+        is a list of dicts, one per (plugin, kind, name) that has been called,
+        with the plugin, kind and name, and the count, total, max and buckets
+        from the latency histogram. See transport.LatencyHistogram. "offload"
+        maps plugin names to the stats of their calls to offload().
+        "middleware" is a list of dicts with the plugin, eventtype, and the
+        number of events the middleware swallowed and replaced
+
+        """
+        handlers = []
+        for (plugin, kind, name), histogram in \
+                self.transport.latency_stats().items():
+            stats = histogram.as_dict()
+            stats.update(plugin=plugin, kind=kind, name=name)
+            handlers.append(stats)
+        offload = {}
+        for plugin_name, plugin in self.pluginboss.loaded_plugins.items():
+            stats = plugin.offload_stats
+            if stats is not None:
+                offload[plugin_name] = dict(
+                        waiting=stats.waiting,
+                        running=stats.running,
+                        wait_times=stats.wait_times.as_dict(),
+                        run_times=stats.run_times.as_dict(),
+                        )
+        middleware = []
+        for (plugin, eventtype), counts in \
+                self.transport.middleware_stats().items():
+            counts.update(plugin=plugin, eventtype=eventtype)
+            middleware.append(counts)
+        return dict(
+                handlers=handlers,
+                offload=offload,
+                queue_depth=self.transport.queue_depth(),
+                lane_depths=self.transport.lane_depths(),
+                shed=dict(self.transport.shed_counts),
+                request_cache=self.transport.request_cache_stats(),
+                middleware=middleware,
+                )
+
+    def stats(self, event, match):
+        plugin_name = match.groupdict()['plugin']
+        if plugin_name == "reset":
+            self.transport.reset_latency_stats()
+            event.reply("Stats reset")
+            return
+
+        histograms = [(key, histogram) for key, histogram in
+                self.transport.latency_stats().items()
+                if plugin_name is None or key[0] == plugin_name]
+        if not histograms:
+            event.reply("No handlers have been called yet")
+            return
+
+        # Show the handlers that have taken the most time overall
+        histograms.sort(key=lambda item: item[1].total, reverse=True)
+        for (plugin, kind, name), histogram in histograms[:5]:
+            p99 = histogram.percentile(99)
+            event.reply("{0} {1} {2}: {3} calls, {4:.1f}ms total, "
+                    "{5:.2f}ms mean, {6:.1f}ms max, p99 {7}".format(
+                        plugin, kind, name,
+                        histogram.count,
+                        histogram.total * 1000,
+                        histogram.total * 1000 / histogram.count,
+                        histogram.max * 1000,
+                        "<{0}ms".format(p99 * 1000) if p99 is not None
+                            else ">1s",
+                        ))
+
+        plugin = self.pluginboss.loaded_plugins.get(plugin_name)
+        if plugin is not None and plugin.offload_stats is not None:
+            stats = plugin.offload_stats
+            event.reply("Offloaded: {0} waiting, {1} running, {2:.1f}ms max "
+                    "wait, {3:.1f}ms max run time".format(
+                        stats.waiting, stats.running,
+                        stats.wait_times.max * 1000,
+                        stats.run_times.max * 1000))
+
+        if plugin_name is None:
+            cache_stats = self.transport.request_cache_stats()
+            if cache_stats:
+                event.reply("Requests: " + ", ".join(
+                    "{0} {1} hits/{2} misses/{3} coalesced".format(
+                        name, stats['hits'], stats['misses'],
+                        stats['coalesced'])
+                    for name, stats in sorted(cache_stats.items())))
+
+        short_circuits = ["{0} {1}: {2} swallowed/{3} replaced".format(
+                    plugin, eventtype, counts['swallowed'], counts['replaced'])
+                for (plugin, eventtype), counts in sorted(
+                    self.transport.middleware_stats().items())
+                if (plugin_name is None or plugin == plugin_name) and
+                    (counts['swallowed'] or counts['replaced'])]
+        if short_circuits:
+            event.reply("Middleware: " + ", ".join(short_circuits))
+
+        shed = sum(self.transport.shed_counts.values())
+        if shed:
+            event.reply("{0} events dropped, {1} queued ({2} by lane)".format(
+                shed, self.transport.queue_depth(),
+                "/".join(str(depth) for depth in self.transport.lane_depths())))
+
     def shutdown(self, event, match):
         event.reply("Goodbye")
         reactor.callLater(2, reactor.stop)
 
     def configreload(self, event, match):
         try:
-            self.pluginboss._load()
+            # Only the plugins whose json files changed are reloaded
+            reloaded = self.pluginboss.reload_changed_configs()
         except Exception:
             event.reply("There was a problem loading the new json. Check for syntax errors maybe? Full traceback in log")
             raise
-        # Each plugin will reload their individual json files when we call reload()
-        for plugin in self.pluginboss.loaded_plugins.values():
-            plugin.reload()
-        event.reply("Config reloaded!")
+        event.reply("Config reloaded! ({0} plugins reloaded)".format(
+            len(reloaded)))
         
 class Help(CommandPluginSuperclass):
     def start(self):
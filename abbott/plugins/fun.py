@@ -9,7 +9,7 @@ from twisted.python import log
 
 from ..pluginbase import BotPlugin
 from ..command import CommandPluginSuperclass
-from ..transport import Event
+from ..transport import Event, make_event, event_attrs
 
 """
 This module has miscellaneous fun plugins that don't do anything useful
@@ -135,8 +135,7 @@ class Reverse(CommandPluginSuperclass):
     def on_event_irc_on_privmsg(self, event):
 
         if self.on and not hasattr(event, "_reversed"):
-            revent = Event("irc.on_privmsg")
-            revent.__dict__.update(event.__dict__)
+            revent = make_event("irc.on_privmsg", **event_attrs(event))
             revent.message = revent.message[::-1]
             revent._reversed = True
             self.transport.send_event(revent)
@@ -148,12 +147,39 @@ class Reverse(CommandPluginSuperclass):
 class Sneeze(BotPlugin):
     DEFAULT_CONFIG = {"channels":[]}
 
+    def __init__(self, *args):
+        self.started = False
+
+        # The channels we currently have a privmsg listener for
+        self.listening = []
+
+        super(Sneeze, self).__init__(*args)
+
     def start(self):
         super(Sneeze, self).start()
 
         self.timers = {}
 
-        self.listen_for_event("irc.on_privmsg")
+        self._listen_channels()
+        self.started = True
+
+    def reload(self):
+        super(Sneeze, self).reload()
+
+        # The channel list may have changed
+        if self.started:
+            self._listen_channels()
+
+    def _listen_channels(self):
+        """Only listen for messages in the configured channels, so we aren't
+        bothered with every message in every other channel
+
+        """
+        for channel in self.listening:
+            self.unlisten_for_event("irc.on_privmsg", channel=channel)
+        self.listening = list(self.config["channels"])
+        for channel in self.listening:
+            self.listen_for_event("irc.on_privmsg", channel=channel)
 
     def stop(self):
         super(Sneeze, self).stop()
@@ -162,21 +188,19 @@ class Sneeze(BotPlugin):
             t.cancel()
 
     def on_event_irc_on_privmsg(self, event):
-        if event.channel in self.config["channels"]:
-
-            # An exponential distribution with a minimum of 1 and a
-            # mean of x+1
-            x = 3
-            timeout = random.expovariate(1.0/x)+1
-            # in seconds
-            timeout = timeout * 60 * 60
-            if event.channel in self.timers:
-                self.timers[event.channel].reset(timeout)
-            else:
-                timer = reactor.callLater(timeout,
-                        self.sneeze,
-                        event.channel)
-                self.timers[event.channel] = timer
+        # An exponential distribution with a minimum of 1 and a
+        # mean of x+1
+        x = 3
+        timeout = random.expovariate(1.0/x)+1
+        # in seconds
+        timeout = timeout * 60 * 60
+        if event.channel in self.timers:
+            self.timers[event.channel].reset(timeout)
+        else:
+            timer = reactor.callLater(timeout,
+                    self.sneeze,
+                    event.channel)
+            self.timers[event.channel] = timer
 
     def sneeze(self, channel):
         log.msg("Sneeze timer erupted for %s" % channel)
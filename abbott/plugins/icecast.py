@@ -69,9 +69,9 @@ class IcecastStatus(CommandPluginSuperclass):
 
     @defer.inlineCallbacks
     def radio_status(self, event, match):
-        response_deferred = self._send_request()
-        response_deferred.addCallback(self._get_status)
-        streams = list((yield response_deferred))
+        content = (yield self._send_request())
+        # Parsing the page takes a while. Do it in a thread.
+        streams = (yield self.offload(lambda: list(self._get_status(content))))
         maxtitlelen = max(len(s['Stream Title']) for s in streams)
 
         count = 0
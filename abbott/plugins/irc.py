@@ -7,7 +7,7 @@ from twisted.internet.ssl import ClientContextFactory
 from twisted.python import log
 
 from ..pluginbase import BotPlugin
-from ..transport import Event
+from ..transport import Event, event_class, make_event
 from ..command import CommandPluginSuperclass
 
 """
@@ -17,6 +17,16 @@ twisted Protocol-derived object (IRCBot) used in conjunction with IRCBotPlugin
 
 """
 
+# Compact classes for the events we emit at a high rate, so each one is stored
+# in slots instead of a dict. See transport.event_class()
+event_class("irc.on_privmsg", ["user", "channel", "message", "direct"])
+event_class("irc.on_notice", ["user", "channel", "message"])
+event_class("irc.on_mode_change", ["user", "channel", "set", "mode", "arg"])
+event_class("irc.on_user_joined", ["user", "channel"])
+event_class("irc.on_user_part", ["user", "channel"])
+event_class("irc.on_user_quit", ["user", "message"])
+event_class("irc.on_nick_change", ["oldnick", "newnick"])
+
 class IRCBot(irc.IRCClient):
     """This is the IRC protocol object (not a bot plugin). One of these objects
     is created per connection to an IRC server by the Factory object
@@ -122,6 +132,16 @@ class IRCBot(irc.IRCClient):
 
     ### The following are things that happen to us
 
+    def signedOn(self):
+        """We have registered with the server"""
+        self.factory.broadcast_message("irc.on_signed_on")
+
+    def nickChanged(self, nick):
+        """Our nick has been changed"""
+        irc.IRCClient.nickChanged(self, nick)
+        self.factory.broadcast_message("irc.on_self_nick_change",
+                newnick=nick)
+
     def joined(self, channel):
         """We have joined a channel"""
         log.msg("Joined channel %s" % channel)
@@ -264,8 +284,16 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
             return d
         self.shutdown_trigger = reactor.addSystemEventTrigger("before", "shutdown", shutdown)
 
-        self.provides_request("irc.getnick")
-        self.provides_request("irc.get_channel_mode_params")
+        # Both of these are asked for constantly. Our nick only changes when
+        # the server tells us so, and the mode params are sent by the server
+        # when we connect.
+        self.provides_request("irc.getnick",
+                cache_ttl=300,
+                invalidate_on=["irc.on_signed_on", "irc.on_self_nick_change",
+                    "irc.do_setnick"])
+        self.provides_request("irc.get_channel_mode_params",
+                cache_ttl=300,
+                invalidate_on=["irc.on_signed_on", "irc.on_join"])
 
     def stop(self):
         log.msg("IRCBotPlugin stopping...")
@@ -297,7 +325,7 @@ class IRCBotPlugin(protocol.ReconnectingClientFactory, BotPlugin):
         comes in from the network
         
         """
-        event = Event(eventname, **kwargs)
+        event = make_event(eventname, **kwargs)
         self.transport.send_event(event)
 
     def received_event(self, event):
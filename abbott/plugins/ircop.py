@@ -188,6 +188,35 @@ class OpProvider(EventWatcher, BotPlugin):
         self.listen_for_event("ircutil.hasop.lost")
         self.listen_for_event("irc.on_join")
 
+    def export_state(self):
+        """Hands over the buffered requests, which would otherwise never be
+        processed, and how long to hold op
+
+        """
+        return {
+                "op_until": dict(self.op_until),
+                "mode_buffer": dict(self.mode_buffer),
+                "event_buffer": dict(self.event_buffer),
+                "connector_buffer": dict(self.connector_buffer),
+                }
+
+    def import_state(self, state):
+        self.op_until.update(state['op_until'])
+        for name in ("mode_buffer", "event_buffer", "connector_buffer"):
+            for channel, items in state[name].items():
+                getattr(self, name)[channel].update(items)
+
+        # The old instance's timers were cancelled when it stopped, so start
+        # them again here
+        for channel in set(state['mode_buffer']) | \
+                set(state['event_buffer']) | set(state['connector_buffer']):
+            if (self.mode_buffer[channel] or self.event_buffer[channel] or
+                    self.connector_buffer[channel]):
+                self._set_buffer_processor_timer(channel)
+        for channel, until in list(self.op_until.items()):
+            if until > time.time():
+                self._deop_later(channel)
+
     def reload(self):
         super(OpProvider, self).reload()
         
@@ -40,7 +40,9 @@ class IRCWhois(CommandPluginSuperclass):
     def start(self):
         super(IRCWhois, self).start()
 
-        self.provides_request("irc.whois")
+        # Every concurrent whois for the same nick gets the same reply, so
+        # only send one to the server
+        self.provides_request("irc.whois", coalesce=True)
 
         self.listen_for_event("irc.on_unknown")
 
@@ -150,7 +152,7 @@ class Names(CommandPluginSuperclass):
     def start(self):
         super(Names, self).start()
 
-        self.provides_request("irc.names")
+        self.provides_request("irc.names", coalesce=True)
 
         self.listen_for_event("irc.on_unknown")
 
@@ -214,7 +216,7 @@ class Names(CommandPluginSuperclass):
 
         
 class ReplyInserter(CommandPluginSuperclass):
-    """This plugin's function is to insert a reply() function to each incoming
+    """This plugin's function is to provide a reply() function on each incoming
     irc.on_privmsg event. It is required for a lot of functionality, including
     all Command-derived plugins, so you should probably have this activated!
 
@@ -223,6 +225,8 @@ class ReplyInserter(CommandPluginSuperclass):
         super(ReplyInserter, self).start()
 
         self.install_middleware("irc.on_privmsg")
+        self.provide_event_attribute("irc.on_privmsg", "reply",
+                self._make_reply)
 
         self.install_command(
                 cmdname="echo",
@@ -250,17 +254,24 @@ class ReplyInserter(CommandPluginSuperclass):
     def on_middleware_irc_on_privmsg(self, event):
 
         # If the message ends in this regular expression, redirect any replies
-        # at the named user
-        match = re.match(r"^(?P<msg>.*)(?:\s+@\s*(?P<target>[^ ]+))\s*$", event.message)
-        if match:
-            gd = match.groupdict()
-            newtarget = gd['target']
-            event.message = gd['msg']
-        else:
-            newtarget = None
+        # at the named user. Most messages don't have an @ at all, so don't
+        # bother with the regular expression for those.
+        if "@" in event.message:
+            match = re.match(r"^(?P<msg>.*)(?:\s+@\s*(?P<target>[^ ]+))\s*$", event.message)
+            if match:
+                gd = match.groupdict()
+                event.message = gd['msg']
+                event.reply = self._make_reply(event, gd['target'])
+        return event
+
+    def _make_reply(self, event, newtarget=None):
+        """Makes the reply() function for an irc.on_privmsg event. This is the
+        lazy provider of the reply attribute, so it's only called if
+        something uses the event's reply().
 
+        """
         def reply(msg, userprefix=True, notice=False, direct=False):
-            """This function is inserted to every irc.on_privmsg event that's
+            """This function is provided on every irc.on_privmsg event that's
             sent. It sends a reply directed at the user that sent the message.
 
             if userprefix is True (the default), the message is prefixed by
@@ -302,8 +313,7 @@ class ReplyInserter(CommandPluginSuperclass):
 
             newevent = Event(eventname, user=outchannel, message=msg)
             self.transport.send_event(newevent)
-        event.reply = reply
-        return event
+        return reply
 
 class HasOp(BotPlugin):
     """A simple plugin to determine if the bot has OP in a channel or not.
@@ -321,6 +331,13 @@ class HasOp(BotPlugin):
         self.listen_for_event("irc.on_join")
         self.listen_for_event("irc.on_mode_change")
 
+    def export_state(self):
+        return dict(self.has_op)
+
+    def import_state(self, state):
+        self.has_op.update(state)
+
+    @non_reentrant(self=0, channel=1)
     @defer.inlineCallbacks
     def on_request_irc_has_op(self, channel):
 
@@ -384,6 +401,12 @@ class ChanMode(EventWatcher, BotPlugin):
         self.listen_for_event("irc.on_mode_change")
         self.listen_for_event("irc.on_unknown")
 
+    def export_state(self):
+        return dict(self.mode)
+
+    def import_state(self, state):
+        self.mode.update(state)
+
     @defer.inlineCallbacks
     def on_request_irc_chanmode(self, channel):
 
@@ -395,7 +418,10 @@ class ChanMode(EventWatcher, BotPlugin):
 
             defer.returnValue( self.mode[channel] )
 
-    @non_reentrant(channel=1)
+    # Concurrent lookups for a channel share one MODE query. Nothing is kept
+    # beyond that: self.mode is the cache, and every other caller wants a
+    # fresh answer because the mode may have just changed.
+    @non_reentrant(self=0, channel=1)
     @defer.inlineCallbacks
     def _get_mode(self, channel):
         log.msg("Sending a request for the mode of channel {0}".format(channel))
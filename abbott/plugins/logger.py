@@ -1,6 +1,12 @@
+import os.path
 import pprint
+import time
+
+from twisted.internet import task
 
 from ..pluginbase import BotPlugin
+from ..transport import event_attrs
+from ..journal import JournalWriter
 from ..command import CommandPluginSuperclass
 
 class Log(BotPlugin):
@@ -10,7 +16,39 @@ class Log(BotPlugin):
     def received_event(self, event):
         print()
         print("Received event %s" % (event.eventtype,))
-        print(pprint.pformat(event.__dict__))
+        print(pprint.pformat(event_attrs(event)))
+
+class Recorder(BotPlugin):
+    """Records every event to a binary journal file, for replaying later. See
+    the journal module.
+
+    The "file" config option is the path of the journal, relative to the
+    config directory. Events are appended to it if it exists.
+
+    """
+    DEFAULT_CONFIG = {"file": "events.journal"}
+
+    def start(self):
+        super(Recorder, self).start()
+
+        path = os.path.join(self.pluginboss.configdir, self.config['file'])
+        self.journal_file = open(path, "ab")
+        self.journal = JournalWriter(self.journal_file)
+
+        # The file is buffered. Flush it every so often so the journal isn't
+        # too far behind if we're killed.
+        self.flusher = task.LoopingCall(self.journal.flush)
+        self.flusher.start(5, now=False)
+
+        self.listen_for_event("*.*")
+
+    def stop(self):
+        super(Recorder, self).stop()
+        self.flusher.stop()
+        self.journal_file.close()
+
+    def received_event(self, event):
+        self.journal.write(event, time.time())
 
 class Repr(CommandPluginSuperclass):
     def start(self):
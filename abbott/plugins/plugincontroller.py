@@ -5,6 +5,7 @@ try:
     from twisted.python._reflectpy3 import namedModule
 except ImportError:
     from twisted.python.reflect import namedModule
+from twisted.internet import defer
 from twisted.python import log
 
 from ..command import CommandPluginSuperclass
@@ -67,6 +68,15 @@ class PluginController(CommandPluginSuperclass):
                 helptext="Lists all currently loaded plugins",
                 )
 
+        plugingroup.install_command(
+                cmdname="subscriptions",
+                argmatch=r"(?P<plugin>[\w.]+)$",
+                callback=self.list_subscriptions,
+                cmdusage="<plugin name>",
+                helptext="Lists the events, middleware and requests the given plugin is registered for",
+                )
+
+    @defer.inlineCallbacks
     def load_plugin(self, event, match):
         plugin_name = match.groupdict()['plugin']
         if plugin_name in self.pluginboss.loaded_plugins:
@@ -74,7 +84,7 @@ class PluginController(CommandPluginSuperclass):
             return
 
         try:
-            self.pluginboss.load_plugin(plugin_name)
+            yield self.pluginboss.load_plugin(plugin_name)
         except Exception:
             event.reply("Something went wrong loading the plugin. Check the error log for a traceback")
             raise
@@ -97,6 +107,7 @@ class PluginController(CommandPluginSuperclass):
             raise
         event.reply("Plugin %s has been unloaded." % plugin_name)
 
+    @defer.inlineCallbacks
     def reload_module(self, event, match):
         module_name = match.groupdict()['module']
 
@@ -112,6 +123,15 @@ class PluginController(CommandPluginSuperclass):
             ", ".join(plugins),
             ))
 
+        # Hand the plugins' caches and such to the new instances
+        states = {}
+        for plugin_name in plugins:
+            try:
+                states[plugin_name] = \
+                        self.pluginboss.loaded_plugins[plugin_name].export_state()
+            except Exception:
+                log.err(None, "Could not export the state of %s" % plugin_name)
+
         for plugin_name in plugins:
             try:
                 self.pluginboss.unload_plugin(plugin_name)
@@ -132,7 +152,8 @@ class PluginController(CommandPluginSuperclass):
 
         for plugin_name in plugins:
             try:
-                self.pluginboss.load_plugin(plugin_name)
+                yield self.pluginboss.load_plugin(plugin_name,
+                        state=states.get(plugin_name))
             except Exception:
                 event.reply("Something went wrong loading %s. Please see the error log" % plugin_name)
             else:
@@ -176,3 +197,35 @@ class PluginController(CommandPluginSuperclass):
 
         plugins.sort()
         event.reply("Plugins currently running: %s" % ", ".join(plugins))
+
+    def list_subscriptions(self, event, match):
+        plugin_name = match.groupdict()['plugin']
+
+        plugin = self.pluginboss.loaded_plugins.get(plugin_name)
+        if plugin is None:
+            event.reply("Plugin %s is not loaded." % plugin_name)
+            return
+
+        subscriptions = self.transport.subscriptions(plugin)
+        if not subscriptions:
+            event.reply("%s isn't registered for anything" % plugin_name)
+            return
+
+        by_kind = {}
+        for sub in subscriptions:
+            if sub['kind'] == "event":
+                desc = sub['name'] + "".join(" {0}={1}".format(attr, value)
+                        for attr, value in sorted(sub['filters'].items()))
+                if sub['shared']:
+                    desc += " (+{0} others)".format(sub['shared'])
+            elif sub['kind'] == "middleware":
+                desc = "{0} (priority {1})".format(sub['name'], sub['priority'])
+            elif sub['kind'] == "attribute":
+                desc = "{0} on {1}".format(sub['attribute'], sub['name'])
+            else:
+                desc = sub['name']
+            by_kind.setdefault(sub['kind'], []).append(desc)
+        for kind in ("event", "middleware", "attribute", "request"):
+            if kind in by_kind:
+                event.reply("{0} {1}s: {2}".format(plugin_name, kind,
+                    ", ".join(by_kind[kind])))
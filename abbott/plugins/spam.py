@@ -188,12 +188,32 @@ class ServerAd(pluginbase.EventWatcher, CommandPluginSuperclass):
     regex = re.compile(
             r'''(?:^|\s|ip(?:=|:)|\*)(\d{1,3}(?:\.\d{1,3}){3})\.?(?:\s|$|:|\*|!|\.|,|;|\?)''', re.I)
 
+    def __init__(self, *args):
+        self.started = False
+
+        # The channel we currently have a join listener for
+        self.listening = None
+
+        super(ServerAd, self).__init__(*args)
+
     def reload(self):
         super(ServerAd, self).reload()
 
+        if self.started:
+            self._listen_joins()
+
+    def _listen_joins(self):
+        """Only listen for joins on the configured channel"""
+        if self.listening:
+            self.unlisten_for_event("irc.on_user_joined", channel=self.listening)
+        self.listening = self.config['channel']
+        if self.listening:
+            self.listen_for_event("irc.on_user_joined", channel=self.listening)
+
     def start(self):
         super(ServerAd, self).start()
-        self.listen_for_event("irc.on_user_joined")
+        self._listen_joins()
+        self.started = True
         permgroup = self.install_cmdgroup(
                 grpname="serverad",
                 permission="serverad",
@@ -219,6 +239,7 @@ class ServerAd(pluginbase.EventWatcher, CommandPluginSuperclass):
         else:
             self.config['channel'] = channel
             self.config.save()
+            self._listen_joins()
             event.reply("Server Ad detection is now on for {0}".format(channel))
 
     @require_channel
@@ -227,6 +248,7 @@ class ServerAd(pluginbase.EventWatcher, CommandPluginSuperclass):
         self.config['channel'] = None
         event.reply("Server ad detection is now off in {0}.".format(channel))
         self.config.save()
+        self._listen_joins()
 
     @classmethod
     def _server_in(cls, text):
@@ -255,11 +277,10 @@ class ServerAd(pluginbase.EventWatcher, CommandPluginSuperclass):
 
     @defer.inlineCallbacks
     def on_event_irc_on_user_joined(self, event):
+        # Only joins to the configured channel are delivered here. See
+        # _listen_joins()
         nick = event.user.split("!")[0]
-        channel = event.channel
-
-        if channel == self.config['channel']:
-            yield self.watch_user(nick, channel)
+        yield self.watch_user(nick, event.channel)
 
     @pluginbase.non_reentrant(self=0, nick=1)
     @defer.inlineCallbacks
@@ -312,6 +312,7 @@ class URLShortener(BotPlugin):
             raise
         self.shortener = googl.Googl()
 
+    @defer.inlineCallbacks
     def on_event_irc_on_privmsg(self, event):
 
         match = self.urlmatcher.search(event.message)
@@ -324,7 +325,8 @@ class URLShortener(BotPlugin):
             return
 
         log.msg("Shortening '%s'" % url)
-        shortened = self.shortener.shorten(url)
+        # This makes an HTTP request, so do it in a thread
+        shortened = (yield self.offload(self.shortener.shorten, url))
 
         event.reply("^ %s" % shortened['id'], userprefix=False)
 
@@ -13,6 +13,14 @@ from ..command import CommandPluginSuperclass, require_channel
 from ..pluginbase import EventWatcher, non_reentrant
 from ..transport import Event
 
+def read_words(filename):
+    """Returns a list of the words in the given dictionary file, one per
+    line
+
+    """
+    with open(filename, "r") as dictionary:
+        return [line.strip() for line in dictionary]
+
 def find_time_until(hour_minute):
     """Returns a datetime.timedelta for the time interval between now and the
     next time of the given hour, in the current locale
@@ -45,6 +53,8 @@ class WordOfTheDay(EventWatcher, CommandPluginSuperclass):
     def __init__(self, *args):
         self.started = False
         self.timer = None
+        # The words of the dictionary. Replaced once reload() has read them
+        self.words = []
 
         super(WordOfTheDay, self).__init__(*args)
 
@@ -79,6 +89,9 @@ class WordOfTheDay(EventWatcher, CommandPluginSuperclass):
                 helptext="Resets the word of the day right now",
                 )
 
+        # Startup isn't finished until we have the words
+        return self.words_loaded
+
     def stop(self):
         if self.timer:
             self.timer.cancel()
@@ -90,11 +103,15 @@ class WordOfTheDay(EventWatcher, CommandPluginSuperclass):
     def reload(self):
         super(WordOfTheDay, self).reload()
 
-        # Get the words of the file
-        self.words = []
-        for line in open(self.config['dictionary'], "r"):
-            line = line.strip()
-            self.words.append(line)
+        # Get the words of the file. It's a big file, so read it in a thread.
+        def got_words(words):
+            self.words = words
+        # Until then, and if the read fails, keep using the words we have
+        self.words_loaded = self.offload(read_words, self.config['dictionary'])
+        self.words_loaded.addCallback(got_words)
+        if self.started:
+            # Otherwise start() returns it, and the plugin loader reports it
+            self.words_loaded.addErrback(log.err, "Could not read the dictionary")
 
         # reset the timer, in case the hour in the config was changed manually
         if self.started:
@@ -148,6 +165,10 @@ class WordOfTheDay(EventWatcher, CommandPluginSuperclass):
         channel = self.config["channel"] or channel
         if not channel:
             raise RuntimeError("_do_wotd() was called, but no channel defined")
+        if not self.words:
+            log.msg("The dictionary hasn't been read yet. Not doing WOTD")
+            self._set_timer()
+            return
         log.msg("Doing WOTD for %s" % channel)
         def say(msg):
             self.transport.send_event(Event("irc.do_msg",
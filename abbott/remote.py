@@ -0,0 +1,493 @@
+import json
+import os
+import os.path
+import sys
+from collections import OrderedDict
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols import amp
+from twisted.python import log
+
+from .pluginbase import BotPlugin, PluginBoss
+from .transport import Transport, make_event, event_attrs
+
+"""
+Support for running plugins in a child process.
+
+Plugins listed in the "out_of_process" list of the core config are not loaded
+into the bot's process. Instead, PluginBoss loads a RemotePlugin in their
+place, which spawns a child python process (this module is its main) that
+loads the real plugin. The two processes talk Twisted AMP over a pair of pipes.
+
+The child has its own Transport and PluginBoss. When the plugin listens for an
+event or provides a request, the child's transport registers it locally and
+also asks the parent to register the RemotePlugin for it. The parent forwards
+matching events and requests to the child, which dispatches them locally.
+Events the plugin sends and requests it issues go to the parent, which
+dispatches them as usual (possibly back to the child).
+
+Event attributes and request arguments and results are sent as JSON. Callables
+(such as the reply() and has_permission() functions middleware adds to events)
+are sent as a reference to the sending side, and the receiving side gets a
+function that calls the original over the pipe and returns a deferred.
+
+Limitations:
+
+* Middleware must return the event synchronously, so a plugin running out of
+  process can't install any. install_middleware() raises NotImplementedError.
+  The same goes for lazy event attribute providers and
+  provide_event_attribute(). Lazy attributes provided in the bot's process are
+  computed before an event is forwarded, and sent to the child with the rest
+  of the event's attributes (callables, such as has_permission(), as
+  references as usual).
+* Requests that fail in the other process errback with RemoteError, not the
+  original exception type.
+* The child's pluginboss doesn't have the other plugins in loaded_plugins.
+  Only loaded_plugins['irc.IRCBotPlugin'].client.nickname is provided, which
+  mirrors the bot's nick.
+* Tuples are sent as lists, and values JSON can't represent are sent as their
+  repr(). AMP limits each encoded value to 64KiB.
+
+"""
+
+class RemoteError(Exception):
+    """A request or call failed on the other side of a process boundary"""
+
+class _Command(amp.Command):
+    errors = {RemoteError: b"REMOTE_ERROR"}
+
+# Sent by the child
+
+class Subscribe(_Command):
+    """kind is "event", "middleware" or "request", name is the event glob or
+    request name. options is a JSON object of keyword arguments to the
+    parent's listen_for_event() or provides_request()
+
+    """
+    arguments = [
+            (b"kind", amp.Unicode()),
+            (b"name", amp.Unicode()),
+            (b"options", amp.Unicode()),
+            ]
+    response = []
+
+class Unsubscribe(Subscribe):
+    pass
+
+class SendEvent(_Command):
+    arguments = [
+            (b"eventtype", amp.Unicode()),
+            (b"attrs", amp.Unicode()),
+            ]
+    requiresAnswer = False
+
+class IssueRequest(_Command):
+    arguments = [
+            (b"name", amp.Unicode()),
+            (b"args", amp.Unicode()),
+            (b"kwargs", amp.Unicode()),
+            ]
+    response = [(b"result", amp.Unicode())]
+
+# Sent by the parent
+
+class DeliverEvent(SendEvent):
+    pass
+
+class HandleRequest(IssueRequest):
+    pass
+
+class Reload(_Command):
+    arguments = []
+    response = []
+
+class Stop(_Command):
+    arguments = []
+    response = []
+
+# Sent by either
+
+class CallCallable(_Command):
+    arguments = [
+            (b"id", amp.Integer()),
+            (b"args", amp.Unicode()),
+            (b"kwargs", amp.Unicode()),
+            ]
+    response = [(b"result", amp.Unicode())]
+
+class _Peer(amp.AMP):
+    """The parts of the protocol common to both processes: encoding values as
+    JSON, and keeping track of the callables sent to the other side
+
+    """
+    # How many callables to keep references to. Once there are more, the
+    # oldest is forgotten and the other side can no longer call it.
+    MAX_CALLABLES = 10000
+
+    def __init__(self):
+        super(_Peer, self).__init__()
+        self._callables = OrderedDict()
+        self._next_callable_id = 0
+
+    def _encode(self, value):
+        return json.dumps(value, default=self._encode_default)
+
+    def _encode_default(self, obj):
+        if callable(obj):
+            callable_id = self._next_callable_id
+            self._next_callable_id += 1
+            self._callables[callable_id] = obj
+            if len(self._callables) > self.MAX_CALLABLES:
+                self._callables.popitem(last=False)
+            return {"__callable__": callable_id}
+        return repr(obj)
+
+    def _decode(self, value):
+        return json.loads(value, object_hook=self._decode_hook)
+
+    def _decode_hook(self, obj):
+        if len(obj) == 1 and "__callable__" in obj:
+            callable_id = obj["__callable__"]
+            def call(*args, **kwargs):
+                d = self.callRemote(CallCallable,
+                        id=callable_id,
+                        args=self._encode(args),
+                        kwargs=self._encode(kwargs))
+                d.addCallback(lambda response: self._decode(response['result']))
+                return d
+            return call
+        return obj
+
+    def _encode_result(self, d):
+        """Adds callbacks to d to turn its result into a response for a
+        command that returns a result
+
+        """
+        def failed(f):
+            raise RemoteError("{0}: {1}".format(
+                f.type.__name__, f.getErrorMessage()))
+        d.addCallbacks(lambda result: {'result': self._encode(result)},
+                failed)
+        return d
+
+    @CallCallable.responder
+    def call_callable(self, id, args, kwargs):
+        try:
+            func = self._callables[id]
+        except KeyError:
+            raise RemoteError("That callable has expired")
+        return self._encode_result(defer.maybeDeferred(func,
+            *self._decode(args), **self._decode(kwargs)))
+
+    def send_event(self, event):
+        # The other side can't call the providers of lazy attributes, so they
+        # have to be called now
+        self.callRemote(self._send_event_command,
+                eventtype=event.eventtype,
+                attrs=self._encode(event_attrs(event, lazy=True)))
+
+    def _received_event(self, eventtype, attrs):
+        return make_event(eventtype, **self._decode(attrs))
+
+    def issue_request(self, name, args, kwargs):
+        d = self.callRemote(self._issue_request_command,
+                name=name,
+                args=self._encode(args),
+                kwargs=self._encode(kwargs))
+        d.addCallback(lambda response: self._decode(response['result']))
+        return d
+
+### The parent side
+
+class _ParentProtocol(_Peer):
+    _send_event_command = DeliverEvent
+    _issue_request_command = HandleRequest
+
+    def __init__(self, plugin):
+        super(_ParentProtocol, self).__init__()
+        self.plugin = plugin
+
+    @Subscribe.responder
+    def subscribe(self, kind, name, options):
+        options = self._decode(options)
+        if kind == "event":
+            self.plugin.transport.listen_for_event(name, self.plugin, **options)
+        elif kind == "request":
+            self.plugin.transport.provides_request(name, self.plugin, **options)
+        else:
+            raise RemoteError("Can't subscribe to {0} from another process".format(kind))
+        return {}
+
+    @Unsubscribe.responder
+    def unsubscribe(self, kind, name, options):
+        if kind == "event":
+            self.plugin.transport.unlisten_for_event(name, self.plugin,
+                    **self._decode(options))
+        return {}
+
+    @SendEvent.responder
+    def event_sent(self, eventtype, attrs):
+        self.plugin.transport.send_event(self._received_event(eventtype, attrs))
+        return {}
+
+    @IssueRequest.responder
+    def request_issued(self, name, args, kwargs):
+        return self._encode_result(self.plugin.transport.issue_request(name,
+            *self._decode(args), **self._decode(kwargs)))
+
+class _ProcessWriter(object):
+    """Stands in for the transport of the parent's _ParentProtocol, writing to
+    the child's command pipe
+
+    """
+    disconnecting = False
+
+    def __init__(self, process, fd):
+        self.process = process
+        self.fd = fd
+
+    def write(self, data):
+        self.process.writeToChild(self.fd, data)
+
+    def writeSequence(self, data):
+        self.write(b"".join(data))
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self.process.closeChildFD(self.fd)
+
+    def getPeer(self):
+        return ("child process", self.process.pid)
+
+    def getHost(self):
+        return ("parent process", os.getpid())
+
+class _ChildProcess(protocol.ProcessProtocol):
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.amp = _ParentProtocol(plugin)
+
+    def connectionMade(self):
+        self.amp.makeConnection(_ProcessWriter(self.transport, 3))
+
+    def childDataReceived(self, fd, data):
+        if fd == 4:
+            self.amp.dataReceived(data)
+        else:
+            for line in data.decode("UTF-8", "replace").splitlines():
+                log.msg("[{0}] {1}".format(self.plugin.plugin_name, line))
+
+    def processEnded(self, reason):
+        self.amp.connectionLost(reason)
+        self.plugin._child_ended(reason)
+
+class RemotePlugin(BotPlugin):
+    """Stands in for a plugin running in a child process. See the module
+    docstring.
+
+    """
+    def __init__(self, *args):
+        self.process = None
+        self.protocol = None
+        self.stopping = False
+
+        # The last event forwarded to the child. See received_event()
+        self._last_event = None
+
+        super(RemotePlugin, self).__init__(*args)
+
+    def reload(self):
+        # The child reads the plugin's config, not us
+        if self.protocol is not None:
+            self.protocol.callRemote(Reload).addErrback(log.err)
+
+    def start(self):
+        super(RemotePlugin, self).start()
+
+        process = _ChildProcess(self)
+        env = dict(os.environ)
+        # Make sure the child can import this package
+        package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+                [package_parent] + env.get("PYTHONPATH", "").split(os.pathsep))
+        self.process = reactor.spawnProcess(process, sys.executable,
+                [sys.executable, "-m", "abbott.remote",
+                    self.pluginboss.configdir, self.plugin_name],
+                env=env,
+                childFDs={0: "w", 1: "r", 2: "r", 3: "w", 4: "r"},
+                )
+        self.protocol = process.amp
+        log.msg("Started {0} in process {1}".format(self.plugin_name, self.process.pid))
+
+    def stop(self):
+        super(RemotePlugin, self).stop()
+        self.stopping = True
+        if self.protocol is None:
+            return
+        self.protocol.callRemote(Stop).addErrback(lambda _: None)
+
+        # If it doesn't exit on its own, make it
+        process = self.process
+        def kill():
+            if process.pid is not None:
+                process.signalProcess("KILL")
+        reactor.callLater(5, kill)
+
+    def _child_ended(self, reason):
+        self.protocol = None
+        if not self.stopping:
+            log.msg("WARNING: the process for {0} ended unexpectedly: {1}".format(
+                self.plugin_name, reason.getErrorMessage()))
+        # Stop sending it things
+        self.transport.unhook_plugin(self)
+
+    def received_event(self, event):
+        # The transport calls us once for each of the child's subscriptions
+        # that match the event, but the child's own transport does the same
+        # when dispatching it there. So only send each event once.
+        if self.protocol is None or event is self._last_event:
+            return
+        self._last_event = event
+        self.protocol.send_event(event)
+
+    def incoming_request(self, name, *args, **kwargs):
+        if self.protocol is None:
+            return defer.fail(RemoteError("{0} is not running".format(self.plugin_name)))
+        return self.protocol.issue_request(name, args, kwargs)
+
+### The child side
+
+class _ChildProtocol(_Peer):
+    _send_event_command = SendEvent
+    _issue_request_command = IssueRequest
+
+    def __init__(self, transport, pluginboss, plugin_name):
+        super(_ChildProtocol, self).__init__()
+        self.bot_transport = transport
+        self.pluginboss = pluginboss
+        self.plugin_name = plugin_name
+
+    def connectionMade(self):
+        super(_ChildProtocol, self).connectionMade()
+        self.bot_transport.protocol = self
+        self.pluginboss.loaded_plugins['irc.IRCBotPlugin'] = _NickMirror(
+                self.bot_transport)
+        def failed(f):
+            log.err(f, "Could not load {0}".format(self.plugin_name))
+            self.transport.loseConnection()
+        defer.maybeDeferred(self.pluginboss.load_plugin,
+                self.plugin_name).addErrback(failed)
+
+    def connectionLost(self, reason):
+        super(_ChildProtocol, self).connectionLost(reason)
+        if reactor.running:
+            reactor.stop()
+
+    @DeliverEvent.responder
+    def event_delivered(self, eventtype, attrs):
+        Transport.send_event(self.bot_transport,
+                self._received_event(eventtype, attrs))
+        return {}
+
+    @HandleRequest.responder
+    def handle_request(self, name, args, kwargs):
+        return self._encode_result(Transport.issue_request(self.bot_transport,
+            name, *self._decode(args), **self._decode(kwargs)))
+
+    @Reload.responder
+    def reload(self):
+        self.pluginboss._load()
+        self.pluginboss.loaded_plugins[self.plugin_name].reload()
+        return {}
+
+    @Stop.responder
+    def stop(self):
+        self.pluginboss.unload_plugin(self.plugin_name)
+        reactor.callLater(0, reactor.stop)
+        return {}
+
+class _ChildTransport(Transport):
+    """The transport in the child process. Registrations are made both here
+    and, through the parent, in the bot's transport. Events and requests from
+    the plugin go to the parent.
+
+    """
+    protocol = None
+
+    def install_middleware(self, matchstr, obj_to_notify, priority=0):
+        raise NotImplementedError("Plugins running out of process can't install middleware")
+
+    def provide_event_attribute(self, matchstr, name, obj, func):
+        raise NotImplementedError("Plugins running out of process can't provide event attributes")
+
+    def listen_for_event(self, matchstr, obj_to_notify, **filters):
+        super(_ChildTransport, self).listen_for_event(matchstr, obj_to_notify, **filters)
+        self.protocol.callRemote(Subscribe, kind="event", name=matchstr,
+                options=json.dumps(filters)).addErrback(log.err)
+
+    def unlisten_for_event(self, matchstr, obj_to_notify, **filters):
+        super(_ChildTransport, self).unlisten_for_event(matchstr, obj_to_notify, **filters)
+        self.protocol.callRemote(Unsubscribe, kind="event", name=matchstr,
+                options=json.dumps(filters)).addErrback(log.err)
+
+    def provides_request(self, name, obj_to_notify, **options):
+        # Any caching or coalescing is done by the bot's transport
+        super(_ChildTransport, self).provides_request(name, obj_to_notify)
+        self.protocol.callRemote(Subscribe, kind="request", name=name,
+                options=json.dumps(options)).addErrback(log.err)
+
+    def send_event(self, event):
+        self.protocol.send_event(event)
+
+    def issue_request(self, name, *args, **kwargs):
+        return self.protocol.issue_request(name, args, kwargs)
+
+class _NickMirror(object):
+    """Installed as loaded_plugins['irc.IRCBotPlugin'] in the child, since
+    some code looks up the bot's nick there. Keeps .client.nickname up to date.
+
+    """
+    plugin_name = "remote.NickMirror"
+
+    def __init__(self, transport):
+        self.client = self
+        self.nickname = None
+        self.transport = transport
+        transport.listen_for_event("irc.on_signed_on", self)
+        transport.listen_for_event("irc.on_self_nick_change", self)
+        self.refresh()
+
+    def refresh(self):
+        def got_nick(nick):
+            self.nickname = nick
+        self.transport.issue_request("irc.getnick").addCallbacks(got_nick,
+                lambda f: log.msg("Could not get the nick: {0}".format(f.getErrorMessage())))
+
+    def received_event(self, event):
+        self.refresh()
+
+class _ChildPluginBoss(PluginBoss):
+    def _seed_defaults(self):
+        raise SystemExit("Could not read the config")
+
+    def save(self):
+        # The bot's process owns the master config
+        pass
+
+    def _get_plugin_class(self, plugin_name):
+        # We're the process it's supposed to run in
+        return self._import_plugin_class(plugin_name)
+
+def main():
+    from twisted.internet import stdio
+
+    configdir, plugin_name = sys.argv[1:3]
+    log.startLogging(sys.stderr)
+    transport = _ChildTransport()
+    pluginboss = _ChildPluginBoss(configdir, transport)
+    stdio.StandardIO(_ChildProtocol(transport, pluginboss, plugin_name),
+            stdin=3, stdout=4)
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
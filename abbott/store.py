@@ -0,0 +1,182 @@
+import json
+import sqlite3
+from contextlib import contextmanager
+
+"""
+Transactional storage for plugin state.
+
+Plugin configs are JSON files that are rewritten in full on every save, which
+is fine for settings but not for large state that changes all the time, like
+per-user counters. For that, each plugin has a PluginStore as self.store, kept
+in a SQLite database ("state.sqlite3" in the config directory) that all
+plugins share. Updating one entry only writes that entry.
+
+A store is a dict-like mapping of string keys to values, which must be
+representable in JSON (tuples come back as lists). It also has named tables,
+from store.table(name), which are separate mappings of the same kind::
+
+    self.store['last_drawing'] = time.time()
+    counter = self.store.table("counter")
+    counter.increment(nick)
+
+Each change is committed right away, unless it's made inside a transaction,
+in which case all of the transaction's changes are committed together (or not
+at all, if the block raises an exception). Use a transaction to batch many
+changes into one commit::
+
+    with self.store.transaction():
+        for nick, count in counter.items():
+            counter[nick] = count // 2
+
+The database is in WAL mode, so commits are cheap and other processes (such as
+plugins running out of process) can read it while the bot writes. It must only
+be used from the reactor thread, not from functions given to offload().
+
+"""
+
+_missing = object()
+
+class Database(object):
+    """A connection to the database file, shared by all the plugins' stores"""
+    def __init__(self, path):
+        # Autocommit mode. Transactions are managed by transaction() instead
+        # of the sqlite3 module.
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode this is still safe from corruption; a power loss may
+        # only lose the last commits
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS plugin_state (
+            plugin TEXT NOT NULL,
+            tbl TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (plugin, tbl, key)
+            ) WITHOUT ROWID""")
+        self._depth = 0
+
+    def execute(self, sql, params=()):
+        return self._conn.execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """Commits the changes made in the with block together. Transactions
+        may be nested; an exception rolls back the innermost one.
+
+        """
+        savepoint = "s{0}".format(self._depth)
+        self._conn.execute("SAVEPOINT " + savepoint)
+        self._depth += 1
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK TO " + savepoint)
+            self._conn.execute("RELEASE " + savepoint)
+            raise
+        else:
+            self._conn.execute("RELEASE " + savepoint)
+        finally:
+            self._depth -= 1
+
+    def close(self):
+        self._conn.close()
+
+class StoreTable(object):
+    """A mapping of string keys to JSON values, stored in the database under
+    a plugin and table name
+
+    """
+    def __init__(self, database, plugin_name, table_name):
+        self._db = database
+        self._where = (plugin_name, table_name)
+
+    def get(self, key, default=None):
+        row = self._db.execute(
+                "SELECT value FROM plugin_state "
+                "WHERE plugin=? AND tbl=? AND key=?",
+                self._where + (key,)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._db.execute(
+                "INSERT OR REPLACE INTO plugin_state (plugin, tbl, key, value) "
+                "VALUES (?, ?, ?, ?)",
+                self._where + (key, json.dumps(value)))
+
+    def __delitem__(self, key):
+        cursor = self._db.execute(
+                "DELETE FROM plugin_state WHERE plugin=? AND tbl=? AND key=?",
+                self._where + (key,))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._db.execute(
+                "SELECT 1 FROM plugin_state WHERE plugin=? AND tbl=? AND key=?",
+                self._where + (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._db.execute(
+                "SELECT count(*) FROM plugin_state WHERE plugin=? AND tbl=?",
+                self._where).fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [row[0] for row in self._db.execute(
+                "SELECT key FROM plugin_state WHERE plugin=? AND tbl=? "
+                "ORDER BY key", self._where)]
+
+    def items(self):
+        return [(key, json.loads(value)) for key, value in self._db.execute(
+                "SELECT key, value FROM plugin_state WHERE plugin=? AND tbl=? "
+                "ORDER BY key", self._where)]
+
+    def update(self, mapping):
+        with self._db.transaction():
+            for key, value in mapping.items():
+                self[key] = value
+
+    def increment(self, key, amount=1):
+        """Adds amount to the number stored under key (0 if there is none)
+        and returns the new value
+
+        """
+        with self._db.transaction():
+            value = self.get(key, 0) + amount
+            self[key] = value
+        return value
+
+    def clear(self):
+        self._db.execute(
+                "DELETE FROM plugin_state WHERE plugin=? AND tbl=?",
+                self._where)
+
+    def transaction(self):
+        return self._db.transaction()
+
+class PluginStore(StoreTable):
+    """Installed in plugins as self.store. Itself a StoreTable for simple
+    key-value storage, and table() returns the plugin's other tables.
+
+    """
+    def __init__(self, database, plugin_name):
+        super(PluginStore, self).__init__(database, plugin_name, "")
+        self._plugin_name = plugin_name
+
+    def table(self, name):
+        return StoreTable(self._db, self._plugin_name, name)
+
+    def drop(self):
+        """Deletes everything the plugin has stored, in every table"""
+        self._db.execute("DELETE FROM plugin_state WHERE plugin=?",
+                (self._plugin_name,))
@@ -1,6 +1,12 @@
+import json
+import os
 import unittest
 
+from twisted.trial import unittest as trial_unittest
+
+from abbott.pluginbase import PluginBoss
 from abbott.plugins.auth import satisfies
+from abbott.transport import Transport
 
 class TestSatisfies(unittest.TestCase):
 
@@ -60,6 +66,33 @@ class TestSatisfies(unittest.TestCase):
         self.assertFalse(satisfies("admin.bar.baz", "admin.*.foo"))
         self.assertFalse(satisfies("admin.bar.biz", "admin.*.foo"))
 
+class TestStateHandover(trial_unittest.TestCase):
+
+    def setUp(self):
+        configdir = self.mktemp()
+        os.mkdir(configdir)
+        with open(os.path.join(configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": []}}, out)
+        self.boss = PluginBoss(configdir, Transport())
+        self.successResultOf(self.boss.load_plugin("auth.Auth"))
+
+    def test_reload_keeps_identified_users(self):
+        old = self.boss.loaded_plugins['auth.Auth']
+        old.authd_users["alice!a@example.com"] = "alice"
+        old.authd_users["bob!b@example.com"] = None
+        old.permissions["alice"].append((None, "admin"))
+        old.config.save()
+
+        state = old.export_state()
+        self.boss.unload_plugin("auth.Auth")
+        self.successResultOf(self.boss.load_plugin("auth.Auth", state=state))
+        new = self.boss.loaded_plugins['auth.Auth']
+        self.assertIsNot(old, new)
+        self.assertEqual({"alice!a@example.com": "alice"}, new.authd_users)
+
+        # Answered from the handed over state, without a whois
+        self.assertEqual([(None, "admin")], list(self.successResultOf(
+            new._get_permissions("alice!a@example.com"))))
+
 if __name__ == "__main__":
     unittest.main()
-
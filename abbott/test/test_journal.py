@@ -0,0 +1,76 @@
+from io import BytesIO
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ..transport import Transport, Event
+from .. import journal
+
+
+class Recorder(object):
+    def __init__(self):
+        self.plugin_name = "recorder"
+        self.events = []
+
+    def received_event(self, event):
+        self.events.append(event)
+
+
+class TestJournal(unittest.TestCase):
+
+    def write(self, *events):
+        out = BytesIO()
+        writer = journal.JournalWriter(out)
+        for timestamp, event in events:
+            writer.write(event, timestamp)
+        return BytesIO(out.getvalue())
+
+    def test_round_trip(self):
+        f = self.write(
+                (100.0, Event("irc.on_privmsg", user="a!b@c", channel="#foo",
+                    message="hi", reply=lambda msg: None)),
+                (101.5, Event("irc.do_msg", user="#foo", message="hello")),
+                )
+        records = list(journal.read_journal(f))
+        self.assertEqual([100.0, 101.5], [t for t, _ in records])
+        event = records[0][1]
+        self.assertEqual("irc.on_privmsg", event.eventtype)
+        self.assertEqual("hi", event.message)
+        # Callables aren't recorded
+        self.assertFalse(hasattr(event, "reply"))
+
+    def test_truncated(self):
+        data = self.write((1.0, Event("a.b")), (2.0, Event("a.c"))).getvalue()
+        records = list(journal.read_journal(BytesIO(data[:-3])))
+        self.assertEqual(1, len(records))
+
+    def test_bad_magic(self):
+        self.assertRaises(journal.JournalError, list,
+                journal.read_journal(BytesIO(b"nope")))
+
+    def test_replay_scaled(self):
+        clock = task.Clock()
+        transport = Transport()
+        r = Recorder()
+        transport.listen_for_event("*.*", r)
+        records = [(100.0, Event("irc.on_a")), (102.0, Event("irc.do_b")),
+                (104.0, Event("irc.on_c"))]
+        d = journal.replay(records, transport, speed=2, match=["irc.on_*"],
+                clock=clock)
+        clock.advance(0)
+        self.assertEqual(["irc.on_a"], [e.eventtype for e in r.events])
+        clock.advance(1.9)
+        self.assertEqual(1, len(r.events))
+        clock.advance(0.1)
+        self.assertEqual(2, len(r.events))
+        d.addCallback(self.assertEqual, 2)
+        return d
+
+    def test_replay_max_speed(self):
+        transport = Transport()
+        r = Recorder()
+        transport.listen_for_event("*.*", r)
+        records = [(float(i), Event("irc.on_a")) for i in range(100)]
+        d = journal.replay(records, transport, speed=None)
+        d.addCallback(self.assertEqual, 100)
+        return d
@@ -0,0 +1,143 @@
+from twisted.test import iosim
+from twisted.trial import unittest
+
+from ..transport import Transport, Event
+from .. import remote
+
+
+class Recorder(object):
+    def __init__(self, name):
+        self.plugin_name = name
+        self.events = []
+
+    def received_event(self, event):
+        self.events.append(event)
+
+    def incoming_request(self, name, *args, **kwargs):
+        return [name, list(args), kwargs]
+
+
+class StubBoss(object):
+    """Loads a Recorder for any plugin name, which listens for irc.on_* and
+    provides test.echo
+
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.loaded_plugins = {}
+
+    def load_plugin(self, plugin_name):
+        plugin = Recorder(plugin_name)
+        self.transport.listen_for_event("irc.on_*", plugin)
+        self.transport.listen_for_event("irc.on_privmsg", plugin,
+                channel="#foo")
+        self.transport.provides_request("test.echo", plugin)
+        self.loaded_plugins[plugin_name] = plugin
+
+
+class StubRemotePlugin(remote.RemotePlugin):
+    """A RemotePlugin that doesn't spawn a process or read any config"""
+    def __init__(self, transport):
+        self.plugin_name = "test.Remote"
+        self.transport = transport
+        self.protocol = None
+        self.stopping = False
+        self._last_event = None
+
+
+class TestRemote(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.nick_requests = 0
+        def getnick():
+            self.nick_requests += 1
+            return "abbott"
+        nick_provider = Recorder("irc.IRCBotPlugin")
+        nick_provider.incoming_request = lambda name: getnick()
+        self.transport.provides_request("irc.getnick", nick_provider)
+
+        self.proxy = StubRemotePlugin(self.transport)
+        self.proxy.protocol = remote._ParentProtocol(self.proxy)
+
+        self.child_transport = remote._ChildTransport()
+        self.boss = StubBoss(self.child_transport)
+        child = remote._ChildProtocol(self.child_transport, self.boss,
+                "test.Remote")
+
+        self.pump = iosim.connect(
+                child, iosim.makeFakeServer(child),
+                self.proxy.protocol, iosim.makeFakeClient(self.proxy.protocol))
+        self.child_plugin = self.boss.loaded_plugins["test.Remote"]
+
+    def test_nick_mirrored(self):
+        nick = self.boss.loaded_plugins['irc.IRCBotPlugin'].client.nickname
+        self.assertEqual("abbott", nick)
+        self.transport.send_event(Event("irc.on_self_nick_change",
+            newnick="abbott"))
+        self.pump.flush()
+        self.assertEqual(2, self.nick_requests)
+
+    def test_events_forwarded_once(self):
+        replies = []
+        event = Event("irc.on_privmsg", channel="#foo", message="hi",
+                reply=replies.append)
+        self.transport.send_event(event)
+        self.transport.send_event(Event("irc.do_msg"))
+        self.pump.flush()
+
+        # One delivery for irc.on_*, one for the channel filter. Not four.
+        self.assertEqual(2, len(self.child_plugin.events))
+        received = self.child_plugin.events[0]
+        self.assertEqual("hi", received.message)
+
+        # Callables are proxied back to the parent
+        received.reply("hello")
+        self.pump.flush()
+        self.assertEqual(["hello"], replies)
+
+    def test_lazy_attributes_forwarded(self):
+        provider = Recorder("auth.Auth")
+        checked = []
+        def has_permission(event):
+            def check(perm):
+                checked.append(perm)
+                return True
+            return check
+        self.transport.provide_event_attribute("irc.on_privmsg",
+                "has_permission", provider, has_permission)
+        self.transport.send_event(Event("irc.on_privmsg", channel="#bar",
+            message="hi"))
+        self.pump.flush()
+
+        received = self.child_plugin.events[0]
+        results = []
+        received.has_permission("test.perm").addCallback(results.append)
+        self.pump.flush()
+        self.assertEqual(["test.perm"], checked)
+        self.assertEqual([True], results)
+
+    def test_events_from_child(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("test.*", r)
+        self.child_transport.send_event(Event("test.thing", value=(1, 2)))
+        self.pump.flush()
+        self.assertEqual([1, 2], r.events[0].value)
+
+    def test_requests(self):
+        results = []
+        self.transport.issue_request("test.echo", "a", b=1).addCallback(
+                results.append)
+        self.pump.flush()
+        self.assertEqual([["test.echo", ["a"], {"b": 1}]], results)
+
+    def test_request_failure(self):
+        d = self.child_transport.issue_request("test.missing")
+        self.assertFailure(d, remote.RemoteError)
+        self.pump.flush()
+        return d
+
+    def test_no_middleware(self):
+        self.assertRaises(NotImplementedError,
+                self.child_transport.install_middleware, "irc.*",
+                self.child_plugin)
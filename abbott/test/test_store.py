@@ -0,0 +1,82 @@
+from twisted.trial import unittest
+
+from .. import store
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.db = store.Database(self.path)
+        self.addCleanup(self.db.close)
+        self.store = store.PluginStore(self.db, "test.Plugin")
+
+    def test_key_value(self):
+        self.store['a'] = {"b": [1, 2]}
+        self.assertEqual({"b": [1, 2]}, self.store['a'])
+        self.assertIn('a', self.store)
+        self.assertEqual(None, self.store.get('missing'))
+        self.assertRaises(KeyError, lambda: self.store['missing'])
+
+        del self.store['a']
+        self.assertNotIn('a', self.store)
+        self.assertRaises(KeyError, self.store.__delitem__, 'a')
+
+    def test_tables_are_separate(self):
+        counter = self.store.table("counter")
+        other = store.PluginStore(self.db, "test.Other")
+        self.store['x'] = 1
+        counter['x'] = 2
+        other['x'] = 3
+        self.assertEqual(1, self.store['x'])
+        self.assertEqual(2, counter['x'])
+        self.assertEqual(3, other['x'])
+        self.assertEqual(1, len(counter))
+
+        self.store.drop()
+        self.assertEqual(0, len(self.store) + len(counter))
+        self.assertEqual(3, other['x'])
+
+    def test_increment(self):
+        counter = self.store.table("counter")
+        self.assertEqual(1, counter.increment("alice"))
+        self.assertEqual(6, counter.increment("alice", 5))
+        counter.increment("bob")
+        self.assertEqual([("alice", 6), ("bob", 1)], counter.items())
+
+    def test_transaction_rollback(self):
+        counter = self.store.table("counter")
+        counter['alice'] = 1
+        try:
+            with self.store.transaction():
+                counter['alice'] = 2
+                with self.store.transaction():
+                    counter['bob'] = 1
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual([("alice", 1)], counter.items())
+
+    def test_nested_rollback(self):
+        """An exception caught inside a transaction only rolls back the inner
+        transaction
+
+        """
+        with self.store.transaction():
+            self.store['a'] = 1
+            try:
+                with self.store.transaction():
+                    self.store['b'] = 1
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.assertEqual(['a'], self.store.keys())
+
+    def test_persists(self):
+        with self.store.transaction():
+            self.store.update({"a": 1, "b": 2})
+        self.db.close()
+        self.db = store.Database(self.path)
+        self.addCleanup(self.db.close)
+        self.assertEqual([("a", 1), ("b", 2)],
+                store.PluginStore(self.db, "test.Plugin").items())
@@ -0,0 +1,76 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ..timerwheel import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000.1)
+        self.wheel = TimerWheel(resolution=1, slots=4, levels=3,
+                clock=self.clock)
+        self.fired = []
+
+    def add(self, delay):
+        return self.wheel.call_later(delay, self.fired.append, delay)
+
+    def test_fires_on_time(self):
+        for delay in [100, 0.5, 3, 7, 20, 64]:
+            self.add(delay)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.clock.pump([0.5] * 300)
+        self.assertEqual([0.5, 3, 7, 20, 64, 100], self.fired)
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_never_early(self):
+        delays = [0.5, 1, 1.5, 4, 4.9, 15, 16, 17, 70]
+        fired_at = {}
+        for delay in delays:
+            self.wheel.call_later(delay, fired_at.__setitem__, delay, None)
+        start = self.clock.seconds()
+        for _ in range(200):
+            self.clock.advance(0.5)
+            for delay in delays:
+                if delay in fired_at and fired_at[delay] is None:
+                    fired_at[delay] = self.clock.seconds() - start
+        for delay in delays:
+            self.assertTrue(delay <= fired_at[delay] < delay + 1.5,
+                    (delay, fired_at[delay]))
+
+    def test_cancel(self):
+        timer = self.add(10)
+        self.add(20)
+        self.assertTrue(timer.active())
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertRaises(ValueError, timer.cancel)
+        self.assertEqual(1, len(self.wheel))
+        self.clock.pump([1] * 30)
+        self.assertEqual([20], self.fired)
+
+    def test_idle_and_restart(self):
+        self.add(2)
+        self.clock.pump([1] * 5)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.clock.advance(1000)
+        self.add(2)
+        self.clock.pump([1] * 5)
+        self.assertEqual([2, 2], self.fired)
+
+    def test_add_from_callback(self):
+        def again():
+            self.fired.append("first")
+            self.add(3)
+        self.wheel.call_later(1, again)
+        self.clock.pump([1] * 10)
+        self.assertEqual(["first", 3], self.fired)
+
+    def test_callback_error(self):
+        self.wheel.call_later(1, lambda: 1/0)
+        self.add(1)
+        self.clock.pump([1] * 3)
+        self.assertEqual(1, len(self.flushLoggedErrors(ZeroDivisionError)))
+        self.assertEqual([1], self.fired)
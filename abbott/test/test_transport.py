@@ -0,0 +1,704 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ..transport import Transport, Event, LatencyHistogram
+from ..transport import event_class, make_event, event_attrs, _event_classes
+
+
+class Recorder(object):
+    """A stand-in for a plugin that records what the transport delivers to
+    it
+
+    """
+    def __init__(self, name, swallow=False):
+        self.plugin_name = name
+        self.swallow = swallow
+        self.events = []
+        self.middleware_events = []
+
+    def received_event(self, event):
+        self.events.append(event.eventtype)
+
+    def received_middleware_event(self, event):
+        self.middleware_events.append(event.eventtype)
+        if self.swallow:
+            return None
+        return event
+
+
+class Provider(Recorder):
+    """Answers any request with the number of times it has been asked"""
+    def __init__(self, name):
+        super(Provider, self).__init__(name)
+        self.calls = 0
+
+    def incoming_request(self, name, *args, **kwargs):
+        self.calls += 1
+        return self.calls
+
+
+class TestRouting(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+
+    def test_exact_and_glob(self):
+        exact = Recorder("exact")
+        glob = Recorder("glob")
+        everything = Recorder("everything")
+        self.transport.listen_for_event("irc.on_privmsg", exact)
+        self.transport.listen_for_event("irc.on_*", glob)
+        self.transport.listen_for_event("*.*", everything)
+
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.do_msg"))
+        self.transport.send_event(Event("irc.on_privmsg.extra"))
+
+        self.assertEqual(["irc.on_privmsg"], exact.events)
+        self.assertEqual(["irc.on_privmsg"], glob.events)
+        self.assertEqual(["irc.on_privmsg", "irc.do_msg"], everything.events)
+
+    def test_globs_do_not_transcend_dots(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.*", r)
+        self.transport.send_event(Event("irc.on.privmsg"))
+        self.transport.send_event(Event("irc"))
+        self.assertEqual([], r.events)
+
+    def test_middleware_swallows(self):
+        mw = Recorder("mw", swallow=True)
+        r = Recorder("r")
+        self.transport.install_middleware("irc.on_*", mw)
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(["irc.on_privmsg"], mw.middleware_events)
+        self.assertEqual([], r.events)
+
+    def test_middleware_priority(self):
+        """Middleware is called lowest priority first, then in the order it
+        was installed, regardless of how specific its pattern is
+
+        """
+        order = []
+        class Ordered(Recorder):
+            def received_middleware_event(self, event):
+                order.append(self.plugin_name)
+                return event
+        self.transport.install_middleware("irc.on_privmsg", Ordered("b"))
+        self.transport.install_middleware("*.*", Ordered("c"))
+        self.transport.install_middleware("irc.on_*", Ordered("a"),
+                priority=-10)
+        self.transport.install_middleware("irc.*", Ordered("d"), priority=5)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(["a", "b", "c", "d"], order)
+
+    def test_middleware_counts(self):
+        class Replacer(Recorder):
+            def received_middleware_event(self, event):
+                return Event(event.eventtype, replaced=True)
+        r = Recorder("r")
+        self.transport.install_middleware("irc.on_*", Replacer("replacer"))
+        self.transport.install_middleware("irc.on_privmsg",
+                Recorder("swallower", swallow=True), priority=1)
+        self.transport.install_middleware("irc.*", Recorder("passer"))
+        self.transport.listen_for_event("irc.on_*", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_join"))
+
+        self.assertEqual(["irc.on_join"], r.events)
+        stats = self.transport.middleware_stats()
+        self.assertEqual(dict(swallowed=0, replaced=1),
+                stats["replacer", "irc.on_privmsg"])
+        self.assertEqual(dict(swallowed=0, replaced=1),
+                stats["replacer", "irc.on_join"])
+        self.assertEqual(dict(swallowed=1, replaced=0),
+                stats["swallower", "irc.on_privmsg"])
+        self.assertEqual(dict(swallowed=0, replaced=0),
+                stats["passer", "irc.on_join"])
+
+    def test_route_invalidated_on_listen(self):
+        first = Recorder("first")
+        second = Recorder("second")
+        self.transport.listen_for_event("irc.on_privmsg", first)
+        self.transport.send_event(Event("irc.on_privmsg"))
+
+        self.transport.listen_for_event("irc.*", second)
+        self.transport.send_event(Event("irc.on_privmsg"))
+
+        self.assertEqual(2, len(first.events))
+        self.assertEqual(1, len(second.events))
+
+    def test_route_invalidated_on_unhook(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.unhook_plugin(r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(1, len(r.events))
+
+    def test_unhook_only_that_plugin(self):
+        r = Provider("r")
+        other = Provider("other")
+        for obj in (r, other):
+            self.transport.install_middleware("irc.on_*", obj)
+            self.transport.listen_for_event("irc.on_privmsg", obj,
+                    channel="#foo")
+            self.transport.provide_event_attribute("irc.on_*", "x", obj,
+                    lambda event: 1)
+        self.transport.provides_request("test.r", r)
+        self.transport.provides_request("test.shared", r)
+        # Takes over test.shared from r
+        self.transport.provides_request("test.shared", other)
+
+        self.transport.unhook_plugin(r)
+        self.assertEqual([], self.transport.subscriptions(r))
+        self.transport.send_event(Event("irc.on_privmsg", channel="#foo"))
+        self.assertEqual([], r.middleware_events + r.events)
+        self.assertEqual(["irc.on_privmsg"], other.middleware_events)
+        self.assertEqual(["irc.on_privmsg"], other.events)
+        self.failureResultOf(self.transport.issue_request("test.r"),
+                NotImplementedError)
+        self.assertEqual(1, self.successResultOf(
+            self.transport.issue_request("test.shared")))
+
+    def test_subscriptions(self):
+        r = Provider("r")
+        self.transport.install_middleware("irc.on_*", r, priority=3)
+        self.transport.listen_for_event("irc.on_privmsg", r, channel="#foo")
+        self.transport.listen_for_event("irc.on_privmsg", Recorder("other"),
+                channel="#foo")
+        self.transport.listen_for_event("irc.do_msg", r)
+        self.transport.unlisten_for_event("irc.do_msg", r)
+        self.transport.provide_event_attribute("irc.on_*", "x", r,
+                lambda event: 1)
+        self.transport.provides_request("test.r", r)
+        self.assertEqual([
+            dict(kind="attribute", name="irc.on_*", attribute="x"),
+            dict(kind="event", name="irc.on_privmsg",
+                filters=dict(channel="#foo"), shared=1),
+            dict(kind="middleware", name="irc.on_*", priority=3),
+            dict(kind="request", name="test.r"),
+            ], self.transport.subscriptions(r))
+
+    def test_unhook_during_dispatch(self):
+        """A listener removed by an earlier listener of the same event is not
+        called
+
+        """
+        victim = Recorder("victim")
+        transport = self.transport
+
+        class Remover(Recorder):
+            def received_event(self, event):
+                transport.unhook_plugin(victim)
+
+        # Register the remover under its own pattern so it comes first
+        transport.listen_for_event("irc.on_privmsg", Remover("remover"))
+        transport.listen_for_event("irc.*", victim)
+        transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual([], victim.events)
+
+    def test_partial_segment_globs(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_*", r)
+        self.transport.listen_for_event("*.do_*_channel", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_"))
+        self.transport.send_event(Event("irc.do_join_channel"))
+        self.transport.send_event(Event("irc.do_msg"))
+        self.assertEqual(["irc.on_privmsg", "irc.do_join_channel"], r.events)
+
+    def test_overlapping_patterns(self):
+        """An object subscribed under two matching patterns is called for
+        each of them
+
+        """
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        self.transport.listen_for_event("irc.*", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual(2, len(r.events))
+
+class TestFilters(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+
+    def test_filter_matches_value(self):
+        foo = Recorder("foo")
+        bar = Recorder("bar")
+        self.transport.listen_for_event("irc.on_privmsg", foo, channel="#foo")
+        self.transport.listen_for_event("irc.on_*", bar, channel="#bar")
+
+        self.transport.send_event(Event("irc.on_privmsg", channel="#foo"))
+        self.transport.send_event(Event("irc.on_privmsg", channel="#bar"))
+        self.transport.send_event(Event("irc.on_privmsg", channel="#baz"))
+        self.transport.send_event(Event("irc.on_privmsg"))
+
+        self.assertEqual(1, len(foo.events))
+        self.assertEqual(1, len(bar.events))
+
+    def test_multiple_filters(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_privmsg", r,
+                channel="#foo", user="alice")
+        self.transport.send_event(Event("irc.on_privmsg",
+            channel="#foo", user="bob"))
+        self.transport.send_event(Event("irc.on_privmsg",
+            channel="#foo", user="alice"))
+        self.assertEqual(1, len(r.events))
+
+    def test_filtered_and_unfiltered(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_privmsg", r)
+        self.transport.listen_for_event("irc.on_privmsg", r, channel="#foo")
+        self.transport.send_event(Event("irc.on_privmsg", channel="#foo"))
+        self.transport.send_event(Event("irc.on_privmsg", channel="#bar"))
+        self.assertEqual(3, len(r.events))
+
+    def test_unlisten(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_privmsg", r, channel="#foo")
+        self.transport.listen_for_event("irc.on_privmsg", r, channel="#bar")
+        self.transport.unlisten_for_event("irc.on_privmsg", r, channel="#foo")
+        self.transport.send_event(Event("irc.on_privmsg", channel="#foo"))
+        self.transport.send_event(Event("irc.on_privmsg", channel="#bar"))
+        self.assertEqual(1, len(r.events))
+
+    def test_unhook_removes_filtered(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_privmsg", r, channel="#foo")
+        self.transport.unhook_plugin(r)
+        self.transport.send_event(Event("irc.on_privmsg", channel="#foo"))
+        self.assertEqual([], r.events)
+
+    def test_unhashable_value(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.on_privmsg", r, channel="#foo")
+        self.transport.send_event(Event("irc.on_privmsg", channel=["#foo"]))
+        self.assertEqual([], r.events)
+
+class TestQueued(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.transport = Transport()
+        self.transport.set_queued_dispatch(slice_size=2, max_depth=3,
+                shed=["irc.on_privmsg"], clock=self.clock)
+
+    def step(self):
+        """Runs the calls currently scheduled, like one reactor iteration.
+        (Clock.advance() would also run the calls they schedule)
+
+        """
+        for call in self.clock.getDelayedCalls():
+            self.clock.calls.remove(call)
+            call.func(*call.args, **call.kw)
+
+    def test_send_returns_before_dispatch(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.*", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.assertEqual([], r.events)
+        self.step()
+        self.assertEqual(["irc.on_privmsg"], r.events)
+
+    def test_drains_in_slices(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.*", r)
+        for _ in range(3):
+            self.transport.send_event(Event("irc.do_msg"))
+        self.step()
+        self.assertEqual(2, len(r.events))
+        self.step()
+        self.assertEqual(3, len(r.events))
+        self.assertEqual(0, self.transport.queue_depth())
+
+    def test_handler_events_do_not_recurse(self):
+        transport = self.transport
+        order = []
+
+        class Echo(Recorder):
+            def received_event(self, event):
+                order.append(event.eventtype)
+                if event.eventtype == "irc.on_privmsg":
+                    transport.send_event(Event("irc.do_msg"))
+                    order.append("returned")
+
+        transport.listen_for_event("irc.*", Echo("echo"))
+        transport.send_event(Event("irc.on_privmsg"))
+        self.step()
+        self.assertEqual(["irc.on_privmsg", "returned", "irc.do_msg"], order)
+
+    def test_shed_past_max_depth(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.*", r)
+        for _ in range(5):
+            self.transport.send_event(Event("irc.on_privmsg"))
+        # Events not configured as sheddable are queued regardless
+        self.transport.send_event(Event("irc.do_msg"))
+        self.assertEqual(4, self.transport.queue_depth())
+        self.assertEqual(2, self.transport.shed_counts["irc.on_privmsg"])
+
+        self.step()
+        self.step()
+        self.assertEqual(["irc.on_privmsg"] * 3 + ["irc.do_msg"], r.events)
+
+    def test_disable_flushes(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.*", r)
+        self.transport.send_event(Event("irc.do_msg"))
+        self.transport.set_queued_dispatch(False)
+        self.assertEqual(["irc.do_msg"], r.events)
+        self.transport.send_event(Event("irc.do_msg"))
+        self.assertEqual(2, len(r.events))
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_lanes(self):
+        self.transport.set_queued_dispatch(slice_size=10, max_depth=3,
+                lanes={"irc.do_*": 0, "irc.do_msg": 2, "irc.on_privmsg": 2},
+                default_lane=1, shed_lane=2, clock=self.clock)
+        r = Recorder("r")
+        self.transport.listen_for_event("*.*", r)
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("irc.on_join"))
+        self.transport.send_event(Event("irc.do_msg"))
+        self.transport.send_event(Event("irc.do_kick"))
+        # irc.do_msg matches both lane 0 and lane 2 globs
+        self.assertEqual([2, 1, 1], self.transport.lane_depths())
+
+        # The queue is full, so only the low priority lane is shed
+        self.transport.send_event(Event("irc.on_privmsg"))
+        self.transport.send_event(Event("test.thing"))
+        self.assertEqual(1, self.transport.shed_counts["irc.on_privmsg"])
+
+        self.step()
+        self.assertEqual(["irc.do_msg", "irc.do_kick", "irc.on_join",
+            "test.thing", "irc.on_privmsg"], r.events)
+
+    def test_urgent_events_jump_ahead(self):
+        """An event queued for a higher priority lane while a slice is being
+        dispatched is dispatched next
+
+        """
+        self.transport.set_queued_dispatch(slice_size=10,
+                lanes={"irc.do_kick": 0}, default_lane=1, clock=self.clock)
+        transport = self.transport
+        class Kicker(Recorder):
+            def received_event(self, event):
+                super(Kicker, self).received_event(event)
+                if event.eventtype == "irc.on_privmsg":
+                    transport.send_event(Event("irc.do_kick"))
+        r = Kicker("r")
+        transport.listen_for_event("irc.*", r)
+        transport.send_event(Event("irc.on_privmsg"))
+        transport.send_event(Event("irc.on_join"))
+        self.step()
+        self.assertEqual(["irc.on_privmsg", "irc.do_kick", "irc.on_join"],
+                r.events)
+
+    def test_reconfigure_keeps_queued(self):
+        r = Recorder("r")
+        self.transport.listen_for_event("irc.*", r)
+        self.transport.send_event(Event("irc.on_join"))
+        self.transport.send_event(Event("irc.do_kick"))
+        self.transport.set_queued_dispatch(lanes={"irc.do_kick": 0},
+                default_lane=1, clock=self.clock)
+        self.step()
+        self.assertEqual(["irc.do_kick", "irc.on_join"], r.events)
+
+class TestLatency(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+        histogram = LatencyHistogram()
+        histogram.record(0.00005)
+        histogram.record(0.002)
+        histogram.record(0.002)
+        histogram.record(5)
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(5, histogram.max)
+        self.assertEqual(1, histogram.counts[0])
+        self.assertEqual(2, histogram.counts[3])
+        self.assertEqual(1, histogram.counts[-1])
+        self.assertEqual(0.005, histogram.percentile(50))
+        self.assertEqual(None, histogram.percentile(99))
+
+    def test_dispatch_is_timed(self):
+        transport = Transport()
+        r = Recorder("r")
+        mw = Recorder("mw")
+        transport.install_middleware("irc.*", mw)
+        transport.listen_for_event("irc.*", r)
+        transport.send_event(Event("irc.on_privmsg"))
+        transport.send_event(Event("irc.on_privmsg"))
+
+        stats = transport.latency_stats()
+        self.assertEqual(2, stats[("r", "event", "irc.on_privmsg")].count)
+        self.assertEqual(2,
+                stats[("mw", "middleware", "irc.on_privmsg")].count)
+
+    def test_requests_are_timed(self):
+        transport = Transport()
+        transport.provides_request("test.answer", Provider("p"))
+        d = transport.issue_request("test.answer")
+        d.addCallback(self.assertEqual, 1)
+        self.assertEqual(1,
+                transport.latency_stats()[("p", "request", "test.answer")].count)
+        return d
+
+class TestEventClasses(unittest.TestCase):
+
+    def setUp(self):
+        self.cls = event_class("test.on_slotted", ["user", "message"])
+
+    def tearDown(self):
+        _event_classes.pop("test.on_slotted")
+
+    def test_make_event(self):
+        event = make_event("test.on_slotted", user="alice", message="hi")
+        self.assertIsInstance(event, self.cls)
+        self.assertEqual("test.on_slotted", event.eventtype)
+        self.assertEqual("alice", event.user)
+        self.assertEqual({}, event.__dict__)
+        self.assertIs(Event, type(make_event("test.on_other", user="bob")))
+
+    def test_no_instance_dict(self):
+        """Events with only their declared attributes set never get an
+        instance dict, even when their attributes are read or changed
+
+        """
+        import gc
+        event = make_event("test.on_slotted", user="alice", message="hi")
+        event.message = event.message + "!"
+        self.assertFalse(hasattr(event, "direct"))
+        self.assertFalse([x for x in gc.get_referents(event)
+            if isinstance(x, dict)])
+        self.assertEqual(dict(user="alice", message="hi!"),
+                event_attrs(event))
+
+    def test_speed(self):
+        """Creating a slotted event and setting its attributes take about as
+        long as for an event that keeps them in its dict. (A __setattr__ hook
+        once made them several times slower.)
+
+        """
+        import timeit
+        def compare(slotted, plain):
+            return (min(timeit.repeat(slotted, repeat=5, number=20000)) /
+                    min(timeit.repeat(plain, repeat=5, number=20000)))
+        self.assertLess(compare(
+            lambda: make_event("test.on_slotted", user="a", message="m"),
+            lambda: Event("test.on_slotted", user="a", message="m")), 2)
+        slotted = make_event("test.on_slotted", user="a")
+        plain = Event("test.on_slotted", user="a")
+        def set_slotted():
+            slotted.user = "b"
+        def set_plain():
+            plain.user = "b"
+        self.assertLess(compare(set_slotted, set_plain), 2)
+
+    def test_invalid_field(self):
+        self.assertRaises(ValueError, event_class, "test.on_bad", ["a-b"])
+        self.assertRaises(ValueError, event_class, "test.on_bad", ["class"])
+        self.assertRaises(ValueError, event_class, "test.on_bad",
+                ["eventtype"])
+        self.assertNotIn("test.on_bad", _event_classes)
+
+    def test_extra_attributes(self):
+        event = make_event("test.on_slotted", user="alice", direct=True)
+        event.reply = len
+        self.assertTrue(event.direct)
+        self.assertFalse(hasattr(event, "message"))
+        self.assertEqual(dict(user="alice", direct=True, reply=len),
+                event_attrs(event))
+
+    def test_filters_see_slots(self):
+        transport = Transport()
+        r = Recorder("r")
+        transport.listen_for_event("test.*", r, user="alice")
+        transport.send_event(make_event("test.on_slotted", user="alice"))
+        transport.send_event(make_event("test.on_slotted", user="bob"))
+        self.assertEqual(1, len(r.events))
+
+class TestLazyAttributes(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.provider = Recorder("provider")
+        self.calls = []
+        def shout(event):
+            self.calls.append(event)
+            return event.message.upper()
+        self.transport.provide_event_attribute("irc.on_*", "shouted",
+                self.provider, shout)
+
+        self.received = []
+        class Keeper(Recorder):
+            def received_event(inner, event):
+                self.received.append(event)
+        self.transport.listen_for_event("irc.*", Keeper("keeper"))
+
+    def test_only_provided_when_accessed(self):
+        self.transport.send_event(Event("irc.on_privmsg", message="hi"))
+        self.transport.send_event(Event("irc.do_msg", message="hi"))
+        self.assertEqual([], self.calls)
+
+        event, other = self.received
+        self.assertEqual("HI", event.shouted)
+        self.assertEqual("HI", event.shouted)
+        self.assertEqual(1, len(self.calls))
+        self.assertFalse(hasattr(other, "shouted"))
+
+    def test_set_attributes_win(self):
+        self.transport.send_event(Event("irc.on_privmsg", message="hi",
+            shouted="no"))
+        self.assertEqual("no", self.received[0].shouted)
+        self.assertEqual([], self.calls)
+
+    def test_event_attrs(self):
+        self.transport.send_event(make_event("irc.on_privmsg", message="hi"))
+        event = self.received[0]
+        self.assertEqual(dict(message="hi"), event_attrs(event))
+        self.assertEqual([], self.calls)
+        self.assertEqual(dict(message="hi", shouted="HI"),
+                event_attrs(event, lazy=True))
+
+    def test_only_events_with_providers(self):
+        """Only events something provides attributes for pay for the
+        __getattr__ lookup
+
+        """
+        cls = event_class("irc.on_slotted", ["message"])
+        self.addCleanup(_event_classes.pop, "irc.on_slotted")
+        self.transport.send_event(make_event("irc.on_slotted", message="hi"))
+        self.transport.send_event(make_event("irc.do_slotted", message="hi"))
+        event, other = self.received
+        self.assertIsInstance(event, cls)
+        self.assertEqual("HI", event.shouted)
+        self.assertFalse(hasattr(type(other), "__getattr__"))
+        self.assertFalse(hasattr(Event, "__getattr__"))
+
+    def test_unhook(self):
+        self.transport.unhook_plugin(self.provider)
+        self.transport.send_event(Event("irc.on_privmsg", message="hi"))
+        self.assertFalse(hasattr(self.received[0], "shouted"))
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.provider = Provider("p")
+
+    def results(self, *args):
+        results = []
+        self.transport.issue_request("test.req", *args).addCallback(
+                results.append)
+        return results[0]
+
+    def test_uncached(self):
+        self.transport.provides_request("test.req", self.provider)
+        self.assertEqual(1, self.results())
+        self.assertEqual(2, self.results())
+
+    def test_cached_by_arguments(self):
+        self.transport.provides_request("test.req", self.provider,
+                cache_ttl=60)
+        self.assertEqual(1, self.results("a"))
+        self.assertEqual(1, self.results("a"))
+        self.assertEqual(2, self.results("b"))
+        self.assertEqual(dict(hits=1, misses=2, cached=2, coalesced=0),
+                self.transport.request_cache_stats()["test.req"])
+
+    def test_unhashable_arguments(self):
+        self.transport.provides_request("test.req", self.provider,
+                cache_ttl=60)
+        self.assertEqual(1, self.results(["a"]))
+        self.assertEqual(2, self.results(["a"]))
+
+    def test_expiry(self):
+        self.transport.provides_request("test.req", self.provider,
+                cache_ttl=0)
+        self.assertEqual(1, self.results())
+        self.assertEqual(2, self.results())
+
+    def test_invalidated_by_event(self):
+        self.transport.provides_request("test.req", self.provider,
+                cache_ttl=60, invalidate_on=["test.on_*"])
+        self.assertEqual(1, self.results())
+        self.transport.send_event(Event("test.do_thing"))
+        self.assertEqual(1, self.results())
+        self.transport.send_event(Event("test.on_change"))
+        self.assertEqual(2, self.results())
+
+    def test_invalidated_in_flight(self):
+        """A result that arrives after an invalidation is not cached"""
+        pending = defer.Deferred()
+        class Slow(Provider):
+            def incoming_request(self, name):
+                self.calls += 1
+                return pending if self.calls == 1 else self.calls
+        provider = Slow("slow")
+        self.transport.provides_request("test.req", provider,
+                cache_ttl=60, invalidate_on=["test.on_change"])
+        first = self.transport.issue_request("test.req")
+        self.transport.send_event(Event("test.on_change"))
+        pending.callback("stale")
+        self.assertEqual(2, self.results())
+        return first
+
+    def test_unhook_drops_cache(self):
+        self.transport.provides_request("test.req", self.provider,
+                cache_ttl=60)
+        self.results()
+        self.transport.unhook_plugin(self.provider)
+        self.transport.provides_request("test.req", self.provider)
+        self.assertEqual(2, self.results())
+        self.assertEqual({}, self.transport.request_cache_stats())
+
+class TestCoalesce(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = Transport()
+        self.pending = []
+        pending = self.pending
+
+        class Slow(Provider):
+            def incoming_request(self, name, *args):
+                self.calls += 1
+                d = defer.Deferred()
+                pending.append(d)
+                return d
+        self.provider = Slow("slow")
+
+    def test_identical_requests_coalesced(self):
+        self.transport.provides_request("test.req", self.provider,
+                coalesce=True)
+        results = []
+        for arg in ["a", "a", "b"]:
+            self.transport.issue_request("test.req", arg).addCallback(
+                    results.append)
+        self.assertEqual(2, self.provider.calls)
+        self.pending[0].callback("A")
+        self.pending[1].callback("B")
+        self.assertEqual(["A", "A", "B"], results)
+        self.assertEqual(1, self.transport.coalesce_counts["test.req"])
+
+        # Nothing is in flight any more, so this calls the provider again
+        self.transport.issue_request("test.req", "a")
+        self.assertEqual(3, self.provider.calls)
+
+    def test_failure_shared(self):
+        self.transport.provides_request("test.req", self.provider,
+                coalesce=True)
+        first = self.transport.issue_request("test.req", "a")
+        second = self.transport.issue_request("test.req", "a")
+        self.pending[0].errback(ValueError("nope"))
+        self.assertFailure(first, ValueError)
+        self.assertFailure(second, ValueError)
+        return defer.gatherResults([first, second])
+
+    def test_not_coalesced_by_default(self):
+        self.transport.provides_request("test.req", self.provider)
+        self.transport.issue_request("test.req", "a")
+        self.transport.issue_request("test.req", "a")
+        self.assertEqual(2, self.provider.calls)
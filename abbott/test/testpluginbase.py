@@ -1,9 +1,14 @@
 from functools import wraps
+import json
+import os
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
-from ..pluginbase import non_reentrant
+from .. import pluginbase, store
+from ..pluginbase import memoized, non_reentrant, BotPlugin
+from ..timerwheel import TimerWheel
+from ..transport import Event, Transport, make_event
 
 
 class TestNonReentrant(unittest.TestCase):
@@ -104,3 +109,679 @@ class TestNonReentrant(unittest.TestCase):
         self.assertEquals(5, (yield r1))
         self.assertEquals(7, (yield r2))
 
+
+
+class Lookup(object):
+    """Counts calls, and returns deferreds the test fires"""
+    def __init__(self):
+        self.calls = []
+
+    @memoized(ttl=10, maxsize=2, self=0, key=1)
+    def lookup(self, key):
+        d = defer.Deferred()
+        self.calls.append((key, d))
+        return d
+
+class TestMemoized(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.patch(pluginbase, "_timer", lambda: self.now)
+        self.obj = Lookup()
+
+    def stats(self):
+        """The counters, less the counts from calls in other tests"""
+        return dict((name, count - self.initial.get(name, 0))
+                for name, count in Lookup.lookup.stats().items())
+
+    def test_single_flight_then_cached(self):
+        self.initial = Lookup.lookup.stats()
+        r1 = self.obj.lookup(1)
+        r2 = self.obj.lookup(key=1)
+        self.assertEqual(1, len(self.obj.calls))
+        self.assertEqual(1, self.stats()['inflight'])
+        self.obj.calls[0][1].callback("one")
+        self.assertEqual("one", self.successResultOf(r1))
+        self.assertEqual("one", self.successResultOf(r2))
+
+        self.now = 9
+        self.assertEqual("one", self.successResultOf(self.obj.lookup(1)))
+        self.assertEqual(1, len(self.obj.calls))
+        self.assertEqual({"hits": 2, "misses": 1, "inflight": 0},
+                self.stats())
+
+        # Expired
+        self.now = 10
+        self.assertNoResult(self.obj.lookup(1))
+        self.assertEqual(2, len(self.obj.calls))
+
+    def test_failures_not_kept(self):
+        r = self.obj.lookup(1)
+        self.obj.calls[0][1].errback(ValueError())
+        self.failureResultOf(r, ValueError)
+        self.obj.lookup(1)
+        self.assertEqual(2, len(self.obj.calls))
+
+    def test_lru(self):
+        for key in [1, 2]:
+            self.obj.lookup(key)
+        for key, d in self.obj.calls:
+            d.callback(key)
+        # Use 1, so 2 is dropped for 3
+        self.obj.lookup(1)
+        self.obj.lookup(3)
+        self.obj.calls[2][1].callback(3)
+        self.obj.lookup(1)
+        self.obj.lookup(2)
+        self.assertEqual([1, 2, 3, 2], [key for key, d in self.obj.calls])
+
+    def test_per_instance_and_forget(self):
+        other = Lookup()
+        self.obj.lookup(1)
+        other.lookup(1)
+        self.assertEqual(1, len(other.calls))
+        self.obj.calls[0][1].callback("one")
+
+        self.obj.lookup.forget(self.obj, 1)
+        self.obj.lookup(1)
+        self.assertEqual(2, len(self.obj.calls))
+
+    def test_instances_not_kept_alive(self):
+        import gc, weakref
+        obj = Lookup()
+        obj.lookup(1)
+        obj.calls[0][1].callback("one")
+        ref = weakref.ref(obj)
+        del obj
+        gc.collect()
+        self.assertEqual(None, ref())
+
+class StubBoss(object):
+    config = {'core': {'thread_pool': {'name': "test", 'size': 2}}}
+
+    def get_plugin_config(self, plugin_name):
+        return {}
+
+class Offloader(BotPlugin):
+    OFFLOAD_CONCURRENCY = 1
+
+    def reload(self):
+        pass
+
+class TestOffload(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = Offloader("test.Offloader", None, StubBoss())
+
+    def tearDown(self):
+        pluginbase._thread_pools.pop("test").stop()
+
+    @defer.inlineCallbacks
+    def test_result(self):
+        import threading
+        result = (yield self.plugin.offload(
+            lambda x: (x, threading.current_thread().name), 5))
+        self.assertEqual(5, result[0])
+        self.assertNotEqual(threading.current_thread().name, result[1])
+
+    @defer.inlineCallbacks
+    def test_exception(self):
+        try:
+            yield self.plugin.offload(int, "not a number")
+        except ValueError:
+            pass
+        else:
+            self.fail("no exception")
+
+    @defer.inlineCallbacks
+    def test_concurrency_limit(self):
+        import threading
+        release = threading.Event()
+        first = self.plugin.offload(release.wait, 5)
+        second = self.plugin.offload(lambda: None)
+
+        stats = self.plugin.offload_stats
+        self.assertEqual(1, stats.running)
+        self.assertEqual(1, stats.waiting)
+
+        release.set()
+        yield defer.gatherResults([first, second])
+        self.assertEqual(0, stats.running)
+        self.assertEqual(0, stats.waiting)
+        self.assertEqual(2, stats.wait_times.count)
+        self.assertEqual(2, stats.run_times.count)
+
+
+class TestPluginConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        with open(self.path, "w") as out:
+            json.dump({"a": 1}, out)
+        self.clock = task.Clock()
+
+    def read(self):
+        with open(self.path) as inp:
+            return json.load(inp)
+
+    def test_save(self):
+        config = pluginbase.PluginConfig(self.path)
+        config['a'] = 2
+        config.save()
+        self.assertEqual({"a": 2}, self.read())
+
+    def test_write_behind(self):
+        config = pluginbase.PluginConfig(self.path, write_behind=10,
+                clock=self.clock)
+        config['a'] = 2
+        config.save()
+        config['a'] = 3
+        config.save()
+        self.assertEqual({"a": 1}, self.read())
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.clock.advance(10)
+        self.assertEqual({"a": 3}, self.read())
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_sync_flush(self):
+        config = pluginbase.PluginConfig(self.path, write_behind=10,
+                clock=self.clock)
+        config['a'] = 2
+        config.save()
+        config.flush(sync=True)
+        self.assertEqual({"a": 2}, self.read())
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    @defer.inlineCallbacks
+    def test_threaded_write_not_stale(self):
+        """A write still running in a thread doesn't replace a newer one"""
+        pool = pluginbase.get_thread_pool("test")
+        self.addCleanup(lambda: pluginbase._thread_pools.pop("test").stop())
+        config = pluginbase.PluginConfig(self.path, write_behind=10,
+                thread_pool=lambda: pool, clock=self.clock)
+        config['a'] = 2
+        config.save()
+        d = config.flush()
+        config['a'] = 3
+        config.save()
+        config.flush(sync=True)
+        yield d
+        # Whichever write got to the file first, the newer one wins
+        self.assertEqual({"a": 3}, self.read())
+
+
+class Starter(BotPlugin):
+    """Records when it starts. start() returns the deferred in the class's
+    waits dict for the plugin, if there is one.
+
+    """
+    log = []
+    waits = {}
+
+    def start(self):
+        self.log.append(self.plugin_name)
+        return self.waits.get(self.plugin_name)
+
+class StartupBoss(pluginbase.PluginBoss):
+    requires = {}
+
+    def _import_plugin_class(self, plugin_name):
+        return type(str(plugin_name.split(".")[1]), (Starter,),
+                dict(REQUIRES=self.requires.get(plugin_name, [])))
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        configdir = self.mktemp()
+        os.mkdir(configdir)
+        with open(os.path.join(configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": [
+                "a.C", "a.B", "a.A", "a.D"]}}, out)
+        Starter.log = []
+        Starter.waits = {}
+        StartupBoss.requires = {"a.C": ["a.B"], "a.B": ["a.A"]}
+        self.boss = StartupBoss(configdir, Transport())
+
+    def test_tiers(self):
+        self.assertEqual([
+            [("a.A", []), ("a.D", [])],
+            [("a.B", ["a.A"])],
+            [("a.C", ["a.B"])],
+            ], self.boss._startup_tiers(self.boss.config['core']['plugins']))
+
+    def test_waits_for_requirements(self):
+        wait_a = Starter.waits["a.A"] = defer.Deferred()
+        wait_d = Starter.waits["a.D"] = defer.Deferred()
+        done = self.boss.load_all_plugins()
+
+        # A and D start together, and B waits for A
+        self.assertEqual(["a.A", "a.D"], Starter.log)
+        wait_a.callback(None)
+        self.assertEqual(["a.A", "a.D"], Starter.log)
+        wait_d.callback(None)
+        self.assertEqual(["a.A", "a.D", "a.B", "a.C"], Starter.log)
+        self.successResultOf(done)
+
+    def test_failed_requirement(self):
+        Starter.waits["a.B"] = defer.fail(ValueError())
+        self.successResultOf(self.boss.load_all_plugins())
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(["a.A", "a.D", "a.B"], Starter.log)
+        self.assertEqual(["a.A", "a.D"], sorted(self.boss.loaded_plugins))
+
+    def test_cycle(self):
+        StartupBoss.requires["a.A"] = ["a.C"]
+        self.successResultOf(self.boss.load_all_plugins())
+        self.assertEqual(["a.D", "a.C", "a.B", "a.A"], Starter.log)
+
+class Handler(Starter):
+    """Records the events and requests it handles"""
+    def start(self):
+        self.events = []
+        self.listen_for_event("irc.on_privmsg")
+        self.provides_request("handler.echo")
+        return super(Handler, self).start()
+
+    def received_event(self, event):
+        self.events.append(event.message)
+
+    def on_request_handler_echo(self, value):
+        return value
+
+class StubIRC(object):
+    def __init__(self):
+        self.client = self
+        self.nickname = "abbott"
+
+class LazyBoss(StartupBoss):
+    def _import_plugin_class(self, plugin_name):
+        return Handler
+
+class TestLazy(unittest.TestCase):
+
+    def setUp(self):
+        configdir = self.mktemp()
+        os.mkdir(configdir)
+        with open(os.path.join(configdir, "config.json"), "w") as out:
+            json.dump({"core": {
+                "plugins": ["a.Handler"],
+                "lazy_plugins": {"a.Handler": {
+                    "commands": ["echo"],
+                    "prefixes": ["."],
+                    "requests": ["handler.echo"],
+                    }},
+                }, "command": {"prefix": "!"}}, out)
+        Starter.log = []
+        Starter.waits = {}
+        self.transport = Transport()
+        self.boss = LazyBoss(configdir, self.transport)
+        self.boss.loaded_plugins['irc.IRCBotPlugin'] = StubIRC()
+        self.successResultOf(self.boss.load_plugin("a.Handler"))
+
+    def say(self, message, direct=False):
+        self.transport.send_event(make_event("irc.on_privmsg",
+            user="alice!a@example.com", channel="#chan", message=message,
+            direct=direct))
+
+    def test_stub_until_command(self):
+        self.assertIsInstance(self.boss.loaded_plugins['a.Handler'],
+                pluginbase.LazyPlugin)
+        self.say("hello")
+        self.say("abbott: other command")
+        self.say("echo without a prefix")
+        self.assertEqual([], Starter.log)
+
+        self.say("!echo hi")
+        plugin = self.boss.loaded_plugins['a.Handler']
+        self.assertIsInstance(plugin, Handler)
+        self.assertEqual(["a.Handler"], Starter.log)
+        self.assertEqual(["!echo hi"], plugin.events)
+
+        # Now the real plugin gets everything
+        self.say("hello")
+        self.assertEqual(["!echo hi", "hello"], plugin.events)
+
+    def test_command_forms(self):
+        for message, direct in [("abbott: help echo", False),
+                ("echo hi", True), (".anything", False)]:
+            self.boss.unload_plugin("a.Handler")
+            self.successResultOf(self.boss.load_plugin("a.Handler"))
+            self.say(message, direct)
+            self.assertIsInstance(self.boss.loaded_plugins['a.Handler'],
+                    Handler, message)
+
+    def test_no_irc_client(self):
+        # Not connected
+        self.boss.loaded_plugins['irc.IRCBotPlugin'].client = None
+        self.say("abbott: echo hi")
+        # Not loaded
+        del self.boss.loaded_plugins['irc.IRCBotPlugin']
+        self.say("abbott: echo hi")
+        self.assertIsInstance(self.boss.loaded_plugins['a.Handler'],
+                pluginbase.LazyPlugin)
+
+        self.say("!echo hi")
+        self.assertIsInstance(self.boss.loaded_plugins['a.Handler'], Handler)
+
+    def test_request_activates(self):
+        wait = Starter.waits["a.Handler"] = defer.Deferred()
+        first = self.transport.issue_request("handler.echo", 1)
+        second = self.transport.issue_request("handler.echo", 2)
+        self.assertNoResult(first)
+        wait.callback(None)
+        self.assertEqual(1, self.successResultOf(first))
+        self.assertEqual(2, self.successResultOf(second))
+        self.assertEqual(["a.Handler"], Starter.log)
+
+    def test_unload_resets(self):
+        self.say("!echo hi")
+        self.boss.unload_plugin("a.Handler")
+        self.successResultOf(self.boss.load_plugin("a.Handler"))
+        self.assertIsInstance(self.boss.loaded_plugins['a.Handler'],
+                pluginbase.LazyPlugin)
+
+class Watcher(pluginbase.EventWatcher, Offloader):
+    pass
+
+class TestEventWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = Watcher("test.Watcher", None, StubBoss())
+
+    def send(self, **kwargs):
+        self.plugin.received_event(make_event("irc.on_privmsg", **kwargs))
+
+    def test_matches_fixed_attributes(self):
+        chan = self.plugin.wait_for(Event("irc.on_privmsg", channel="#a"))
+        user = self.plugin.wait_for(Event("irc.on_privmsg", channel="#a",
+            user="alice"))
+        other = self.plugin.wait_for(Event("irc.on_privmsg", channel="#b"))
+        anything = self.plugin.wait_for(Event("irc.on_privmsg"))
+
+        self.send(channel="#a", user="bob")
+        self.assertEqual("bob", self.successResultOf(chan).user)
+        self.assertEqual("bob", self.successResultOf(anything).user)
+        self.assertNoResult(user)
+        self.assertNoResult(other)
+
+        self.send(channel="#a", user="alice")
+        self.assertEqual("alice", self.successResultOf(user).user)
+        self.assertNoResult(other)
+
+    def test_missing_attribute(self):
+        d = self.plugin.wait_for(Event("irc.on_privmsg", channel="#a"))
+        self.send(user="alice")
+        self.assertNoResult(d)
+        self.send(channel="#a", user="alice")
+        self.successResultOf(d)
+
+    def test_timeout(self):
+        clock = task.Clock()
+        self.patch(pluginbase, "_timer_wheel", TimerWheel(clock=clock))
+        timed_out = self.plugin.wait_for(Event("irc.on_privmsg",
+            channel="#a"), timeout=300)
+        matched = self.plugin.wait_for(Event("irc.on_privmsg",
+            channel="#b"), timeout=300)
+        self.assertEqual(2, len(pluginbase._timer_wheel))
+        self.send(channel="#b")
+        self.successResultOf(matched)
+        self.assertEqual(1, len(pluginbase._timer_wheel))
+
+        clock.pump([1] * 300)
+        self.assertEqual(None, self.successResultOf(timed_out))
+        self.send(channel="#a")
+        self.assertEqual(0, len(pluginbase._timer_wheel))
+
+    def test_waiting_again_from_callback(self):
+        """A watcher added by a callback waits for the next event"""
+        results = []
+        def again(event):
+            results.append(event.message)
+            d = self.plugin.wait_for(Event("irc.on_privmsg", channel="#a"))
+            d.addCallback(lambda event: results.append(event.message))
+        self.plugin.wait_for(Event("irc.on_privmsg", channel="#a")
+                ).addCallback(again)
+        self.send(channel="#a", message="one")
+        self.assertEqual(["one"], results)
+        self.send(channel="#a", message="two")
+        self.assertEqual(["one", "two"], results)
+
+class Later(pluginbase.Scheduler, Offloader):
+    LATER_SAVE_DELAY = 5
+
+    def on_later_note(self, *args):
+        self.notes.append(args)
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.database = store.Database(self.mktemp())
+        self.addCleanup(self.database.close)
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.plugin = self.start()
+
+    def start(self):
+        boss = StubBoss()
+        boss.get_plugin_store = lambda name: store.PluginStore(
+                self.database, name)
+        plugin = Later("test.Later", None, boss)
+        plugin.scheduler_clock = self.clock
+        plugin.notes = []
+        plugin.start()
+        self.addCleanup(plugin.stop)
+        return plugin
+
+    def test_order(self):
+        self.plugin.call_later(20, "note", "b")
+        self.plugin.call_later(10, "note", "a")
+        self.plugin.call_at(1030, "note", "c", 1)
+        self.clock.advance(15)
+        self.assertEqual([("a",)], self.plugin.notes)
+        self.clock.advance(15)
+        self.assertEqual([("a",), ("b",), ("c", 1)], self.plugin.notes)
+        self.assertEqual([], self.plugin.pending_laters())
+
+    def test_reschedule_and_cancel(self):
+        self.plugin.call_later(10, "note", "a")
+        self.plugin.call_later(20, "note", "b")
+        self.plugin.call_later(30, "note", "a")
+        self.assertEqual([(1020, "note", ("b",)), (1030, "note", ("a",))],
+                self.plugin.pending_laters())
+        self.assertTrue(self.plugin.cancel_later("note", "b"))
+        self.assertFalse(self.plugin.cancel_later("note", "b"))
+        self.clock.advance(30)
+        self.assertEqual([("a",)], self.plugin.notes)
+
+    def test_unknown_callback(self):
+        self.assertRaises(ValueError, self.plugin.call_later, 1, "missing")
+
+    def test_callback_error_logged(self):
+        def fail():
+            raise ValueError()
+        self.plugin.on_later_fail = fail
+        self.plugin.call_later(1, "fail")
+        self.plugin.call_later(2, "note", "after")
+        self.clock.advance(2)
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual([("after",)], self.plugin.notes)
+
+    def test_saved_in_batches(self):
+        table = store.PluginStore(self.database, "test.Later").table("laters")
+        self.plugin.call_later(100, "note", "a")
+        self.plugin.call_later(100, "note", "b")
+        self.assertEqual(0, len(table))
+        self.clock.advance(5)
+        self.assertEqual(2, len(table))
+        self.plugin.cancel_later("note", "a")
+        self.plugin.stop()
+        self.assertEqual([[1100, "note", ["b"]]],
+                [value for key, value in table.items()])
+
+    def test_persists_across_restart(self):
+        Later.LATER_STARTUP_DELAY = 30
+        self.addCleanup(setattr, Later, "LATER_STARTUP_DELAY", 0)
+        self.plugin.call_later(10, "note", "a", [1, 2])
+        self.plugin.call_later(100, "note", "b")
+        self.plugin.stop()
+
+        # Comes back up after the first was due, which is held until the
+        # startup delay has passed
+        self.clock.advance(20)
+        plugin = self.start()
+        self.clock.advance(29)
+        self.assertEqual([], plugin.notes)
+        self.clock.advance(1)
+        self.assertEqual([("a", [1, 2])], plugin.notes)
+        self.clock.advance(50)
+        self.assertEqual([("a", [1, 2]), ("b",)], plugin.notes)
+
+class Reloader(Starter):
+    reloads = []
+
+    def reload(self):
+        super(Reloader, self).reload()
+        self.reloads.append(self.plugin_name)
+
+class ReloadBoss(StartupBoss):
+    def _import_plugin_class(self, plugin_name):
+        return Reloader
+
+class TestConfigReload(unittest.TestCase):
+
+    def setUp(self):
+        self.configdir = self.mktemp()
+        os.mkdir(self.configdir)
+        with open(os.path.join(self.configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": ["a.A", "a.B"]}}, out)
+        Starter.log = []
+        Starter.waits = {}
+        self.boss = ReloadBoss(self.configdir, Transport())
+        self.successResultOf(self.boss.load_all_plugins())
+        Reloader.reloads = []
+
+    def write(self, filename, contents):
+        with open(os.path.join(self.configdir, filename), "w") as out:
+            out.write(contents)
+
+    def test_only_changed_plugins(self):
+        self.write("a.B.json", '{"x": 1}')
+        self.assertEqual(["a.B"], self.boss.reload_changed_configs())
+        self.assertEqual(["a.B"], Reloader.reloads)
+        self.assertEqual(1, self.boss.loaded_plugins['a.B'].config['x'])
+
+        # Nothing changed since
+        self.assertEqual([], self.boss.reload_changed_configs())
+
+    def test_unchanged_contents(self):
+        with open(os.path.join(self.configdir, "a.A.json")) as inp:
+            contents = inp.read()
+        self.write("a.A.json", contents)
+        self.assertEqual([], self.boss.reload_changed_configs())
+
+    def test_own_saves_ignored(self):
+        plugin = self.boss.loaded_plugins['a.A']
+        plugin.config['x'] = 2
+        plugin.config.save()
+        self.boss.config['core']['new'] = True
+        self.boss.save()
+        self.assertEqual([], self.boss.reload_changed_configs())
+
+    def test_filenames(self):
+        self.write("a.A.json", '{"x": 1}')
+        self.write("a.B.json", '{"x": 1}')
+        self.assertEqual(["a.B"],
+                self.boss.reload_changed_configs(["a.B.json"]))
+
+    def test_invalid_json_skipped(self):
+        self.write("a.A.json", '{"x": ')
+        self.assertEqual([], self.boss.reload_changed_configs())
+        self.write("a.A.json", '{"x": 3}')
+        self.assertEqual(["a.A"], self.boss.reload_changed_configs())
+
+    def test_master_config(self):
+        self.write("config.json", json.dumps(
+            {"core": {"plugins": ["a.A", "a.B"], "new": True}}))
+        self.assertEqual(["a.A", "a.B"],
+                sorted(self.boss.reload_changed_configs(["config.json"])))
+        self.assertTrue(self.boss.config['core']['new'])
+
+        self.write("config.json", "{")
+        self.assertRaises(ValueError, self.boss.reload_changed_configs)
+
+    def test_write_behind_edit_wins(self):
+        self.boss.config['core']['config_write_behind'] = 10
+        plugin = self.boss.loaded_plugins['a.A']
+        plugin.reload()
+        plugin.config['channel'] = None
+        plugin.config.save()
+
+        self.write("a.A.json", '{"channel": "#edited"}')
+        self.assertEqual(["a.A"], self.boss.reload_changed_configs())
+        self.assertEqual("#edited", plugin.config['channel'])
+        with open(os.path.join(self.configdir, "a.A.json")) as inp:
+            self.assertEqual({"channel": "#edited"}, json.load(inp))
+
+    def test_write_behind_edit_wins_with_master_config(self):
+        self.boss.config['core']['config_write_behind'] = 10
+        plugin = self.boss.loaded_plugins['a.A']
+        plugin.reload()
+        plugin.config['channel'] = None
+        plugin.config.save()
+
+        self.write("config.json", json.dumps({"core": {
+            "plugins": ["a.A", "a.B"], "config_write_behind": 10}}))
+        self.write("a.A.json", '{"channel": "#edited"}')
+        self.assertEqual(["a.A", "a.B"],
+                sorted(self.boss.reload_changed_configs()))
+        self.assertEqual("#edited", plugin.config['channel'])
+        with open(os.path.join(self.configdir, "a.A.json")) as inp:
+            self.assertEqual({"channel": "#edited"}, json.load(inp))
+
+
+class Stateful(Starter):
+    def start(self):
+        self.cache = {}
+        return super(Stateful, self).start()
+
+    def export_state(self):
+        return dict(self.cache)
+
+    def import_state(self, state):
+        if state == "bad":
+            raise ValueError()
+        self.cache.update(state)
+
+class StatefulBoss(StartupBoss):
+    def _import_plugin_class(self, plugin_name):
+        return Stateful
+
+class TestStateHandover(unittest.TestCase):
+
+    def setUp(self):
+        configdir = self.mktemp()
+        os.mkdir(configdir)
+        with open(os.path.join(configdir, "config.json"), "w") as out:
+            json.dump({"core": {"plugins": []}}, out)
+        Starter.log = []
+        Starter.waits = {}
+        self.boss = StatefulBoss(configdir, Transport())
+
+    def test_handover(self):
+        self.successResultOf(self.boss.load_plugin("a.Stateful"))
+        old = self.boss.loaded_plugins['a.Stateful']
+        old.cache['#chan'] = True
+
+        state = old.export_state()
+        self.boss.unload_plugin("a.Stateful")
+        self.successResultOf(self.boss.load_plugin("a.Stateful", state=state))
+        new = self.boss.loaded_plugins['a.Stateful']
+        self.assertIsNot(old, new)
+        self.assertEqual({"#chan": True}, new.cache)
+
+    def test_import_error(self):
+        """A plugin that can't import the state is loaded anyway"""
+        self.successResultOf(self.boss.load_plugin("a.Stateful", state="bad"))
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual({}, self.boss.loaded_plugins['a.Stateful'].cache)
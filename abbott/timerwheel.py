@@ -0,0 +1,140 @@
+from twisted.python import log
+
+"""
+A hierarchical timer wheel, for scheduling lots of coarse-grained timers
+without giving each its own reactor delayed call.
+
+The wheel keeps its own timers in levels of slots. The first level has a slot
+per tick (of resolution seconds), the next a slot per full turn of the first
+level, and so on. Adding or cancelling a timer takes constant time. The wheel
+advances with a single reactor delayed call each tick, and only while it has
+timers. As it passes the start of a slot in a higher level, that slot's
+timers are moved down to the levels below.
+
+Timers fire on the first tick at or after their time, so up to resolution
+seconds late, and never early.
+
+"""
+
+class WheelTimer(object):
+    """Returned by TimerWheel.call_later(). Has the cancel() and active()
+    methods of a reactor delayed call.
+
+    """
+    __slots__ = ["expire", "func", "args", "kwargs", "_wheel", "_slot"]
+
+    def __init__(self, wheel, expire, func, args, kwargs):
+        self._wheel = wheel
+        self.expire = expire
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._slot = None
+
+    def cancel(self):
+        if self._slot is None:
+            raise ValueError("Timer is not active")
+        del self._slot[self]
+        self._slot = None
+        self._wheel._count -= 1
+
+    def active(self):
+        return self._slot is not None
+
+class TimerWheel(object):
+    def __init__(self, resolution=0.25, slots=64, levels=4, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.resolution = resolution
+        self.clock = clock
+        self._slot_count = slots
+        # Each level is a list of slots. Each slot is a dict with the timers
+        # in it as keys, so timers can be removed from it by cancel().
+        self._levels = [[{} for _ in range(slots)] for _ in range(levels)]
+        # The last tick that was processed, as a number of ticks since the
+        # epoch
+        self._tick = None
+        self._ticker = None
+        self._count = 0
+        self._advancing = False
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) in delay seconds, rounded up to the
+        next tick
+
+        """
+        now = self.clock.seconds()
+        if not self._count and not self._advancing:
+            # The wheel has been idle, so it may be far behind
+            self._tick = int(now // self.resolution)
+        # Round up, to a tick that hasn't been processed yet
+        expire = max(self._tick + 1,
+                -int(-(now + delay) // self.resolution))
+        timer = WheelTimer(self, expire, func, args, kwargs)
+        self._place(timer)
+        self._count += 1
+        if self._ticker is None:
+            self._schedule_tick()
+        return timer
+
+    def _place(self, timer):
+        slots = self._slot_count
+        delta = timer.expire - self._tick
+        level = 0
+        span = 1
+        while delta >= span * slots and level < len(self._levels) - 1:
+            level += 1
+            span *= slots
+        # Timers beyond the last level's reach go in it anyway, and are
+        # placed again each time their slot comes up until they're in reach
+        slot = self._levels[level][(timer.expire // span) % slots]
+        slot[timer] = None
+        timer._slot = slot
+
+    def _schedule_tick(self):
+        delay = (self._tick + 1) * self.resolution - self.clock.seconds()
+        self._ticker = self.clock.callLater(max(0, delay), self._advance)
+
+    def _advance(self):
+        self._ticker = None
+        self._advancing = True
+        try:
+            self._advance_to(int(self.clock.seconds() // self.resolution))
+        finally:
+            self._advancing = False
+        if self._count:
+            self._schedule_tick()
+
+    def _advance_to(self, target):
+        slots = self._slot_count
+        while self._count and self._tick < target:
+            self._tick += 1
+            tick = self._tick
+
+            # Move the timers in higher levels' slots that start at this tick
+            # down
+            span = slots
+            for level in self._levels[1:]:
+                if tick % span:
+                    break
+                slot = level[(tick // span) % slots]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self._place(timer)
+                span *= slots
+
+            slot = self._levels[0][tick % slots]
+            if slot:
+                due = list(slot)
+                slot.clear()
+                self._count -= len(due)
+                for timer in due:
+                    timer._slot = None
+                    try:
+                        timer.func(*timer.args, **timer.kwargs)
+                    except Exception:
+                        log.err(None, "Error in timer wheel callback")
@@ -1,9 +1,11 @@
+import keyword
 import re
-from collections import defaultdict
-from itertools import chain
+from bisect import bisect_left
+from collections import deque, defaultdict
+from timeit import default_timer as _timer
 
 from twisted.internet import defer
-from twisted.python import log
+from twisted.python import failure, log
 
 """
 About the Abbott event system:
@@ -22,16 +24,54 @@ glob event names such as irc.* or irc.on_*
 Globs do not transcend dots, so you must do something like *.* to receive all
 events.
 
+Listeners may also give attribute filters when registering, e.g.
+listen_for_event("irc.on_privmsg", channel="#foo"). Such listeners only receive
+events whose attributes equal the given values. The transport indexes these
+filters, so a plugin that only cares about one channel is never called for the
+others.
+
 There are two ways to register an event: as a normal listener, or as a
 middleware listener. There are two differences: all middleware listeners are
 called before normal listeners, and middleware listeners have an opportunity to
 edit the event arbitrarily (add or change attributes) or destroy the event (in
 which case no other handlers will be called.
 
+Middleware is called in order of the priority given when it was installed,
+lowest first, and in the order it was installed for equal priorities. The
+transport counts how often each middleware swallows an event or replaces it
+with a different event object; see middleware_stats().
+
 This system allows for things like an auth plugin which inserts authentication
 information into the event for use by other plugins. It's perfectly fine to
-insert callback functions as attributes on the event too, not just values. (See
-the auth.Auth plugin)
+insert callback functions as attributes on the event too, not just values.
+
+For attributes that most handlers never look at, a plugin can instead register
+a lazy attribute provider with provide_event_attribute(). This is a function
+that's given the event and returns the attribute's value. It's only called the
+first time something accesses that attribute on an event, and the value is then
+stored on the event. (See the auth.Auth and ircutil.ReplyInserter plugins)
+
+By default send_event() dispatches an event to every listener before it
+returns, so a handler that emits events of its own recurses through the bus on
+the same stack. The transport can instead be put in queued mode with
+set_queued_dispatch() (configured by the "dispatch" key in the core config).
+Events are then appended to a FIFO which the reactor drains a bounded slice at
+a time, and send_event() returns immediately. If the queue grows past a limit,
+new events of the types configured as sheddable are dropped instead of being
+queued.
+
+Event types can also be assigned to priority lanes in queued mode. Each lane is
+its own FIFO, and an event is only dispatched once every higher priority lane
+is empty. This keeps moderation traffic (irc.do_kick, irc.do_mode) moving
+while the bus is busy with chatter. Whole lanes can be made sheddable too.
+Events of different lanes are not necessarily dispatched in the order they
+were sent.
+
+The transport also times every call it makes into a plugin's
+received_event(), received_middleware_event() and incoming_request() methods,
+and keeps a LatencyHistogram for each (plugin, kind, event or request name).
+See latency_stats(). Only the time spent in the call itself is measured; work a
+handler defers until later is not attributed to it.
 
 Aside from events, there is another mechanism meant for inter-plugin
 communication. One plugin can send a "request" that another plugin perfrom some
@@ -48,8 +88,189 @@ Other notes about requests: only one plugin may provide a request handler for a
 particular request name. If more than one handler tries to provide a particular
 request, the behavior is undefined.
 
+A provider may declare a request cacheable when it calls provides_request(),
+giving a time to live and a list of event globs that invalidate it. The
+transport then answers repeated requests with the same arguments from its
+cache, without calling the plugin, until the entry expires or a matching event
+is sent. This is only appropriate for requests whose result depends on nothing
+but their arguments and the state those events announce changes to.
+
+A provider may also declare a request safe to coalesce. While such a request
+is in flight, identical requests (same name and arguments) don't call the
+provider again; they wait for the outstanding one and get the same result.
+
 """
 
+# Sentinel for attributes missing from an event
+_missing = object()
+
+class _TrieNode(object):
+    __slots__ = ["glob", "literals", "globs", "objs", "filtered"]
+    def __init__(self, glob):
+        # The full glob this node is the end of
+        self.glob = glob
+        # Maps literal segment strings to child nodes
+        self.literals = {}
+        # List of (segment glob, compiled regex, child node). The regex is
+        # None for a bare * segment, which matches any segment.
+        self.globs = []
+        # The set of objects subscribed to the pattern ending at this node
+        self.objs = set()
+        # Maps attribute filters to the set of objects subscribed to the
+        # pattern ending at this node with those filters. Filters are a
+        # sorted tuple of (attribute name, value) pairs.
+        self.filtered = {}
+
+class _SubscriptionTrie(object):
+    """Stores subscriptions to event globs in a trie with one level per
+    dot-separated segment of the glob.
+
+    Since globs do not transcend dots, each segment of a glob can be matched
+    against the corresponding segment of an event type independently. Looking
+    up the subscribers of an event type then costs time proportional to the
+    number of segments in the event type (and the number of glob edges along
+    the way), not to the number of patterns registered.
+
+    """
+    def __init__(self):
+        self._root = _TrieNode("")
+
+    def subscribers(self, matchstr, filters=()):
+        """Returns the set of objects subscribed to exactly this glob (and
+        exactly these filters, if given), creating the trie nodes for it if
+        necessary
+
+        """
+        node = self._root
+        segments = matchstr.split(".")
+        for depth, segment in enumerate(segments):
+            if "*" not in segment:
+                child = node.literals.get(segment)
+                if child is None:
+                    child = node.literals[segment] = _TrieNode(
+                            ".".join(segments[:depth+1]))
+            else:
+                for glob, _, child in node.globs:
+                    if glob == segment:
+                        break
+                else:
+                    if segment == "*":
+                        regex = None
+                    else:
+                        regex = re.compile(".+".join(
+                            re.escape(x) for x in segment.split("*")) + "$")
+                    child = _TrieNode(".".join(segments[:depth+1]))
+                    node.globs.append((segment, regex, child))
+            node = child
+        if filters:
+            return node.filtered.setdefault(filters, set())
+        return node.objs
+
+    def add(self, matchstr, obj, filters=()):
+        self.subscribers(matchstr, filters).add(obj)
+
+    def discard(self, obj):
+        """Removes obj from every glob it is subscribed to"""
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            node.objs.discard(obj)
+            for obj_set in node.filtered.values():
+                obj_set.discard(obj)
+            stack.extend(node.literals.values())
+            stack.extend(child for _, _, child in node.globs)
+
+    def match(self, eventtype):
+        """Returns two lists for the subscriptions matching the given event
+        type. The first has (obj, obj_set) tuples for every subscription
+        without filters. The second has (obj, obj_set, filters) tuples for the
+        subscriptions with filters. obj_set is the set the subscription is
+        stored in.
+
+        """
+        nodes = self._match_nodes(eventtype)
+        return (
+                [(obj, node.objs) for node in nodes for obj in node.objs],
+                [(obj, obj_set, filters)
+                    for node in nodes
+                    for filters, obj_set in node.filtered.items()
+                    for obj in obj_set],
+                )
+
+    def match_globs(self, eventtype):
+        """Returns a list of (glob, obj, obj_set) tuples for the subscriptions
+        without filters matching the given event type, where glob is the glob
+        the object subscribed to
+
+        """
+        return [(node.glob, obj, node.objs)
+                for node in self._match_nodes(eventtype)
+                for obj in node.objs]
+
+    def _match_nodes(self, eventtype):
+        """Returns the nodes for the globs matching the given event type"""
+        nodes = [self._root]
+        for segment in eventtype.split("."):
+            next_nodes = []
+            for node in nodes:
+                child = node.literals.get(segment)
+                if child is not None:
+                    next_nodes.append(child)
+                for _, regex, child in node.globs:
+                    if regex is None or regex.match(segment):
+                        next_nodes.append(child)
+            if not next_nodes:
+                return []
+            nodes = next_nodes
+        return nodes
+
+class LatencyHistogram(object):
+    """Counts call durations in fixed buckets. Recording a sample costs a
+    bisection over a handful of bounds and no allocation, so these can be left
+    on all the time.
+
+    """
+    # Upper bounds of the buckets, in seconds. Slower samples go in one extra
+    # bucket at the end
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    __slots__ = ["counts", "total", "max"]
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket the p-th percentile sample
+        falls in, or None if it is in the last, unbounded bucket
+
+        """
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return None
+
+    def as_dict(self):
+        return dict(
+                count=self.count,
+                total=self.total,
+                max=self.max,
+                buckets=list(zip(self.BOUNDS + (None,), self.counts)),
+                )
+
 class Transport(object):
     """A generalized transport layer to send messages from one plugin to another.
     
@@ -57,55 +278,447 @@ class Transport(object):
     """
 
     def __init__(self):
-        # maps event names to sets of objects
-        self._middleware_listeners = defaultdict(set)
-        self._event_listeners = defaultdict(set)
+        # Tries mapping event globs to sets of objects
+        self._middleware_listeners = _SubscriptionTrie()
+        # Maps (glob, obj) middleware registrations to a (priority, sequence
+        # number) sort key. The sequence number orders registrations with
+        # equal priority by when they were made.
+        self._middleware_order = {}
+        self._middleware_sequence = 0
+        # Maps (plugin name, event type) to [swallowed, replaced] counts
+        self._middleware_counts = defaultdict(lambda: [0, 0])
+        # Maps event globs to (attribute name, obj, function) lazy attribute
+        # providers, and those to a sequence number giving the order they
+        # were registered in. See provide_event_attribute()
+        self._attribute_providers = _SubscriptionTrie()
+        self._attribute_order = {}
+        self._attribute_sequence = 0
+
+        # The reverse index: maps objects to the set of their registrations,
+        # as (kind, glob or request name, details) tuples. details is the
+        # filters for "event" registrations, the (attribute name, function)
+        # for "attribute" registrations and None otherwise. This is what lets
+        # unhook_plugin() find an object's registrations without searching
+        # everyone else's.
+        self._subscriptions = defaultdict(set)
+        self._event_listeners = _SubscriptionTrie()
         self._request_listeners = {}
 
+        # The routing index. Maps concrete event types to a tuple of
+        # (middleware, listeners, filtered, invalidates, providers).
+        # middleware and listeners are lists of (obj, obj_set) tuples in the
+        # order they should be called. (middleware tuples also have the
+        # object's [swallowed, replaced] counts for the event type.) obj_set
+        # is the registration set the object came from, so that dispatch can
+        # tell whether an object was removed partway through an event.
+        # filtered is the index of listeners with attribute filters; see
+        # _build_route(). invalidates is a list of the names of cached
+        # requests this event type invalidates. providers maps lazy attribute
+        # names to the functions that provide them. This is cleared whenever
+        # the registrations change.
+        self._routes = {}
+
+        # Queued dispatch state. See set_queued_dispatch()
+        self._queued = False
+        # One queue per priority lane, highest priority first
+        self._lanes = [deque()]
+        self._drain_call = None
+        self._clock = None
+        self._slice_size = 100
+        self._max_depth = None
+        self._shed_patterns = _SubscriptionTrie()
+        self._shed_lane = None
+        # Maps event globs to the numbers of the lanes they're assigned to
+        self._lane_patterns = _SubscriptionTrie()
+        self._default_lane = 0
+        # Maps event types to a (lane number, sheddable) tuple. Filled lazily
+        self._event_lanes = {}
+        self._shedding = False
+        # Maps event types to the number of events of that type dropped
+        self.shed_counts = defaultdict(int)
+
+        # Maps (plugin name, kind, event or request name) to a
+        # LatencyHistogram. kind is one of "event", "middleware" or "request"
+        self._latency = {}
+
+        # Request caching. See provides_request().
+        # Maps cacheable request names to their time to live
+        self._cache_ttl = {}
+        # Maps request names to dicts mapping (args, kwargs) to (expiry time,
+        # result)
+        self._request_cache = {}
+        # Trie mapping event globs to the names of the requests they
+        # invalidate
+        self._cache_invalidators = _SubscriptionTrie()
+        # Maps request names to [hits, misses]
+        self.request_cache_counts = defaultdict(lambda: [0, 0])
+
+        # Request coalescing. The names of requests to coalesce
+        self._coalesce = set()
+        # Maps (request name, (args, kwargs)) to the list of deferreds waiting
+        # on the in-flight call for it
+        self._in_flight = {}
+        # Maps request names to the number of calls that were coalesced
+        self.coalesce_counts = defaultdict(int)
+
+    def set_queued_dispatch(self, enabled=True, slice_size=100, max_depth=None,
+            shed=(), lanes=None, default_lane=0, shed_lane=None, clock=None):
+        """Turns queued dispatch on or off.
+
+        In queued mode, send_event() appends the event to a queue and returns.
+        The queue is drained from the reactor, at most slice_size events per
+        reactor iteration, so a flood of events can't starve everything else
+        and handlers that emit events don't recurse.
+
+        max_depth, if given, is the queue length past which events whose type
+        matches one of the globs in shed are dropped. Events of other types
+        are always queued; they are the ones we can't afford to lose.
+
+        lanes, if given, is a dict mapping event globs to priority lane
+        numbers. Lane 0 is dispatched first, then lane 1 once lane 0 is empty,
+        and so on. An event type matching globs of several lanes goes in the
+        highest priority one, and types matching none go in default_lane. If
+        shed_lane is given, events in that lane or lower priority lanes are
+        dropped past max_depth too. For example::
+
+            transport.set_queued_dispatch(max_depth=5000,
+                    lanes={"irc.do_kick": 0, "irc.do_mode": 0,
+                        "irc.on_privmsg": 2},
+                    default_lane=1, shed_lane=2)
+
+        clock is the object to schedule draining on. It defaults to the
+        reactor.
+
+        """
+        if not enabled:
+            # Deliver anything still waiting before going back to synchronous
+            # dispatch
+            self._drain_all()
+        self._queued = enabled
+        self._slice_size = slice_size
+        self._max_depth = max_depth
+        self._shed_patterns = _SubscriptionTrie()
+        for matchstr in shed:
+            self._shed_patterns.add(matchstr, True)
+        self._shed_lane = shed_lane
+        lanes = lanes or {}
+        self._lane_patterns = _SubscriptionTrie()
+        for matchstr, lane in lanes.items():
+            self._lane_patterns.add(matchstr, lane)
+        self._default_lane = default_lane
+        self._event_lanes = {}
+        # Requeue anything still waiting into the new lanes
+        pending = [event for queue in self._lanes for event in queue]
+        self._lanes = [deque() for _ in
+                range(max([default_lane] + list(lanes.values())) + 1)]
+        for event in pending:
+            self._lanes[self._event_lane(event.eventtype)[0]].append(event)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+    def queue_depth(self):
+        """Returns the number of events waiting to be dispatched"""
+        return sum(len(queue) for queue in self._lanes)
+
+    def lane_depths(self):
+        """Returns a list of the number of events waiting in each lane"""
+        return [len(queue) for queue in self._lanes]
+
+    def _event_lane(self, eventtype):
+        """Returns the (lane number, sheddable) tuple for an event type"""
+        try:
+            return self._event_lanes[eventtype]
+        except KeyError:
+            pass
+        lanes = [lane for lane, _ in self._lane_patterns.match(eventtype)[0]]
+        lane = min(lanes) if lanes else self._default_lane
+        sheddable = bool(self._shed_patterns.match(eventtype)[0]) or (
+                self._shed_lane is not None and lane >= self._shed_lane)
+        self._event_lanes[eventtype] = lane, sheddable
+        return lane, sheddable
+
+    def _build_route(self, eventtype):
+        """Resolves the middleware and listeners for a concrete event type.
+        The result is stored in the routing index by send_event()
+
+        Listeners registered with attribute filters are indexed by the first
+        of their filter attributes, and then by the value they want for it::
+
+            {attribute name: {value: [(obj, obj_set, remaining filters)]}}
+
+        so that dispatching an event costs one dictionary lookup per distinct
+        filter attribute, no matter how many values are subscribed to.
+
+        """
+        middleware = [(self._middleware_order[glob, obj], obj, obj_set)
+                for glob, obj, obj_set in
+                self._middleware_listeners.match_globs(eventtype)]
+        middleware.sort(key=lambda item: item[0])
+        middleware = [(obj, obj_set,
+                    self._middleware_counts[
+                        getattr(obj, "plugin_name", None), eventtype])
+                for _, obj, obj_set in middleware]
+        listeners, filtered_listeners = self._event_listeners.match(eventtype)
+
+        filtered = {}
+        for obj, obj_set, filters in filtered_listeners:
+            (attr, value), rest = filters[0], filters[1:]
+            filtered.setdefault(attr, {}).setdefault(value, []).append(
+                    (obj, obj_set, rest))
+
+        invalidates = [name for name, _ in
+                self._cache_invalidators.match(eventtype)[0]]
+
+        # The first provider registered for an attribute name wins
+        providers = {}
+        for entry, _ in sorted(self._attribute_providers.match(eventtype)[0],
+                key=lambda item: self._attribute_order[item[0]]):
+            name, _, func = entry
+            providers.setdefault(name, func)
+
+        return middleware, listeners, filtered, invalidates, providers
+
+    def _invalidate_routes(self):
+        self._routes.clear()
+
     def send_event(self, event):
-        # Note: iterating over the listener dictionaries and sets are done with
-        # copies, not an iterator, because of the posibility of the dictionary
-        # being modified somewhere down the stack in an event handler
+        if not self._queued:
+            self._dispatch(event)
+            return
+
+        lane, sheddable = self._event_lane(event.eventtype)
+        if sheddable and self._max_depth is not None:
+            depth = self.queue_depth()
+            if depth >= self._max_depth:
+                if not self._shedding:
+                    log.msg("WARNING: event queue is {0} deep. Dropping "
+                            "low priority events".format(depth))
+                    self._shedding = True
+                self.shed_counts[event.eventtype] += 1
+                return
+
+        self._lanes[lane].append(event)
+        if self._drain_call is None:
+            self._drain_call = self._clock.callLater(0, self._drain)
+
+    def _drain(self):
+        """Dispatches one slice of the queue, and reschedules itself if there
+        is more left
+
+        """
+        self._drain_call = None
+        for _ in range(self._slice_size):
+            event = self._next_event()
+            if event is None:
+                break
+            self._dispatch(event)
+
+        if self.queue_depth():
+            self._drain_call = self._clock.callLater(0, self._drain)
+        elif self._shedding:
+            log.msg("Event queue drained. Total events dropped so far: "
+                    "{0}".format(sum(self.shed_counts.values())))
+            self._shedding = False
+
+    def _drain_all(self):
+        if self._drain_call is not None:
+            self._drain_call.cancel()
+            self._drain_call = None
+        while True:
+            event = self._next_event()
+            if event is None:
+                break
+            self._dispatch(event)
+
+    def _next_event(self):
+        """Pops the next event to dispatch, from the highest priority lane
+        with anything in it. Returns None if every lane is empty.
+
+        """
+        # Look from the top every time, since dispatching may have queued
+        # more urgent events
+        for queue in self._lanes:
+            if queue:
+                return queue.popleft()
+        return None
+
+    def _dispatch(self, event):
+        # Note: the route lists are never mutated once built; registration
+        # changes replace the routing index instead. So it is safe for an
+        # event handler somewhere down the stack to change the registrations
+        # while we iterate here.
+        eventtype = event.eventtype
+        try:
+            middleware, listeners, filtered, invalidates, providers = \
+                    self._routes[eventtype]
+        except KeyError:
+            middleware, listeners, filtered, invalidates, providers = \
+                    self._routes[eventtype] = self._build_route(eventtype)
+
+        for name in invalidates:
+            self._request_cache[name] = {}
+
+        if providers:
+            _provide_lazily(event, providers)
 
         # First call all middleware
-        for callback_name, callback_obj_set in list(self._middleware_listeners.items()):
-            callback_parts = [re.escape(x) for x in callback_name.split("*")]
-            callback_match = "[^. ]+".join(callback_parts) + "$"
-            if re.match(callback_match, event.eventtype):
-                for callback_obj in set(callback_obj_set):
-                    try:
-                        event = callback_obj.received_middleware_event(event)
-                    except Exception:
-                        # We don't want one plugin's errors to prevent other
-                        # plugins from being called
-                        import traceback
-                        log.msg(traceback.format_exc())
-                    if not event:
-                        return
+        for callback_obj, callback_obj_set, counts in middleware:
+            if callback_obj not in callback_obj_set:
+                continue
+            start = _timer()
+            try:
+                new_event = callback_obj.received_middleware_event(event)
+            except Exception:
+                # We don't want one plugin's errors to prevent other
+                # plugins from being called
+                import traceback
+                log.msg(traceback.format_exc())
+                new_event = event
+            self._record_latency(callback_obj, "middleware", eventtype,
+                    _timer() - start)
+            if not new_event:
+                counts[0] += 1
+                return
+            if new_event is not event:
+                counts[1] += 1
+                event = new_event
+                if providers:
+                    _provide_lazily(event, providers)
 
         # Now call the event handlers
-        for callback_name, callback_obj_set in list(self._event_listeners.items()):
-            callback_match = callback_name.replace("*", "[^.]+") + "$"
-            if re.match(callback_match, event.eventtype):
-                # create a new set since the set may mutate while we iterate over it
-                for callback_obj in set(callback_obj_set):
-                    try:
-                        # Do a check to see if it's still in the original set. If
-                        # it *has* been removed (by an earlier callback, for
-                        # example), then don't call it
-                        if callback_obj in callback_obj_set:
-                            callback_obj.received_event(event)
-                    except Exception:
-                        # We don't want one plugin's errors to prevent other
-                        # plugins from being called.
-                        import traceback
-                        log.msg(traceback.format_exc())
-
-    def install_middleware(self, matchstr, obj_to_notify):
-        self._middleware_listeners[matchstr].add(obj_to_notify)
-
-    def listen_for_event(self, matchstr, obj_to_notify):
-        self._event_listeners[matchstr].add(obj_to_notify)
+        for callback_obj, callback_obj_set in listeners:
+            # Do a check to see if it's still in the original set. If it
+            # *has* been removed (by an earlier callback, for example), then
+            # don't call it
+            if callback_obj in callback_obj_set:
+                self._notify_listener(callback_obj, event)
+
+        # And the handlers that only want events with particular attribute
+        # values
+        for attr, by_value in filtered.items():
+            try:
+                targets = by_value.get(getattr(event, attr, _missing), ())
+            except TypeError:
+                # Unhashable attribute value. It can't equal any of the
+                # (hashable) values subscribed to anyways.
+                continue
+            for callback_obj, callback_obj_set, rest in targets:
+                if callback_obj not in callback_obj_set:
+                    continue
+                for other_attr, value in rest:
+                    if getattr(event, other_attr, _missing) != value:
+                        break
+                else:
+                    self._notify_listener(callback_obj, event)
+
+    def _notify_listener(self, callback_obj, event):
+        start = _timer()
+        try:
+            callback_obj.received_event(event)
+        except Exception:
+            # We don't want one plugin's errors to prevent other
+            # plugins from being called.
+            import traceback
+            log.msg(traceback.format_exc())
+        self._record_latency(callback_obj, "event", event.eventtype,
+                _timer() - start)
+
+    def _record_latency(self, obj, kind, name, seconds):
+        key = (getattr(obj, "plugin_name", None), kind, name)
+        try:
+            histogram = self._latency[key]
+        except KeyError:
+            histogram = self._latency[key] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def latency_stats(self):
+        """Returns the dispatch latency histograms, a dict mapping (plugin
+        name, kind, event or request name) tuples to LatencyHistogram objects.
+        kind is one of "event", "middleware" or "request"
+
+        """
+        return self._latency
+
+    def reset_latency_stats(self):
+        self._latency = {}
+
+    def install_middleware(self, matchstr, obj_to_notify, priority=0):
+        """Registers obj_to_notify as middleware for events matching
+        matchstr. Middleware with a lower priority is called first.
+
+        """
+        key = (matchstr, obj_to_notify)
+        if key in self._middleware_order:
+            sequence = self._middleware_order[key][1]
+        else:
+            sequence = self._middleware_sequence
+            self._middleware_sequence += 1
+        self._middleware_order[key] = (priority, sequence)
+        self._middleware_listeners.add(matchstr, obj_to_notify)
+        self._subscriptions[obj_to_notify].add(("middleware", matchstr, None))
+        self._invalidate_routes()
+
+    def middleware_stats(self):
+        """Returns a dict mapping (plugin name, event type) to a dict with the
+        number of events the middleware "swallowed" and the number it
+        "replaced" with a different event object. (Middleware that modifies
+        the event it was given in place doesn't count as replacing it.)
+
+        """
+        return dict((key, dict(swallowed=counts[0], replaced=counts[1]))
+                for key, counts in self._middleware_counts.items())
+
+    def provide_event_attribute(self, matchstr, name, obj, func):
+        """Registers func as the lazy provider of the attribute name on events
+        matching matchstr. The first time the attribute is accessed on such an
+        event, func is called with the event, and its return value becomes the
+        attribute's value. obj is the plugin the provider belongs to.
+
+        The attribute isn't provided if it's already set on the event, and if
+        several providers for the same name match an event, the one registered
+        first is used.
+
+        """
+        entry = (name, obj, func)
+        if entry not in self._attribute_order:
+            self._attribute_order[entry] = self._attribute_sequence
+            self._attribute_sequence += 1
+        self._attribute_providers.add(matchstr, entry)
+        self._subscriptions[obj].add(("attribute", matchstr, (name, func)))
+        self._invalidate_routes()
+
+    def listen_for_event(self, matchstr, obj_to_notify, **filters):
+        """Registers obj_to_notify to receive events matching matchstr.
+
+        Any keyword arguments are attribute filters: the object will only
+        receive events whose attributes equal all the given values. For
+        example::
+
+            transport.listen_for_event("irc.on_privmsg", plugin,
+                    channel="#foo")
+
+        only delivers messages said in #foo. Filter values must be hashable.
+        Filtered subscriptions are indexed by the transport, so listeners for
+        other values are never consulted.
+
+        """
+        filters = tuple(sorted(filters.items()))
+        self._event_listeners.add(matchstr, obj_to_notify, filters)
+        self._subscriptions[obj_to_notify].add(("event", matchstr, filters))
+        self._invalidate_routes()
+
+    def unlisten_for_event(self, matchstr, obj_to_notify, **filters):
+        """Removes a registration made with listen_for_event(). The matchstr
+        and filters must be the same as were given when listening.
+
+        """
+        filters = tuple(sorted(filters.items()))
+        self._event_listeners.subscribers(matchstr, filters).discard(
+                obj_to_notify)
+        self._subscriptions[obj_to_notify].discard(
+                ("event", matchstr, filters))
+        self._invalidate_routes()
 
 
     ### Request Interface
@@ -117,10 +730,88 @@ class Transport(object):
         except KeyError:
            return defer.fail(NotImplementedError("Request name %r is not implemented"%(name,)))
 
+        cacheable = name in self._cache_ttl
+        coalesce = name in self._coalesce
+        if not (cacheable or coalesce):
+            return self._call_provider(obj, name, args, kwargs)
+
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable arguments can't be cached or coalesced
+            return self._call_provider(obj, name, args, kwargs)
+
+        if cacheable:
+            cache = self._request_cache[name]
+            try:
+                expires, result = cache[key]
+            except KeyError:
+                pass
+            else:
+                if expires > _timer():
+                    self.request_cache_counts[name][0] += 1
+                    return defer.succeed(result)
+                del cache[key]
+            self.request_cache_counts[name][1] += 1
+
+        if coalesce:
+            d = self._call_coalesced(obj, name, args, kwargs, key)
+        else:
+            d = self._call_provider(obj, name, args, kwargs)
+
+        if cacheable:
+            def store(result):
+                # If the cache was invalidated while the request was in
+                # flight, cache is no longer the live cache dict and this is
+                # dropped
+                cache[key] = (_timer() + self._cache_ttl.get(name, 0), result)
+                return result
+            d.addCallback(store)
+        return d
+
+    def _call_coalesced(self, obj, name, args, kwargs, key):
+        """Calls the provider, unless an identical request is already in
+        flight, in which case this returns a deferred that fires with its
+        result
+
+        """
+        flight_key = (name, key)
+        try:
+            waiters = self._in_flight[flight_key]
+        except KeyError:
+            pass
+        else:
+            self.coalesce_counts[name] += 1
+            d = defer.Deferred()
+            waiters.append(d)
+            return d
+
+        d = self._call_provider(obj, name, args, kwargs)
+        if d.called:
+            # Answered synchronously, so there's nothing to wait on
+            return d
+
+        waiters = self._in_flight[flight_key] = []
+        def release(result):
+            del self._in_flight[flight_key]
+            for waiter in waiters:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+            return result
+        d.addBoth(release)
+        return d
+
+    def _call_provider(self, obj, name, args, kwargs):
+        start = _timer()
         try:
             toret = obj.incoming_request(name, *args, **kwargs)
         except Exception as e:
             return defer.fail(e)
+        finally:
+            self._record_latency(obj, "request", name, _timer() - start)
 
         # Programming convenience: request implementations can return a
         # deferred or a value, and this automatically wraps them in a deferred.
@@ -129,30 +820,237 @@ class Transport(object):
 
         return toret
 
-    def provides_request(self, name, obj_to_notify):
+    def provides_request(self, name, obj_to_notify, cache_ttl=None,
+            invalidate_on=(), coalesce=False):
         """Plugins: call this in your start() method to receive requests for this reqeust name
 
+        If cache_ttl is given, successful results are cached for that many
+        seconds, keyed by the request arguments (which must be hashable to be
+        cached). Any event matching one of the globs in invalidate_on clears
+        the cache for this request. Every caller gets the same result object,
+        so results of cached requests must not be modified.
+
+        If coalesce is true, a request issued while an identical one (same
+        arguments) is still in flight waits for that one instead of calling
+        the provider again. The same caveat about modifying results applies.
+
         """
         if name in self._request_listeners:
             log.msg("WARNING! two plugins provide the request {0}: {1} and {2}".format(
                 name, obj_to_notify.plugin_name, self._request_listeners[name].plugin_name))
         self._request_listeners[name] = obj_to_notify
+        self._subscriptions[obj_to_notify].add(("request", name, None))
+
+        self._uncache_request(name)
+        if coalesce:
+            self._coalesce.add(name)
+        else:
+            self._coalesce.discard(name)
+        if cache_ttl is not None:
+            self._cache_ttl[name] = cache_ttl
+            self._request_cache[name] = {}
+            for matchstr in invalidate_on:
+                self._cache_invalidators.add(matchstr, name)
+            self._invalidate_routes()
+
+    def _uncache_request(self, name):
+        if self._cache_ttl.pop(name, None) is not None:
+            del self._request_cache[name]
+            self._cache_invalidators.discard(name)
+            self._invalidate_routes()
+
+    def request_cache_stats(self):
+        """Returns a dict mapping the names of cacheable or coalesced requests
+        to dicts with their cache hits, misses, number of cached results, and
+        number of calls coalesced
+
+        """
+        return dict((name, dict(
+                    hits=self.request_cache_counts[name][0],
+                    misses=self.request_cache_counts[name][1],
+                    cached=len(self._request_cache.get(name, ())),
+                    coalesced=self.coalesce_counts[name],
+                    )) for name in set(self._cache_ttl) | self._coalesce)
 
 
     ### Called on plugin unloading
 
     def unhook_plugin(self, plugin):
-        for obj_set in chain(iter(self._middleware_listeners.values()),
-                iter(self._event_listeners.values())):
-            obj_set.discard(plugin)
-        for reqname, obj in list(self._request_listeners.items()):
-            if obj is plugin:
-                del self._request_listeners[reqname]
+        for kind, name, details in self._subscriptions.pop(plugin, ()):
+            if kind == "middleware":
+                self._middleware_listeners.subscribers(name).discard(plugin)
+                self._middleware_order.pop((name, plugin), None)
+            elif kind == "attribute":
+                entry = (details[0], plugin, details[1])
+                self._attribute_providers.subscribers(name).discard(entry)
+                self._attribute_order.pop(entry, None)
+            elif kind == "event":
+                self._event_listeners.subscribers(name, details).discard(
+                        plugin)
+            elif self._request_listeners.get(name) is plugin:
+                del self._request_listeners[name]
+                self._uncache_request(name)
+                self._coalesce.discard(name)
+        self._invalidate_routes()
+
+    def subscriptions(self, obj):
+        """Returns a list of obj's registrations with this transport, for
+        debugging. Each is a dict with the "kind" of registration ("event",
+        "middleware", "attribute" or "request") and the "name" (the glob or
+        request name). Events also have the "filters" dict and the number of
+        other objects subscribed to the same glob and filters as "shared",
+        middleware has its "priority", and attributes have the "attribute"
+        name.
+
+        """
+        subscriptions = []
+        for kind, name, details in self._subscriptions.get(obj, ()):
+            subscription = dict(kind=kind, name=name)
+            if kind == "event":
+                subscription['filters'] = dict(details)
+                subscription['shared'] = len(
+                        self._event_listeners.subscribers(name, details) -
+                        {obj})
+            elif kind == "middleware":
+                subscription['priority'] = \
+                        self._middleware_order[name, obj][0]
+            elif kind == "attribute":
+                subscription['attribute'] = details[0]
+            subscriptions.append(subscription)
+        subscriptions.sort(key=lambda s: (s['kind'], s['name']))
+        return subscriptions
 
 
 class Event(object):
     """Pretty much just a container for data"""
+    # The __dict__ slot keeps arbitrary attributes working, but lets
+    # subclasses made by event_class() store their declared attributes in
+    # slots. An instance's dict is only allocated once something assigns an
+    # attribute that isn't a slot, or reads __dict__.
+    # _lazy is set by the transport to the event type's lazy attribute
+    # providers when the event is dispatched, if it has any. See
+    # _provide_lazily()
+    __slots__ = ["eventtype", "_lazy", "__dict__"]
+
+    # The attributes stored in slots. See event_class()
+    _fields = ()
+
     def __init__(self, eventtype, **kwargs):
         self.__dict__.update(kwargs)
         self.eventtype = eventtype
 
+def _lazy_getattr(self, name):
+    # Only called for attributes that aren't set on the event
+    if name == "_lazy":
+        raise AttributeError(name)
+    try:
+        func = self._lazy[name]
+    except KeyError:
+        raise AttributeError(name)
+    value = func(self)
+    setattr(self, name, value)
+    return value
+
+# Maps Event classes to subclasses of them with the __getattr__ that provides
+# lazy attributes. The lazy classes map to themselves.
+_lazy_classes = {}
+
+def _provide_lazily(event, providers):
+    """Makes the given lazy attribute providers supply event's missing
+    attributes. Only events this is done to pay for a __getattr__ method;
+    looking up a missing attribute on any other event fails without running
+    any python code.
+
+    """
+    event._lazy = providers
+    cls = type(event)
+    try:
+        lazy_cls = _lazy_classes[cls]
+    except KeyError:
+        if not isinstance(event, Event):
+            return
+        lazy_cls = type(cls.__name__, (cls,), dict(
+            __slots__=(),
+            __getattr__=_lazy_getattr,
+            ))
+        _lazy_classes[cls] = _lazy_classes[lazy_cls] = lazy_cls
+    if lazy_cls is not cls:
+        # The lazy class adds no slots, so its instances have the same layout
+        event.__class__ = lazy_cls
+
+# Maps event types to the Event subclass make_event() should use for them
+_event_classes = {}
+
+# Marks the fields not passed to an event_class() class's constructor
+_unset = object()
+
+def event_class(eventtype, fields):
+    """Declares a compact Event subclass for the given event type, with the
+    given attribute names stored in __slots__ instead of the instance dict.
+    Events of this type created with make_event() will be instances of it.
+
+    This is for events emitted at a high rate. Instances behave just like any
+    other Event: attributes not in fields (such as those added by middleware)
+    may still be set on them, and they match EventWatcher templates the same
+    way.
+
+    """
+    fields = tuple(fields)
+    for name in fields:
+        if (not re.match(r"[A-Za-z_][A-Za-z0-9_]*$", name) or
+                keyword.iskeyword(name) or
+                name in ("self", "eventtype", "kwargs")):
+            raise ValueError("Invalid event field name {0!r}".format(name))
+    classname = "".join(x.capitalize() for x in
+            eventtype.replace(".", "_").split("_")) + "Event"
+    # The constructor is generated so that it assigns the slots directly,
+    # instead of looping over setattr() for every event
+    source = ["def __init__(self, eventtype",
+            "".join(", {0}=_unset".format(name) for name in fields),
+            ", **kwargs):\n",
+            "    self.eventtype = eventtype\n"]
+    for name in fields:
+        source.append("    if {0} is not _unset:\n"
+                "        self.{0} = {0}\n".format(name))
+    source.append("    if kwargs:\n"
+            "        self.__dict__.update(kwargs)\n")
+    namespace = dict(_unset=_unset)
+    exec("".join(source), namespace)
+    cls = type(classname, (Event,), dict(
+        __slots__=fields,
+        __init__=namespace['__init__'],
+        _fields=fields,
+        ))
+    _event_classes[eventtype] = cls
+    return cls
+
+def make_event(eventtype, **kwargs):
+    """Creates an Event of the given type, using the class declared for it
+    with event_class() if there is one
+
+    """
+    return _event_classes.get(eventtype, Event)(eventtype, **kwargs)
+
+def event_attrs(event, lazy=False):
+    """Returns a dict of the attributes set on the given event, whether stored
+    in slots or in the instance dict. The eventtype is not included.
+
+    Lazily provided attributes are only included once something has accessed
+    them. If lazy is True, the rest are included too, which calls their
+    providers; that may be expensive, so only ask for it when the values are
+    really needed.
+
+    """
+    attrs = {}
+    for name in event._fields:
+        try:
+            attrs[name] = getattr(event, name)
+        except AttributeError:
+            pass
+    attrs.update(vars(event))
+    if lazy:
+        for name in getattr(event, "_lazy", ()):
+            if name not in attrs:
+                attrs[name] = getattr(event, name)
+    return attrs
+